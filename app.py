@@ -1,33 +1,287 @@
 """客服系统后端API。
 
+:py:func:`create_app` 按照配置初始化数据库、构建状态机并且创建Flask应用。导入本模块本身没有副作用，
+第一次访问 ``app`` 属性时才按照 ``config.json`` 创建默认的应用，因此 ``from app import app`` 和 ``flask run`` 的用法不变。
+每个应用的会话、状态机等保存在 ``app.extensions["robot"]`` 中（参考 :py:class:`AppState` ），路由通过 ``current_app`` 读取。
+
 Copyright (c) 2021 Ziheng Mao.
 """
 
 import os
 import sys
+import atexit
+import logging
 import jwt
 import json
-from flask import Flask, jsonify, request, abort
-from server.state_machine import StateMachine, LoginError, GrammarError, init_database
+from time import perf_counter, time
+from threading import Lock
+from typing import Optional
+from flask import Flask, Blueprint, Response, jsonify, request, abort, g, current_app, has_app_context
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import TooManyRequests, UnsupportedMediaType
+from server.state_machine import StateMachine, LoginError, GrammarError, init_database, get_storage
+from server.storage import Storage
 from server.user_manage import UserManage
+from server.metrics import registry
+from server.tracing import CollapsedStackTracer, add_hook
+from server.transcript import TranscriptLog
+from server.admission import RateLimiter, ConcurrencyLimiter, rejected_total, retry_after
 
-app = Flask(__name__)
 try:
-    current_path = os.path.split(os.path.realpath(__file__))[0]
-    config: dict = json.load(open(os.path.join(current_path, "config.json")))
+    import msgpack  # 可选依赖，没有安装时只支持JSON
+except ImportError:
+    msgpack = None
+
+MSGPACK = "application/msgpack"
+MAX_SECONDS = 2 ** 31 - 1  # /echo 中闲置时间的上限（秒），会话快照以64位整数保存闲置时间
+
+current_path = os.path.split(os.path.realpath(__file__))[0]
+logger = logging.getLogger(__name__)
+api = Blueprint("api", __name__)
+_app_lock = Lock()
+
+request_seconds = registry.histogram("robot_http_request_seconds", "请求处理的耗时（秒）", ("route",))
+responses_total = registry.counter("robot_http_responses_total", "响应的数量", ("route", "status"))
+registry.gauge_function("robot_sessions", "当前会话的数量", ("login",),
+                        lambda: app_state().user_manage.session_count() if has_app_context() else {})
+
+
+class AppState(object):
+    """一个应用的服务端状态，保存在 ``app.extensions["robot"]`` 中，同一进程中的多个应用互不影响。
+
+    :ivar config: 创建应用的配置字典。
+    :ivar user_manage: 会话管理。
+    :ivar state_machine: 状态机。
+    :ivar storage: 存储后端。
+    :ivar transcript: 对话记录，没有配置时为None。
+    :ivar rate_limiter: 按照令牌的限速，没有配置时为None。
+    :ivar concurrency_limiter: 并发数量的限制，没有配置时为None。
+    :ivar snapshot_path: 会话快照路径，没有配置时为None。
+    :ivar tracer: 状态转移的采样器，没有配置时为None。
+    """
+
+    def __init__(self, config: dict, user_manage: UserManage, state_machine: StateMachine, storage: Storage) -> None:
+        self.config = config
+        self.user_manage = user_manage
+        self.state_machine = state_machine
+        self.storage = storage
+        self.transcript: Optional[TranscriptLog] = None
+        self.rate_limiter: Optional[RateLimiter] = None
+        self.concurrency_limiter: Optional[ConcurrencyLimiter] = None
+        self.snapshot_path: Optional[str] = None
+        self.tracer: Optional[CollapsedStackTracer] = None
+        self._stopped = False
+
+    def shutdown(self) -> None:
+        """写入剩余的对话记录、导出折叠栈文件、保存会话快照，最后停止存储后端的后台任务，内存数据库在此时写回磁盘。
+
+        每个应用在退出时调用一次，重复调用没有影响。
+        """
+        if self._stopped:
+            return
+        self._stopped = True
+        if self.transcript is not None:
+            self.transcript.shutdown()
+        if self.tracer is not None:
+            self.tracer.dump(os.path.join(current_path, self.config["trace_path"]))
+        if self.snapshot_path is not None:
+            self.user_manage.save_snapshot(self.snapshot_path, self.state_machine.states)
+        self.storage.shutdown()
+
+
+def app_state() -> AppState:
+    """返回当前请求所属应用的服务端状态。"""
+    return current_app.extensions["robot"]
+
+
+def load_config(path: str = os.path.join(current_path, "config.json")) -> dict:
+    """读取配置文件。
+
+    :param path: 配置文件路径。
+    :return: 配置字典。
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def create_app(config: dict) -> Flask:
+    """按照配置初始化数据库、构建状态机，并且创建Flask应用。
+
+    配置中的路径均相对于本文件所在的目录。每个应用有自己的 :py:class:`AppState` ，退出时调用一次 :py:meth:`AppState.shutdown` 。
+    数据库由 :py:func:`server.state_machine.init_database` 在进程中全局初始化，同一进程中的多个应用共用最后初始化的数据库。
+
+    :param config: 配置字典，各项配置参考用户指南。
+    :return: Flask应用。
+    :raises GrammarError: 脚本存在语法错误时触发。
+    :raises KeyError: 缺少必需的配置项时触发。
+    """
     user_manage = UserManage(config["key"])
-    init_database(os.path.join(current_path, config["db_path"]))
-    state_machine = StateMachine([os.path.join(current_path, path) for path in config["source"]])
-except GrammarError as err:
-    print(" ".join(err.context))
-    print("GrammarError: ", err.msg)
-    sys.exit(1)
-except (FileNotFoundError, json.JSONDecodeError, KeyError):
-    print("Error with config.json or file not found")
-    sys.exit(1)
-
-
-@app.route('/')
+    init_database(os.path.join(current_path, config["db_path"]), config.get("storage", "storm"),
+                  config.get("shards", 4), config.get("checkpoint_interval", 5.0), config.get("keep_database", False))
+    parse_cache = config.get("parse_cache")
+    state_machine = StateMachine([os.path.join(current_path, path) for path in config["source"]],
+                                 config.get("compile", False), config.get("match_cache_size", 1024),
+                                 os.path.join(current_path, parse_cache) if parse_cache else None)
+    state = AppState(config, user_manage, state_machine, get_storage())
+    if config.get("session_snapshot"):  # 启动时恢复会话，退出时保存会话
+        state.snapshot_path = os.path.join(current_path, config["session_snapshot"])
+        if os.path.exists(state.snapshot_path):
+            try:
+                user_manage.load_snapshot(state.snapshot_path, state_machine.states)
+            except ValueError:
+                logger.warning("Session snapshot %s is corrupted, ignored", state.snapshot_path)
+        if config.get("session_snapshot_interval", 0) > 0:
+            user_manage.autosave(state.snapshot_path, state_machine.states, config["session_snapshot_interval"])
+    if config.get("trace_path"):  # 采样状态转移，退出时导出折叠栈文件
+        state.tracer = CollapsedStackTracer(config.get("trace_sample_rate", 0.01))
+        add_hook(state.tracer)
+    if config.get("transcript_path"):  # 记录每一条消息和响应，退出时写入剩余的记录
+        state.transcript = TranscriptLog(os.path.join(current_path, config["transcript_path"]),
+                                         config.get("transcript_capacity", 10000),
+                                         config.get("transcript_policy", "drop"),
+                                         config.get("transcript_max_bytes", 64 << 20),
+                                         config.get("transcript_backups", 5))
+    if config.get("rate_limit", 0) > 0:  # 按照令牌限速
+        state.rate_limiter = RateLimiter(config["rate_limit"], config.get("rate_burst", 10))
+    if config.get("max_concurrency", 0) > 0:  # 限制同时处理的请求数量
+        state.concurrency_limiter = ConcurrencyLimiter(config["max_concurrency"],
+                                                       config.get("max_queue", config["max_concurrency"]),
+                                                       config.get("queue_timeout", 1.0))
+    atexit.register(state.shutdown)
+    app = Flask(__name__)
+    app.config["JSON_AS_ASCII"] = False  # 中文按照UTF-8输出，每个字符3字节，而不是6字节的转义序列
+    app.extensions["robot"] = state
+    app.register_blueprint(api)
+    return app
+
+
+def __getattr__(name: str) -> Flask:
+    """第一次访问 ``app`` 属性时按照 ``config.json`` 创建默认的应用，配置或者脚本有误时退出。"""
+    if name != "app":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with _app_lock:
+        if "app" not in globals():
+            try:
+                globals()["app"] = create_app(load_config())
+            except GrammarError as err:
+                print(" ".join(err.context))
+                print("GrammarError: ", err.msg)
+                sys.exit(1)
+            except (FileNotFoundError, json.JSONDecodeError, KeyError):
+                print("Error with config.json or file not found")
+                sys.exit(1)
+    return globals()["app"]
+
+
+@api.before_app_request
+def start_timer() -> None:
+    """记录请求开始处理的时刻。"""
+    g.start_time = perf_counter()
+
+
+def arguments() -> MultiDict:
+    """读取请求参数，结果缓存在 ``g`` 中，准入控制和路由只解析一次。
+
+    GET请求的参数在查询串中。POST请求的参数在请求体中，按照 ``Content-Type`` 解析为JSON或者MessagePack对象，
+    其中的数字转换为字符串，与查询串中的参数一致。请求体为空时没有参数。
+
+    :return: 请求参数。
+    :raises BadRequest: 请求体格式错误，或者不是由字符串和数字组成的对象时触发。
+    :raises UnsupportedMediaType: 请求体的类型不是JSON或者MessagePack时触发。
+    """
+    if "arguments" in g:
+        return g.arguments
+    if request.method != "POST":
+        g.arguments = request.args
+        return g.arguments
+    body = request.get_data(cache=False)
+    try:
+        if len(body) == 0:
+            data = dict()
+        elif request.mimetype == MSGPACK and msgpack is not None:
+            data = msgpack.unpackb(body)
+        elif request.mimetype == "application/json":
+            data = json.loads(body)
+        else:
+            raise UnsupportedMediaType()
+    except ValueError:  # JSON和MessagePack的格式错误都是ValueError的子类
+        abort(400)
+    if not isinstance(data, dict) or \
+            not all(isinstance(value, (str, int, float)) and not isinstance(value, bool) for value in data.values()):
+        abort(400)
+    g.arguments = MultiDict({key: value if isinstance(value, str) else str(value) for key, value in data.items()})
+    return g.arguments
+
+
+def reply(data: dict) -> Response:
+    """按照 ``Accept`` 请求头选择响应的编码，客户端更倾向于MessagePack时以MessagePack编码，否则以JSON编码。
+
+    响应带有 ``Vary: Accept`` 响应头，缓存不会把一种编码的响应返回给要求另一种编码的客户端。
+
+    :param data: 响应对象。
+    :return: 状态码为200的响应。
+    """
+    if msgpack is not None and request.accept_mimetypes.best_match(["application/json", MSGPACK]) == MSGPACK:
+        response = Response(msgpack.packb(data), mimetype=MSGPACK)
+    else:
+        response = jsonify(data)
+    response.vary.add("Accept")
+    return response
+
+
+@api.before_app_request
+def admit() -> None:
+    """准入控制，在令牌解码之前按照令牌限速，并且限制同时处理的请求数量。
+
+    没有令牌的请求只受并发数量的限制， ``/metrics`` 不受限制，过载时仍然可以观测服务端。
+
+    :raises TooManyRequests: 请求被拒绝时触发，响应为429和 ``Retry-After`` 响应头。
+    """
+    if request.endpoint == "api.metrics":
+        return
+    robot = app_state()
+    rate_limiter, concurrency_limiter = robot.rate_limiter, robot.concurrency_limiter
+    token = arguments().get("token")
+    if rate_limiter is not None and token is not None:
+        wait = rate_limiter.acquire(token)
+        if wait > 0:
+            rejected_total.inc(("rate",))
+            raise TooManyRequests(retry_after=retry_after(wait))
+    if concurrency_limiter is not None:
+        if not concurrency_limiter.acquire():
+            rejected_total.inc(("concurrency",))
+            raise TooManyRequests(retry_after=retry_after(concurrency_limiter.timeout))
+        g.limiter = concurrency_limiter
+
+
+@api.teardown_app_request
+def release(exception: Optional[BaseException]) -> None:
+    """请求结束时释放并发名额。"""
+    limiter = g.pop("limiter", None)
+    if limiter is not None:
+        limiter.release()
+
+
+@api.after_app_request
+def record_latency(response):
+    """记录请求的处理耗时和响应状态码。"""
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    request_seconds.observe((route,), perf_counter() - g.start_time)
+    responses_total.inc((route, str(response.status_code)))
+    return response
+
+
+@api.route('/metrics')
+def metrics():
+    """导出服务器的性能指标。
+
+    :return: Prometheus文本格式的指标，包括各个路由的请求耗时、各个状态的转移耗时、各类动作的耗时、数据库锁的等待和持有时间，以及当前会话的数量。
+    :status 200: 成功导出指标。
+    """
+    return registry.expose(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+@api.route('/', methods=["GET", "POST"])
 def connect():
     """一个新的客户端连接到服务器时，请求一个token。
 
@@ -37,11 +291,12 @@ def connect():
     一个客户端与服务器建立连接时，或者客户端开始一个新的会话时，从此路由获取一个token。
     服务器默认分配一个访客账户，如果设置了默认的问候消息，还会返回消息列表。
     """
-    user, token = user_manage.connect()
-    return jsonify({"msg": state_machine.hello(user.state), "token": token}), 200
+    robot = app_state()
+    user, token = robot.user_manage.connect()
+    return reply({"msg": robot.state_machine.hello(user.state), "token": token})
 
 
-@app.route('/send')
+@api.route('/send', methods=["GET", "POST"])
 def send():
     """客户端发送一条新消息，服务器返回响应。
 
@@ -49,7 +304,9 @@ def send():
     :return: 返回一个消息列表和是否结束会话的标志，格式为：``{"msg": ["xxx", "xxx"], "exit": false}``。
     :status 200: 鉴权成功，服务器产生响应。
     :status 400: 客户端请求消息格式有误。
+    :status 415: 请求体不是JSON或者MessagePack。
     :status 403: 鉴权失败。
+    :status 429: 请求过于频繁或者服务端过载，客户端应当在 ``Retry-After`` 秒之后重试。
     :status 401: 用户是访客，需要登录。
 
     一个客户端通过此路由向服务器发送一条消息。
@@ -58,13 +315,24 @@ def send():
     如果服务器需要终止一个会话，则设 ``exit`` 为1，该token立即过期，客户端需要重新开启一个会话。
     """
     try:
-        msg = request.args["msg"]
-        token = request.args["token"]
-        user = user_manage.jwt_decode(token)
-        response = state_machine.condition_transform(user.state, msg)
-        if user.state.state == -1:
-            user_manage.timeout_handler(user.username)
-        return jsonify({"msg": response, "exit": user.state.state == -1}), 200
+        args = arguments()
+        msg = args["msg"]
+        token = args["token"]
+        robot = app_state()
+        user_manage, state_machine, transcript = robot.user_manage, robot.state_machine, robot.transcript
+        with user_manage.session(token) as user:  # 同一个会话的请求依次执行
+            state, start = user.state.state, perf_counter()
+            response = state_machine.condition_transform(user.state, msg)
+            next_state = user.state.state
+            if transcript is not None:
+                transcript.push((time(), user.username, state_machine.states[state],
+                                 state_machine.states[next_state] if next_state >= 0 else None, msg, response,
+                                 perf_counter() - start))
+            if next_state == -1:
+                user_manage.timeout_handler(user.username)
+            else:
+                user_manage.commit(user)
+        return reply({"msg": response, "exit": next_state == -1})
     except KeyError:
         abort(400)
     except jwt.InvalidTokenError:
@@ -73,7 +341,7 @@ def send():
         abort(401)
 
 
-@app.route('/echo')
+@api.route('/echo', methods=["GET", "POST"])
 def echo():
     """客户端发送一条echo，服务器返回响应。
 
@@ -81,8 +349,10 @@ def echo():
     :return: 返回一个消息列表、是否结束会话的标志和是否要求用户重置计时器的标志，格式为：
         ``{"msg": ["xxx", "xxx"], "exit": false, reset: false}``。
     :status 200: 鉴权成功，服务器产生响应。
-    :status 400: 客户端请求消息格式有误。
+    :status 400: 客户端请求消息格式有误，或者闲置时间为负数或超出范围。
+    :status 415: 请求体不是JSON或者MessagePack。
     :status 403: 鉴权失败。
+    :status 429: 请求过于频繁或者服务端过载，客户端应当在 ``Retry-After`` 秒之后重试。
     :status 401: 用户是访客，需要登录。
 
     一个客户端通过此路由向服务器发送一条echo，表明自己仍然存活和用户闲置的时间。
@@ -92,13 +362,20 @@ def echo():
     如果服务器要求客户端重置闲置时间计时器，则设 ``reset`` 为1，客户端应当重启计时器。
     """
     try:
-        seconds = int(request.args["seconds"])
-        token = request.args["token"]
-        user = user_manage.jwt_decode(token)
-        response, exit_, reset_timer = state_machine.timeout_transform(user.state, seconds)
-        if exit_:
-            user_manage.timeout_handler(user.username)
-        return jsonify({"msg": response, "exit": exit_, "reset": reset_timer}), 200
+        args = arguments()
+        seconds = int(args["seconds"])
+        if not 0 <= seconds <= MAX_SECONDS:
+            raise ValueError(f"闲置时间 {seconds} 超出范围")
+        token = args["token"]
+        robot = app_state()
+        user_manage, state_machine = robot.user_manage, robot.state_machine
+        with user_manage.session(token) as user:
+            response, exit_, reset_timer = state_machine.timeout_transform(user.state, seconds)
+            if exit_:
+                user_manage.timeout_handler(user.username)
+            else:
+                user_manage.commit(user)
+        return reply({"msg": response, "exit": exit_, "reset": reset_timer})
     except (KeyError, ValueError):
         abort(400)
     except jwt.InvalidTokenError:
@@ -107,7 +384,7 @@ def echo():
         abort(401)
 
 
-@app.route('/login')
+@api.route('/login', methods=["GET", "POST"])
 def login():
     """客户端请求登录，服务器返回新的token。
 
@@ -115,7 +392,9 @@ def login():
     :return: 返回一个新的token，格式为：``{"token": "xxx"}``。
     :status 200: 鉴权并登录成功。
     :status 400: 客户端请求消息格式有误。
+    :status 415: 请求体不是JSON或者MessagePack。
     :status 403: 鉴权失败。
+    :status 429: 请求过于频繁或者服务端过载，客户端应当在 ``Retry-After`` 秒之后重试。
 
     一个客户端通过此路由向服务器发送一个登录请求。
 
@@ -123,19 +402,21 @@ def login():
     原有的token立即过期，客户端需要使用新的token继续会话。
     """
     try:
-        username = request.args["username"]
-        passwd = request.args["passwd"]
-        token = request.args["token"]
-        user = user_manage.jwt_decode(token)
-        new_token = user_manage.login(user, username, passwd)
-        return jsonify({"token": new_token}), 200
+        args = arguments()
+        username = args["username"]
+        passwd = args["passwd"]
+        token = args["token"]
+        user_manage = app_state().user_manage
+        with user_manage.session(token) as user:
+            new_token = user_manage.login(user, username, passwd)
+        return reply({"token": new_token})
     except jwt.InvalidTokenError:
         abort(403)
     except KeyError:
         abort(400)
 
 
-@app.route('/register')
+@api.route('/register', methods=["GET", "POST"])
 def register():
     """客户端请求注册，服务器返回新的token。
 
@@ -143,7 +424,9 @@ def register():
     :return: 返回一个新的token，格式为：``{"token": "xxx"}``。
     :status 200: 鉴权并注册成功。
     :status 400: 客户端请求消息格式有误。
+    :status 415: 请求体不是JSON或者MessagePack。
     :status 403: 鉴权失败。
+    :status 429: 请求过于频繁或者服务端过载，客户端应当在 ``Retry-After`` 秒之后重试。
 
     一个客户端通过此路由向服务器发送一个注册请求。
 
@@ -151,12 +434,14 @@ def register():
     原有的token立即过期，客户端需要使用新的token继续会话。
     """
     try:
-        username = request.args["username"]
-        passwd = request.args["passwd"]
-        token = request.args["token"]
-        user = user_manage.jwt_decode(token)
-        new_token = user_manage.register(user, username, passwd)
-        return jsonify({"token": new_token}), 200
+        args = arguments()
+        username = args["username"]
+        passwd = args["passwd"]
+        token = args["token"]
+        user_manage = app_state().user_manage
+        with user_manage.session(token) as user:
+            new_token = user_manage.register(user, username, passwd)
+        return reply({"token": new_token})
     except jwt.InvalidTokenError:
         abort(403)
     except KeyError:
@@ -164,4 +449,4 @@ def register():
 
 
 if __name__ == '__main__':
-    app.run()
+    create_app(load_config()).run()
@@ -0,0 +1,52 @@
+"""在Zipf分布的消息语料上测量匹配结果缓存的命中率和耗时。
+
+运行方式：``python -m benchmark.bench_match_cache``
+
+Copyright (c) 2021 Ziheng Mao.
+"""
+
+import os
+import random
+import tempfile
+import timeit
+from server.state_machine import StateMachine, MessageContext, init_database
+from benchmark.bench_matchers import SCRIPT
+
+HOT_MESSAGES = ["余额", "退出", "返回", "投诉", "改名", "帮助", "充值", "100", "好的", "是"]
+
+
+def zipf_corpus(size: int, vocabulary: int, exponent: float = 1.1, seed: int = 0) -> list[str]:
+    """生成服从Zipf分布的消息语料。
+
+    :param size: 语料中的消息数量。
+    :param vocabulary: 不同消息的数量。
+    :param exponent: Zipf分布的指数。
+    :param seed: 随机数种子。
+    :return: 消息列表。
+    """
+    words = HOT_MESSAGES + [f"我想咨询第{i}个问题" for i in range(vocabulary - len(HOT_MESSAGES))]
+    weights = [1 / (rank + 1) ** exponent for rank in range(vocabulary)]
+    return random.Random(seed).choices(words, weights, k=size)
+
+
+def main() -> None:
+    corpus = zipf_corpus(100000, 5000)
+    for cache_size in [0, 256, 1024]:
+        with tempfile.TemporaryDirectory() as directory:
+            script = os.path.join(directory, "script.txt")
+            with open(script, "w", encoding="utf-8") as f:
+                f.write(SCRIPT)
+            init_database(os.path.join(directory, "bench.db"))
+            machine = StateMachine([script], cache_size=cache_size)
+        matcher = machine.matchers[0]
+        seconds = min(timeit.repeat(lambda: [matcher(MessageContext(msg)) for msg in corpus], number=1, repeat=3))
+        line = f"cache_size={cache_size:<6}{seconds / len(corpus) * 1e9:>8.0f} ns/message"
+        if cache_size > 0:
+            hits = machine.cache_statistics("hits")[("Welcome",)]
+            misses = machine.cache_statistics("misses")[("Welcome",)]
+            line += f"    hit rate {hits / (hits + misses):.1%}"
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""比较解释执行和生成代码两种方式匹配条件分支的耗时。
+
+运行方式：``python -m benchmark.bench_matchers``
+
+Copyright (c) 2021 Ziheng Mao.
+"""
+
+import os
+import tempfile
+import timeit
+from server.state_machine import StateMachine, MessageContext, init_database
+from server.codegen import compile_matchers
+
+SCRIPT = """
+State Welcome
+    Case Contain "余额"
+        Goto Welcome
+    Case Contain "改名"
+        Goto Welcome
+    Case "投诉"
+        Goto Welcome
+    Case "退出"
+        Goto Welcome
+    Case "返回"
+        Goto Welcome
+    Case "帮助"
+        Goto Welcome
+    Case Type Int
+        Goto Welcome
+    Case Type Real
+        Goto Welcome
+    Case Length <= 2
+        Goto Welcome
+    Case Length > 200
+        Goto Welcome
+    Default
+"""
+
+MESSAGES = ["余额", "我要改名", "投诉", "退出", "返回", "123", "12.5", "好", "我想咨询一下别的问题", "x" * 300]
+
+
+def bench_matchers() -> dict[str, float]:
+    """测量解释执行和生成代码两种方式每条消息的匹配耗时。
+
+    :return: 从匹配方式映射到每条消息耗时（纳秒）的字典。
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        script = os.path.join(directory, "script.txt")
+        with open(script, "w", encoding="utf-8") as f:
+            f.write(SCRIPT)
+        init_database(os.path.join(directory, "bench.db"))
+        machine = StateMachine([script])
+    interpreted = machine.matchers[0]
+    compiled = compile_matchers(machine.states, machine.case)[0]
+    for msg in MESSAGES:
+        assert interpreted(MessageContext(msg)) == compiled(MessageContext(msg))
+
+    number = 20000
+    interpreted_time = min(timeit.repeat(lambda: [interpreted(MessageContext(msg)) for msg in MESSAGES],
+                                         number=number, repeat=3))
+    compiled_time = min(timeit.repeat(lambda: [compiled(MessageContext(msg)) for msg in MESSAGES],
+                                      number=number, repeat=3))
+    per_message = number * len(MESSAGES)
+    return {"interpreted": interpreted_time / per_message * 1e9, "compiled": compiled_time / per_message * 1e9}
+
+
+def main() -> None:
+    result = bench_matchers()
+    print(f"interpreted: {result['interpreted']:.0f} ns/message")
+    print(f"compiled:    {result['compiled']:.0f} ns/message")
+    print(f"speedup:     {result['interpreted'] / result['compiled']:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""各类条件和动作的微基准测试。
+
+运行方式：``python -m benchmark.bench_micro``
+
+Copyright (c) 2021 Ziheng Mao.
+"""
+
+import os
+import tempfile
+import timeit
+from typing import Callable
+from storm.locals import Store
+from storm.properties import Int, Float, Unicode
+from server.state_machine import LengthCondition, ContainCondition, TypeCondition, EqualCondition, ExitAction, \
+    GotoAction, UpdateAction, SpeakAction, MessageContext, UserState, UserVariableSet, init_database, get_database
+
+MESSAGES = ["余额", "  投诉 ", "123", "12.5", "我想咨询一下别的问题", ""]
+
+
+def measure(function: Callable[[], None], number: int) -> float:
+    """测量一个函数的耗时。
+
+    :param function: 被测函数。
+    :param number: 每轮调用的次数。
+    :return: 每次调用的耗时（纳秒），取三轮中的最小值。
+    """
+    return min(timeit.repeat(function, number=number, repeat=3)) / number * 1e9
+
+
+def bench_conditions() -> dict[str, float]:
+    """测量各类条件每次判断的耗时。"""
+    conditions = [LengthCondition(op, 5) for op in ["<", ">", "<=", ">=", "="]]
+    conditions += [ContainCondition("余额"), TypeCondition("Int"), TypeCondition("Real"), EqualCondition("投诉")]
+    result = dict()
+    for condition in conditions:
+        check = condition.check
+
+        def run() -> None:
+            for msg in MESSAGES:
+                check(MessageContext(msg))  # 每条消息使用新的上下文
+
+        result[repr(condition)] = measure(run, 20000) / len(MESSAGES)
+    return result
+
+
+def bench_actions() -> dict[str, float]:
+    """测量各类动作每次执行的耗时。"""
+    UserVariableSet.bench_int = Int(default=0)
+    UserVariableSet.bench_real = Float(default=0.0)
+    UserVariableSet.bench_text = Unicode(default="default")
+    UserVariableSet.column_type.update({"bench_int": "Int", "bench_real": "Real", "bench_text": "Text"})
+    result = dict()
+    with tempfile.TemporaryDirectory() as directory:
+        init_database(os.path.join(directory, "bench.db"))
+        store = Store(get_database())
+        store.execute("CREATE TABLE user_variable (username TEXT PRIMARY KEY, passwd TEXT, "
+                      "bench_int INTEGER, bench_real REAL, bench_text TEXT)")
+        store.commit()
+        store.close()
+        user_state = UserState()
+        user_state.register("bench", "")
+
+        actions = [(ExitAction(), ""), (GotoAction(0, False), ""),
+                   (UpdateAction("bench_int", "Add", 1, None), ""),
+                   (UpdateAction("bench_int", "Sub", "Copy", "Int"), "2"),
+                   (UpdateAction("bench_real", "Add", "Copy", "Real"), "1.5"),
+                   (UpdateAction("bench_text", "Set", "\"text\"", None), ""),
+                   (UpdateAction("bench_text", "Set", "Copy", "Text"), "copy"),
+                   (SpeakAction(["\"你好\"", "Copy"]), "copy"),
+                   (SpeakAction(["\"余额为\"", "$bench_real"]), ""),
+                   (SpeakAction(["$bench_text", "\"，余额为\"", "$bench_real"]), "")]
+        for action, request in actions:
+            response: list[str] = []
+            uses_database = isinstance(action, UpdateAction) or "$" in repr(action)
+            number = 200 if uses_database else 20000
+            result[repr(action)] = measure(lambda: action.exec(user_state, response, MessageContext(request)), number)
+            response.clear()
+    return result
+
+
+def main() -> None:
+    for name, nanoseconds in bench_conditions().items():
+        print(f"{name:<40}{nanoseconds:>12.0f} ns")
+    for name, nanoseconds in bench_actions().items():
+        print(f"{name:<40}{nanoseconds:>12.0f} ns")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""比较一个状态中的正则表达式条件合并为 :py:class:`server.state_machine.RegexGroup` 之后和逐个搜索时每条消息的耗时。
+
+运行方式：``python -m benchmark.bench_regex_group``
+
+Copyright (c) 2021 Ziheng Mao.
+"""
+
+import timeit
+from server.state_machine import MatchCondition, MessageContext, RegexGroup
+
+MESSAGES = {
+    "short, no match": "你好" * 5,
+    "long, no match": "你好" * 100,
+    "long, last clause at end": "你好" * 100 + "订单{last}号12",
+    "long, middle clause at start": "订单{middle}号1" + "你好" * 100,
+}
+
+
+def bench(clauses: int, number: int = 2000) -> dict[str, tuple[float, float]]:
+    """测量一组消息在合并模式和逐个搜索下的耗时。
+
+    :param clauses: 正则表达式条件的数量。
+    :param number: 每条消息的重复次数。
+    :return: 从消息名映射到合并模式和逐个搜索每条消息耗时（微秒）的字典。
+    """
+    conditions = [MatchCondition(f"订单{i}号\\d+") for i in range(clauses)]
+    group = RegexGroup.combine(conditions)
+    result = dict()
+    for name, template in MESSAGES.items():
+        message = template.format(last=clauses - 1, middle=clauses // 2)
+        combined = min(timeit.repeat(lambda: group._scan(MessageContext(message)), number=number, repeat=3))
+        separate = min(timeit.repeat(lambda: next((position for position, condition in enumerate(conditions)
+                                                   if condition.regex.search(message)), -1),
+                                     number=number, repeat=3))
+        result[name] = (combined / number * 1e6, separate / number * 1e6)
+    return result
+
+
+def main() -> None:
+    for clauses in [5, 20, 100]:
+        for name, (combined, separate) in bench(clauses).items():
+            print(f"clauses={clauses:<4}{name:<30}combined {combined:>7.2f} us  separate {separate:>7.2f} us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""在不同规模的短语集合上测量 ``Similar`` 条件索引的建立时间、内存占用和每条消息的匹配耗时。
+
+运行方式：``python -m benchmark.bench_similar`` 。给出短语时进入交互模式，输出每行输入和各个短语的相似度，
+例如 ``python -m benchmark.bench_similar 查询余额 我要投诉`` 。
+
+Copyright (c) 2021 Ziheng Mao.
+"""
+
+import random
+import sys
+import timeit
+from time import perf_counter
+from server.state_machine import SimilarCondition, MessageContext
+from server.similarity import SimilarIndex
+
+VERBS = ["查询", "修改", "取消", "办理", "咨询", "投诉", "开通", "关闭", "充值", "退订"]
+OBJECTS = ["余额", "套餐", "流量", "话费", "宽带", "积分", "账单", "密码", "地址", "发票"]
+
+
+def phrases(size: int, seed: int = 0) -> list[str]:
+    """生成意图短语。
+
+    :param size: 短语数量。
+    :param seed: 随机数种子。
+    :return: 短语列表。
+    """
+    generator = random.Random(seed)
+    return [f"我想{generator.choice(VERBS)}{generator.choice(OBJECTS)}{i}" for i in range(size)]
+
+
+def main() -> None:
+    messages = ["帮我查询一下余额", "我要投诉", "宽带怎么开通", "你好", "我想修改密码123"]
+    for size in [1000, 50000]:
+        conditions = [SimilarCondition(phrase, 0.8) for phrase in phrases(size)]
+        start = perf_counter()
+        index = SimilarIndex.combine(conditions)
+        build = perf_counter() - start
+        number = 200 if size <= 1000 else 20
+        seconds = min(timeit.repeat(lambda: [index.first(MessageContext(msg)) for msg in messages],
+                                    number=number, repeat=3))
+        print(f"phrases={size:<7}build {build * 1e3:>8.1f} ms  index {index.nbytes / 2 ** 20:>6.1f} MiB  "
+              f"{seconds / number / len(messages) * 1e6:>8.1f} us/message")
+
+
+def interact(texts: list[str]) -> None:
+    """从标准输入逐行读取消息，输出它和各个短语的相似度，用于调整阈值。
+
+    :param texts: 短语列表。
+    """
+    index = SimilarIndex([SimilarCondition(text, 0.5) for text in texts])
+    while True:
+        try:
+            line = input("> ")
+        except EOFError:
+            break
+        for text, score in zip(texts, index.scores(MessageContext(line))):
+            print(f"{score:.3f}  {text}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        interact(sys.argv[1:])
+    else:
+        main()
@@ -0,0 +1,97 @@
+"""测量服务端的导入耗时和冷启动耗时。
+
+导入耗时通过 ``python -X importtime -c "import app"`` 测量，列出累计耗时最长的模块。
+冷启动耗时为新的解释器进程从启动到 :py:func:`app.create_app` 返回的时间，脚本由 :py:func:`benchmark.suite.generate_script`
+生成，分别测量不使用语法树缓存、缓存未命中（解析并写入缓存）和缓存命中三种情况，并且与目标耗时比较。
+
+运行方式：``python -m benchmark.bench_startup``
+
+Copyright (c) 2021 Ziheng Mao.
+"""
+
+import os
+import sys
+import json
+import tempfile
+import subprocess
+from time import perf_counter
+from benchmark.suite import generate_script
+
+STATES = [10, 100, 300]
+TARGET_SECONDS = 0.3  # 缓存命中时，最大的脚本的冷启动目标耗时
+REPEAT = 3
+
+STARTUP = """
+import sys, json
+from time import perf_counter
+start = perf_counter()
+import app
+imported = perf_counter()
+app.create_app(json.loads(sys.argv[1]))
+print(json.dumps([imported - start, perf_counter() - imported]))
+"""
+
+
+def import_time(top: int = 10) -> tuple[float, list[tuple[str, float]]]:
+    """通过 ``-X importtime`` 测量导入 :py:mod:`app` 的耗时。
+
+    :param top: 列出的模块数量。
+    :return: 导入 ``app`` 的累计耗时（秒），以及累计耗时最长的若干模块和耗时（秒）。
+    """
+    root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], cwd=root,
+                             stderr=subprocess.PIPE, check=True, encoding="utf-8")
+    modules = dict()
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit():
+            modules[name.strip()] = int(cumulative) / 1e6
+    ranked = sorted(modules.items(), key=lambda item: item[1], reverse=True)
+    return modules.get("app", 0.0), [item for item in ranked if item[0] != "app"][:top]
+
+
+def cold_start(config: dict) -> tuple[float, float, float]:
+    """在新的解释器进程中导入 :py:mod:`app` 并且创建应用。
+
+    :param config: 传给 :py:func:`app.create_app` 的配置。
+    :return: 进程的总耗时、导入 ``app`` 的耗时和 ``create_app`` 的耗时（秒）。
+    """
+    root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    start = perf_counter()
+    process = subprocess.run([sys.executable, "-c", STARTUP, json.dumps(config)], cwd=root, stdout=subprocess.PIPE,
+                             check=True, encoding="utf-8")
+    total = perf_counter() - start
+    imported, created = json.loads(process.stdout.strip().splitlines()[-1])
+    return total, imported, created
+
+
+def main() -> None:
+    total, modules = import_time()
+    print(f"import app: {total * 1000:.1f}ms (-X importtime, cumulative)")
+    for name, seconds in modules:
+        print(f"  {name:<40}{seconds * 1000:>8.1f}ms")
+
+    print(f"{'states':<8}{'mode':<12}{'process':>10}{'import':>10}{'create':>10}")
+    last = None
+    with tempfile.TemporaryDirectory() as directory:
+        for states in STATES:
+            script = os.path.join(directory, f"script{states}.txt")
+            with open(script, "w", encoding="utf-8") as f:
+                f.write(generate_script(states))
+            config = {"key": "secret", "db_path": os.path.join(directory, "startup.db"), "source": [script],
+                      "storage": "sqlite"}
+            cache = os.path.join(directory, f"cache{states}")
+            runs = [("no cache", config, REPEAT), ("cache miss", dict(config, parse_cache=cache), 1),
+                    ("cache hit", dict(config, parse_cache=cache), REPEAT)]
+            for mode, run_config, repeat in runs:
+                total, imported, created = min(cold_start(run_config) for _ in range(repeat))
+                print(f"{states:<8}{mode:<12}{total * 1000:>8.1f}ms{imported * 1000:>8.1f}ms{created * 1000:>8.1f}ms")
+                last = total
+    print(f"target: {STATES[-1]} states with a cache hit in {TARGET_SECONDS * 1000:.0f}ms, "
+          f"{'met' if last <= TARGET_SECONDS else 'missed'} ({last * 1000:.1f}ms)")
+
+
+if __name__ == '__main__':
+    main()
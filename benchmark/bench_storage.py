@@ -0,0 +1,89 @@
+"""比较各个存储后端在注册、登录、Speak和Update动作上的耗时，每个请求一个新线程时登录的耗时，以及多个线程同时更新不同用户时每次更新的平均耗时。
+
+运行方式：``python -m benchmark.bench_storage``
+
+Copyright (c) 2021 Ziheng Mao.
+"""
+
+import os
+import tempfile
+from threading import Thread
+from time import perf_counter_ns
+from server.state_machine import StateMachine, UpdateAction, SpeakAction, MessageContext, UserState, init_database, \
+    get_storage
+from benchmark.bench_micro import measure
+
+BACKENDS = ["storm", "sqlite", "memory", "sharded"]
+THREADS = 8
+
+SCRIPT = """
+Variable
+    $name Text "用户"
+    $billing Real 0.0
+    $transactions Int 0
+
+State Welcome
+    Default
+"""
+
+
+def bench_backend(backend: str) -> dict[str, float]:
+    """测量一种存储后端各项操作的耗时。
+
+    :param backend: 存储后端。
+    :return: 从操作名映射到每次操作耗时（纳秒）的字典。
+    """
+    result = dict()
+    with tempfile.TemporaryDirectory() as directory:
+        script = os.path.join(directory, "script.txt")
+        with open(script, "w", encoding="utf-8") as f:
+            f.write(SCRIPT)
+        init_database(os.path.join(directory, "bench.db"), backend)
+        StateMachine([script])
+        storage = get_storage()
+        user_state = UserState()
+        user_state.register("bench", "bench")
+
+        counter = iter(range(10 ** 9))
+        result["register"] = measure(lambda: storage.register(f"user{next(counter)}", ""), 200)
+        result["login"] = measure(lambda: user_state.login("bench", "bench"), 2000)
+
+        def login_in_thread() -> None:  # 模拟Werkzeug为每个请求创建新的线程
+            thread = Thread(target=user_state.login, args=("bench", "bench"))
+            thread.start()
+            thread.join()
+
+        result["login, new thread"] = measure(login_in_thread, 500)
+        speak = SpeakAction(["$name", "\"，余额为\"", "$billing", "\"，交易次数\"", "$transactions"])
+        result[repr(speak)] = measure(lambda: speak.exec(user_state, [], None), 2000)
+        update = UpdateAction("billing", "Add", "Copy", "Real")
+        message = MessageContext("1.5")
+        result[repr(update)] = measure(lambda: update.exec(user_state, [], message), 200)
+
+        def worker(name: str) -> None:
+            state = UserState()
+            state.register(name, "")
+            for _ in range(100):
+                update.exec(state, [], message)
+
+        pool = [Thread(target=worker, args=(f"thread{i}",)) for i in range(THREADS)]
+        start = perf_counter_ns()
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+        result[f"{update!r} x{THREADS} threads"] = (perf_counter_ns() - start) / THREADS / 100
+        storage.close()
+        storage.shutdown()
+    return result
+
+
+def main() -> None:
+    results = [bench_backend(backend) for backend in BACKENDS]
+    print(f"{'':<60}" + "".join(f"{backend:>12}" for backend in BACKENDS))
+    for name in results[0]:
+        print(f"{name:<60}" + "".join(f"{result[name]:>10.0f}ns" for result in results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""比较请求和响应的各种编码方式：GET查询字符串、JSON（转义和不转义非ASCII字符）以及MessagePack。
+
+对于一条典型的中文 ``/send`` 请求和响应，分别报告编码后的字节数和一次编码加解码的耗时，
+之后通过Flask测试客户端测量以各种方式请求 ``/send`` 的端到端耗时。没有安装 ``msgpack`` 时跳过MessagePack。
+
+运行方式：``python -m benchmark.bench_wire``
+
+Copyright (c) 2021 Ziheng Mao.
+"""
+
+import json
+from typing import Any, Callable
+from urllib.parse import urlencode, parse_qs
+from benchmark.bench_micro import measure
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+TOKEN = "eyJ0eXAiOiJKV1QiLCJhbGciOiJIUzI1NiJ9.eyJ1c2VybmFtZSI6Ikd1ZXN0XzE3OTIzODE3MjgxMzgzMjM4NTdfMTkzOTEifQ." \
+        "cFOPXjy5c_9Vezy3yQvCENEV2W4li8lhehTLAJnkyc0"
+REQUEST = {"msg": "我想查询一下账户余额", "token": TOKEN}
+RESPONSE = {"msg": ["您好，用户，您的余额为100.0元", "请问还有什么可以帮您？输入“投诉”进入投诉，输入“退出”结束会话"], "exit": False}
+
+
+def codecs() -> dict[str, tuple[Callable[[Any], bytes], Callable[[bytes], Any]]]:
+    """返回从编码名映射到编码函数和解码函数的字典，查询字符串只用于请求。"""
+    result = {
+        "query": (lambda data: urlencode(data).encode("ascii"), lambda data: parse_qs(data.decode("ascii"))),
+        "json ascii": (lambda data: json.dumps(data).encode("ascii"), json.loads),
+        "json utf-8": (lambda data: json.dumps(data, ensure_ascii=False).encode("utf-8"), json.loads)}
+    if msgpack is not None:
+        result["msgpack"] = (msgpack.packb, msgpack.unpackb)
+    return result
+
+
+def bench_codecs() -> list[tuple[str, str, int, float]]:
+    """测量各种编码方式的字节数和一次编码加解码的耗时（纳秒）。"""
+    result = []
+    for name, (encode, decode) in codecs().items():
+        for kind, data in [("request", REQUEST), ("response", RESPONSE)]:
+            if name == "query" and kind == "response":
+                continue
+            result.append((name, kind, len(encode(data)), measure(lambda: decode(encode(data)), 20000)))
+    return result
+
+
+def bench_http() -> dict[str, float]:
+    """通过Flask测试客户端测量以各种方式请求 ``/send`` 的端到端耗时（纳秒）。"""
+    from app import app
+
+    client = app.test_client()
+    token = client.post("/").get_json()["token"]
+    params = {"msg": REQUEST["msg"], "token": token}
+    result = {"GET query": measure(lambda: client.get("/send", query_string=params), 1000),
+              "POST json": measure(lambda: client.post("/send", json=params), 1000)}
+    if msgpack is not None:
+        body = msgpack.packb(params)
+        headers = {"Content-Type": "application/msgpack", "Accept": "application/msgpack"}
+        result["POST msgpack"] = measure(lambda: client.post("/send", data=body, headers=headers), 1000)
+    return result
+
+
+def main() -> None:
+    print(f"{'format':<14}{'payload':<10}{'bytes':>8}{'encode+decode':>16}")
+    for name, kind, size, ns in bench_codecs():
+        print(f"{name:<14}{kind:<10}{size:>8}{ns:>14.0f}ns")
+    print(f"{'request':<24}{'/send':>16}")
+    for name, ns in bench_http().items():
+        print(f"{name:<24}{ns / 1000:>14.1f}us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+"""按照客户端的协议产生负载，报告各个路由的延迟分位数、吞吐量和错误率。
+
+每个虚拟客户端与 :py:class:`client.main.ClientModel` 的行为一致：连接时请求 ``/`` 获取令牌，按照一定比例注册并登录，
+之后在思考时间之后发送消息，并且每隔 ``--echo`` 秒发送一次 ``/echo`` 报告闲置时间。会话结束或者令牌被拒绝时重新连接。
+
+所有虚拟客户端运行在一个asyncio事件循环中，每个客户端持有一个HTTP/1.1长连接，服务端关闭连接时重新建立。
+请求默认与客户端一样以POST发送MessagePack（没有安装 ``msgpack`` 时为JSON），也可以通过 ``--format`` 选择旧的GET查询字符串。
+
+运行方式：``python -m benchmark.loadgen --launch -c 1000 -d 60``
+
+消息比例文件为JSON对象，从消息映射到权重，例如 ``{"余额": 3, "投诉": 1, "退出": 1}`` 。
+
+Copyright (c) 2021 Ziheng Mao.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import subprocess
+from typing import Optional
+from urllib.parse import urlencode, urlsplit
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+DEFAULT_MIX = {"余额": 4, "改名": 2, "新名字": 2, "充值": 2, "100": 2, "返回": 3, "投诉": 1, "退出": 1, "你好": 3}
+REQUEST_TIMEOUT = 10  # 请求的超时时间（秒）
+FORMATS = ("query", "json", "msgpack")  # 参数的编码方式，query为GET查询字符串，其余为POST请求体
+MSGPACK = "application/msgpack"
+
+
+class RouteStats(object):
+    """一个路由的统计信息。
+
+    :ivar latencies: 各个成功请求的延迟（秒）。
+    :ivar statuses: 从状态码映射到响应数量的字典。
+    :ivar errors: 连接失败或者超时的请求数量。
+    """
+
+    def __init__(self) -> None:
+        self.latencies: list[float] = []
+        self.statuses: dict[int, int] = dict()
+        self.errors = 0
+
+    @property
+    def count(self) -> int:
+        """请求总数。"""
+        return sum(self.statuses.values()) + self.errors
+
+    @property
+    def failures(self) -> int:
+        """失败的请求数量，包括连接失败、超时和5xx响应。"""
+        return self.errors + sum(count for status, count in self.statuses.items() if status >= 500)
+
+    def percentile(self, p: float) -> float:
+        """返回延迟的分位数（最近秩法）。
+
+        :param p: 百分位，取值范围为0到100。
+        :return: 分位数（秒），没有请求时返回0。
+        """
+        if len(self.latencies) == 0:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, max(0, int(len(ordered) * p / 100 + 0.5) - 1))]
+
+
+class Connection(object):
+    """一个HTTP/1.1长连接，只支持带有 ``Content-Length`` 的响应。
+
+    :ivar host: 服务器地址。
+    :ivar port: 服务器端口。
+    :ivar format: 参数的编码方式，取值见 :py:data:`FORMATS` 。
+    :ivar connects: 建立连接的次数。
+    """
+
+    def __init__(self, host: str, port: int, format: str = "query") -> None:
+        self.host = host
+        self.port = port
+        self.format = format
+        self.connects = 0
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    def _encode(self, path: str, params: dict) -> bytes:
+        """按照编码方式生成请求头和请求体。"""
+        head = f"Host: {self.host}:{self.port}\r\nConnection: keep-alive\r\n"
+        if self.format == "query":
+            target = path + ("?" + urlencode(params) if params else "")
+            return f"GET {target} HTTP/1.1\r\n{head}\r\n".encode("utf-8")
+        if self.format == "msgpack":
+            body, mimetype = msgpack.packb(params), MSGPACK
+            head += f"Accept: {MSGPACK}\r\n"
+        else:
+            body, mimetype = json.dumps(params, ensure_ascii=False).encode("utf-8"), "application/json"
+        return f"POST {path} HTTP/1.1\r\n{head}Content-Type: {mimetype}\r\n" \
+               f"Content-Length: {len(body)}\r\n\r\n".encode("utf-8") + body
+
+    async def request(self, path: str, params: dict) -> tuple[int, Optional[dict]]:
+        """发送一个请求。
+
+        :param path: 请求路径。
+        :param params: 请求参数。
+        :return: 状态码和响应的JSON对象。
+        """
+        for attempt in range(2):  # 复用的连接可能已经被服务端关闭，此时重新连接一次
+            reused = self._writer is not None
+            if not reused:
+                self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+                self.connects += 1
+            self._writer.write(self._encode(path, params))
+            try:
+                await self._writer.drain()
+                head = await self._reader.readuntil(b"\r\n\r\n")
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            lines = head.decode("latin-1").split("\r\n")
+            version, status = lines[0].split(" ")[:2]
+            headers = dict(line.split(":", 1) for line in lines[1:] if ":" in line)
+            headers = {key.strip().lower(): value.strip() for key, value in headers.items()}
+            if "content-length" in headers:
+                body = await self._reader.readexactly(int(headers["content-length"]))
+            else:
+                body = await self._reader.read()
+            if version == "HTTP/1.0" or headers.get("connection", "").lower() == "close" \
+                    or "content-length" not in headers:
+                self.close()
+            data = None
+            if int(status) == 200:
+                data = msgpack.unpackb(body) if headers.get("content-type", "").startswith(MSGPACK) else json.loads(body)
+            return int(status), data
+        raise ConnectionError
+
+    def close(self) -> None:
+        """关闭连接。"""
+        if self._writer is not None:
+            self._writer.close()
+        self._reader, self._writer = None, None
+
+
+class VirtualClient(object):
+    """虚拟客户端。
+
+    :ivar index: 客户端序号，用于生成注册的用户名。
+    :ivar options: 命令行参数。
+    :ivar stats: 从路由映射到统计信息的字典，所有客户端共用。
+    """
+
+    def __init__(self, index: int, options, stats: dict[str, RouteStats], mix: dict[str, float]) -> None:
+        self.index = index
+        self.options = options
+        self.stats = stats
+        self.connection = Connection(*_address(options.url), options.format)
+        self.token: Optional[str] = None
+        self.idle = 0
+        self._messages = list(mix.keys())
+        self._weights = list(mix.values())
+        self._random = random.Random(options.seed * 100003 + index)
+        self._lock = asyncio.Lock()
+
+    async def request(self, route: str, params: dict) -> tuple[int, Optional[dict]]:
+        """发送一个请求并且记录统计信息。
+
+        与客户端的工作线程一致，一个客户端的请求依次发送，令牌在发送时才加入参数，因此总是使用最新的令牌。
+
+        :param route: 请求路径，除了 ``/`` 以外都需要令牌。
+        :param params: 请求参数，不包括令牌。
+        :return: 状态码和响应的JSON对象，连接失败或者超时时状态码为-1，没有会话时状态码为0。
+        """
+        stats = self.stats.setdefault(route, RouteStats())
+        async with self._lock:
+            if route != "/":
+                if self.token is None:
+                    return 0, None
+                params = dict(params, token=self.token)
+            start = time.perf_counter()
+            try:
+                status, data = await asyncio.wait_for(self.connection.request(route, params), REQUEST_TIMEOUT)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+                self.connection.close()
+                stats.errors += 1
+                return -1, None
+        stats.latencies.append(time.perf_counter() - start)
+        stats.statuses[status] = stats.statuses.get(status, 0) + 1
+        return status, data
+
+    async def connect(self) -> None:
+        """建立会话，按照比例注册一个新用户。"""
+        self.token = None
+        status, data = await self.request("/", {})
+        if status != 200:
+            return
+        self.token = data["token"]
+        self.idle = 0
+        if self._random.random() < self.options.login:
+            name = f"load{self.index}_{self._random.getrandbits(32)}"
+            status, data = await self.request("/register", {"username": name, "passwd": name})
+            if status == 200 and data.get("token") is not None:
+                self.token = data["token"]
+
+    async def echo(self, deadline: float) -> None:
+        """每隔 ``--echo`` 秒发送一次echo，与 ``ClientModel.timeout_handler`` 一致。"""
+        while time.monotonic() + self.options.echo < deadline:
+            await asyncio.sleep(self.options.echo)
+            self.idle += self.options.echo
+            status, data = await self.request("/echo", {"seconds": int(self.idle)})
+            if status == 200 and data.get("reset"):
+                self.idle = 0
+            if status == 403 or (status == 200 and data.get("exit")):
+                self.token = None
+
+    async def run(self, deadline: float) -> None:
+        """运行虚拟客户端直到截止时刻。"""
+        await asyncio.sleep(self._random.uniform(0, self.options.ramp))
+        echo = asyncio.ensure_future(self.echo(deadline))
+        try:
+            while time.monotonic() < deadline:
+                if self.token is None:
+                    await self.connect()
+                    if self.token is None:  # 连接失败，稍后重试
+                        await asyncio.sleep(1)
+                        continue
+                await asyncio.sleep(self._random.expovariate(1 / self.options.think))
+                if time.monotonic() >= deadline:
+                    break
+                msg = self._random.choices(self._messages, self._weights)[0]
+                self.idle = 0
+                status, data = await self.request("/send", {"msg": msg})
+                if status == 403 or (status == 200 and data.get("exit")):
+                    self.token = None
+        finally:
+            echo.cancel()
+            self.connection.close()
+
+
+def _address(url: str) -> tuple[str, int]:
+    parts = urlsplit(url)
+    return parts.hostname, parts.port or 80
+
+
+def _wait_for_server(url: str, timeout: float) -> None:
+    """等待服务端开始监听。"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(_address(url), 0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise SystemExit(f"server at {url} is not reachable")
+
+
+def format_report(stats: dict[str, RouteStats], seconds: float, connects: int) -> str:
+    """生成各个路由的统计报告。
+
+    :param stats: 从路由映射到统计信息的字典。
+    :param seconds: 负载持续的时间（秒）。
+    :param connects: 建立TCP连接的总次数。
+    :return: 报告文本。
+    """
+    lines = [f"{'route':<12}{'requests':>10}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>10}"
+             f"  statuses"]
+    total = RouteStats()
+    for route, route_stats in sorted(stats.items()):
+        total.latencies += route_stats.latencies
+        total.errors += route_stats.errors
+        for status, count in route_stats.statuses.items():
+            total.statuses[status] = total.statuses.get(status, 0) + count
+    for route, route_stats in sorted(stats.items()) + [("total", total)]:
+        error_rate = route_stats.failures / route_stats.count if route_stats.count else 0.0
+        statuses = " ".join(f"{status}:{count}" for status, count in sorted(route_stats.statuses.items()))
+        lines.append(f"{route:<12}{route_stats.count:>10}{route_stats.count / seconds:>10.1f}"
+                     f"{route_stats.percentile(50) * 1e3:>10.2f}{route_stats.percentile(95) * 1e3:>10.2f}"
+                     f"{route_stats.percentile(99) * 1e3:>10.2f}{error_rate:>10.2%}  {statuses}")
+    lines.append(f"{connects} TCP connection(s) for {total.count} request(s)")
+    return "\n".join(lines)
+
+
+async def run(options, mix: dict[str, float]) -> tuple[dict[str, RouteStats], float, int]:
+    """运行所有虚拟客户端。
+
+    :return: 各个路由的统计信息、实际持续的时间（秒）和建立TCP连接的总次数。
+    """
+    stats: dict[str, RouteStats] = dict()
+    clients = [VirtualClient(index, options, stats, mix) for index in range(options.clients)]
+    start = time.monotonic()
+    await asyncio.gather(*[client.run(start + options.duration) for client in clients])
+    return stats, time.monotonic() - start, sum(client.connection.connects for client in clients)
+
+
+def main() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="按照客户端的协议产生负载，报告各个路由的延迟分位数、吞吐量和错误率。")
+    parser.add_argument("-u", "--url", default="http://127.0.0.1:5000", help="服务端地址")
+    parser.add_argument("-c", "--clients", type=int, default=200, help="虚拟客户端数量")
+    parser.add_argument("-d", "--duration", type=float, default=30, help="持续时间（秒）")
+    parser.add_argument("-t", "--think", type=float, default=2.0, help="两条消息之间的平均思考时间（秒），服从指数分布")
+    parser.add_argument("-e", "--echo", type=float, default=5.0, help="发送echo的间隔（秒）")
+    parser.add_argument("-l", "--login", type=float, default=0.5, help="注册并登录的客户端比例")
+    parser.add_argument("-r", "--ramp", type=float, default=5.0, help="各个客户端在这段时间（秒）内陆续启动")
+    parser.add_argument("-m", "--mix", help="消息比例文件，默认使用主目录下grammar.txt对应的消息")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="随机数种子")
+    parser.add_argument("-f", "--format", choices=FORMATS, default="msgpack" if msgpack is not None else "json",
+                        help="参数的编码方式，query为GET查询字符串，json和msgpack为POST请求体")
+    parser.add_argument("--launch", action="store_true", help="在子进程中启动服务端，结束后关闭")
+    options = parser.parse_args()
+
+    mix = DEFAULT_MIX
+    if options.mix:
+        with open(options.mix, "r", encoding="utf-8") as f:
+            mix = json.load(f)
+
+    server = None
+    if options.launch:
+        root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+        server = subprocess.Popen([sys.executable, os.path.join(root, "app.py")], cwd=root,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _wait_for_server(options.url, 30)
+        stats, seconds, connects = asyncio.run(run(options, mix))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    print(format_report(stats, seconds, connects))
+
+
+if __name__ == '__main__':
+    main()
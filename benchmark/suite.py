@@ -0,0 +1,305 @@
+"""基准测试套件。
+
+套件将各项基准测试的结果汇总为一个JSON文件，作为之后比较的基线。比较命令在某一项耗时的增长超过阈值时以状态码1退出，
+因此可以在每次修改之后检查性能是否退化。各项结果均为每次操作的耗时（纳秒），越小越好。
+
+基准测试分为以下几组，每组在单独的子进程中运行，避免数据库和用户变量等全局状态互相影响：
+
+* ``parse`` ：对生成的脚本调用 ``RobotLanguage.parse_files`` 。
+* ``build`` ：初始化数据库并且构建状态机。
+* ``transition`` ：命中各类条件的 ``condition_transform`` 以及 ``timeout_transform`` 。
+* ``condition`` 、 ``action`` ：各类条件和动作，参考 :py:mod:`benchmark.bench_micro` 。
+* ``matcher`` ：解释执行和生成代码两种匹配方式，参考 :py:mod:`benchmark.bench_matchers` 。
+* ``storage`` ：各个存储后端，参考 :py:mod:`benchmark.bench_storage` 。
+* ``jwt`` ：``UserManage.jwt_decode`` ，以及解码之后独占会话的 ``UserManage.session`` 。
+* ``http`` ：通过Flask测试客户端端到端地请求 ``/send`` 和 ``/echo`` 。
+
+运行方式::
+
+    python -m benchmark.suite run -o baseline.json
+    python -m benchmark.suite run -o current.json --compare baseline.json
+    python -m benchmark.suite compare baseline.json current.json -t 0.2
+
+Copyright (c) 2021 Ziheng Mao.
+"""
+
+import os
+import sys
+import json
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+import timeit
+from typing import Callable
+
+DEFAULT_THRESHOLD = 0.25  # 默认的退化阈值，耗时增长超过25%视为退化
+REPEAT = 5
+
+TRANSITION_SCRIPT = """
+State Welcome
+    Case Length > 100
+        Goto Welcome
+    Case Contain "余额"
+        Goto Welcome
+    Case Type Int
+        Goto Welcome
+    Case Type Real
+        Goto Welcome
+    Case "投诉"
+        Goto Welcome
+    Case In "退出", "再见"
+        Goto Welcome
+    Case Match /^订单\\d+$/
+        Goto Welcome
+    Case Similar "我要修改名字" 0.5
+        Goto Welcome
+    Default
+    Timeout 30
+        Speak "您已经很久没有操作了"
+"""
+
+TRANSITION_MESSAGES = {"Length": "x" * 150, "Contain": "查询余额", "Type Int": "123", "Type Real": "12.5",
+                       "Equal": "投诉", "In": "再见", "Match": "订单123", "Similar": "我想修改名字", "Default": "随便说说"}
+
+
+def measure(function: Callable[[], None], number: int) -> float:
+    """测量一个函数的耗时。
+
+    与 :py:func:`benchmark.bench_micro.measure` 不同，测量之前先预热一轮，并且取更多轮中的最小值，使得两次运行的结果可以比较。
+
+    :param function: 被测函数。
+    :param number: 每轮调用的次数。
+    :return: 每次调用的耗时（纳秒）。
+    """
+    timeit.timeit(function, number=number)
+    return min(timeit.repeat(function, number=number, repeat=REPEAT)) / number * 1e9
+
+
+def generate_script(states: int) -> str:
+    """生成一个有若干状态的脚本，每个状态包含各类条件、动作和超时转移。
+
+    :param states: 状态数量。
+    :return: 脚本文本。
+    """
+    def state_name(index: int) -> str:  # 状态名只能由字母组成
+        return "Welcome" if index == 0 else "State" + "".join(chr(ord("a") + int(digit)) for digit in str(index))
+
+    lines = ["Variable", "    $billing Real 0", "    $name Text \"用户\"", "    $count Int 0", ""]
+    for i in range(states):
+        name, target = state_name(i), state_name((i + 1) % states)
+        lines += [f"State {name}" + (" Verified" if i != 0 else ""),
+                  f"    Speak \"状态{i}，\" + $name",
+                  f"    Case Contain \"下一步{i}\"",
+                  f"        Goto {target}",
+                  f"    Case \"查询{i}\"",
+                  f"        Speak $name + \"的余额为\" + $billing",
+                  f"    Case Length > {i + 10}",
+                  f"        Speak \"输入过长\"",
+                  f"    Case Type Real",
+                  f"        Speak Copy",
+                  f"    Default",
+                  f"        Goto Welcome",
+                  f"    Timeout {i + 30}",
+                  f"        Exit",
+                  ""]
+    return "\n".join(lines)
+
+
+def _write(directory: str, text: str) -> str:
+    path = os.path.join(directory, "script.txt")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+    return path
+
+
+def bench_parse() -> dict[str, float]:
+    """测量语法分析的耗时。"""
+    from server.parser import RobotLanguage
+
+    result = dict()
+    with tempfile.TemporaryDirectory() as directory:
+        for states in [10, 100]:
+            path = _write(directory, generate_script(states))
+            result[f"{states} states"] = measure(lambda: RobotLanguage.parse_files([path]), 100 // states)
+    return result
+
+
+def bench_build() -> dict[str, float]:
+    """测量初始化数据库和构建状态机的耗时。"""
+    from server.state_machine import StateMachine, init_database
+
+    result = dict()
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, "bench.db")
+        for states in [10, 100]:
+            path = _write(directory, generate_script(states))
+
+            def build() -> None:
+                init_database(database)
+                StateMachine([path])
+
+            result[f"{states} states"] = measure(build, 100 // states)
+    return result
+
+
+def bench_transition() -> dict[str, float]:
+    """测量命中各类条件的条件转移和超时转移的耗时，不使用匹配结果缓存。"""
+    from server.state_machine import StateMachine, UserState, init_database
+
+    with tempfile.TemporaryDirectory() as directory:
+        init_database(os.path.join(directory, "bench.db"))
+        machine = StateMachine([_write(directory, TRANSITION_SCRIPT)])
+    user_state = UserState()
+    result = dict()
+    for kind, msg in TRANSITION_MESSAGES.items():
+        result[f"condition {kind}"] = measure(lambda: machine.condition_transform(user_state, msg), 20000)
+
+    def timeout() -> None:
+        user_state.last_time = 0
+        machine.timeout_transform(user_state, 60)
+
+    result["timeout"] = measure(timeout, 20000)
+    return result
+
+
+def bench_condition() -> dict[str, float]:
+    from benchmark.bench_micro import bench_conditions
+    return bench_conditions()
+
+
+def bench_action() -> dict[str, float]:
+    from benchmark.bench_micro import bench_actions
+    return bench_actions()
+
+
+def bench_matcher() -> dict[str, float]:
+    from benchmark.bench_matchers import bench_matchers
+    return bench_matchers()
+
+
+def bench_storage() -> dict[str, float]:
+    from benchmark.bench_storage import bench_backend, BACKENDS
+    return {f"{backend} {name}": value for backend in BACKENDS for name, value in bench_backend(backend).items()}
+
+
+def bench_jwt() -> dict[str, float]:
+    """测量令牌解码的耗时，以及解码并且独占会话的耗时。"""
+    from server.user_manage import UserManage
+
+    user_manage = UserManage("secret")
+    _, token = user_manage.connect()
+
+    def session() -> None:
+        with user_manage.session(token):
+            pass
+
+    return {"jwt_decode": measure(lambda: user_manage.jwt_decode(token), 20000), "session": measure(session, 20000)}
+
+
+def bench_http() -> dict[str, float]:
+    """通过Flask测试客户端测量请求的端到端耗时，包括路由、鉴权、状态转移和JSON编码。"""
+    from app import app
+
+    client = app.test_client()
+    token = client.get("/").get_json()["token"]
+    return {"GET /send": measure(lambda: client.get("/send", query_string={"msg": "你好", "token": token}), 1000),
+            "GET /echo": measure(lambda: client.get("/echo", query_string={"seconds": 1, "token": token}), 1000),
+            "POST /send": measure(lambda: client.post("/send", json={"msg": "你好", "token": token}), 1000)}
+
+
+GROUPS: dict[str, Callable[[], dict[str, float]]] = {
+    "parse": bench_parse, "build": bench_build, "transition": bench_transition, "condition": bench_condition,
+    "action": bench_action, "matcher": bench_matcher, "storage": bench_storage, "jwt": bench_jwt, "http": bench_http}
+
+
+def run(groups: list[str]) -> dict[str, float]:
+    """在各自的子进程中运行若干组基准测试。
+
+    :param groups: 组名列表。
+    :return: 从 ``组名/项目名`` 映射到耗时（纳秒）的字典。
+    """
+    root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    metrics = dict()
+    for group in groups:
+        process = subprocess.run([sys.executable, "-m", "benchmark.suite", "group", group], cwd=root,
+                                 stdout=subprocess.PIPE, check=True, encoding="utf-8")
+        result = json.loads(process.stdout.strip().splitlines()[-1])  # 最后一行是结果，之前可能有其他输出
+        for name, value in result.items():
+            metrics[f"{group}/{name}"] = value
+        print(f"{group}: {len(result)} metric(s)", file=sys.stderr)
+    return metrics
+
+
+def compare(baseline: dict[str, float], current: dict[str, float], threshold: float) -> tuple[str, list[str]]:
+    """比较两次运行的结果。
+
+    :param baseline: 基线结果。
+    :param current: 本次结果。
+    :param threshold: 退化阈值，耗时与基线之比超过 ``1 + threshold`` 时视为退化。
+    :return: 报告文本和退化的项目列表。只在一边出现的项目会列出，但是不视为退化。
+    """
+    lines = [f"{'metric':<60}{'baseline':>14}{'current':>14}{'ratio':>8}"]
+    regressions = []
+    for name in sorted(set(baseline) | set(current)):
+        if name not in baseline or name not in current:
+            value = f"{current[name]:>12.0f}ns" if name in current else f"{'-':>14}"
+            base = f"{baseline[name]:>12.0f}ns" if name in baseline else f"{'-':>14}"
+            lines.append(f"{name:<60}{base}{value}{'new' if name in current else 'removed':>8}")
+            continue
+        ratio = current[name] / baseline[name] if baseline[name] > 0 else 1.0
+        mark = ""
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            mark = "  REGRESSION"
+        lines.append(f"{name:<60}{baseline[name]:>12.0f}ns{current[name]:>12.0f}ns{ratio:>7.2f}x{mark}")
+    lines.append(f"{len(regressions)} regression(s) beyond {threshold:.0%}")
+    return "\n".join(lines), regressions
+
+
+def _load(path: str) -> dict[str, float]:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)["metrics"]
+
+
+def main() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="运行基准测试套件，或者与基线比较。")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="运行基准测试并且保存结果")
+    run_parser.add_argument("-o", "--output", default="benchmark.json", help="结果文件")
+    run_parser.add_argument("-g", "--group", action="append", choices=list(GROUPS), help="只运行指定的组，可以重复")
+    run_parser.add_argument("-c", "--compare", help="运行之后与此基线比较")
+    run_parser.add_argument("-t", "--threshold", type=float, default=DEFAULT_THRESHOLD, help="退化阈值，默认为0.25")
+    compare_parser = commands.add_parser("compare", help="比较两个结果文件")
+    compare_parser.add_argument("baseline", help="基线结果文件")
+    compare_parser.add_argument("current", help="本次结果文件")
+    compare_parser.add_argument("-t", "--threshold", type=float, default=DEFAULT_THRESHOLD, help="退化阈值，默认为0.25")
+    group_parser = commands.add_parser("group", help="在当前进程中运行一组基准测试，以JSON输出结果")
+    group_parser.add_argument("name", choices=list(GROUPS))
+    args = parser.parse_args()
+
+    if args.command == "group":
+        print(json.dumps(GROUPS[args.name]()))
+        return
+    if args.command == "run":
+        groups = args.group or list(GROUPS)
+        metrics = run(groups)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"created": datetime.now().isoformat(timespec="seconds"), "python": platform.python_version(),
+                       "machine": platform.machine(), "unit": "ns", "metrics": metrics}, f, ensure_ascii=False,
+                      indent=2)
+        if args.compare is None:
+            return
+        baseline = {name: value for name, value in _load(args.compare).items() if name.split("/")[0] in groups}
+        report, regressions = compare(baseline, metrics, args.threshold)
+    else:
+        report, regressions = compare(_load(args.baseline), _load(args.current), args.threshold)
+    print(report)
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,216 +4,276 @@ Copyright (c) 2021 Ziheng Mao.
 """
 
 import sys
-from threading import Timer, Lock
-import json.decoder
+from typing import Optional
 import requests
-from PyQt5.QtCore import QObject, pyqtProperty, pyqtSlot, pyqtSignal
+from PyQt5.QtCore import QObject, QThread, QTimer, QAbstractListModel, QModelIndex, QByteArray, Qt, pyqtProperty, \
+    pyqtSlot, pyqtSignal
 from PyQt5.QtGui import QGuiApplication
-from PyQt5.QtQml import QQmlApplicationEngine, QQmlListProperty
+from PyQt5.QtQml import QQmlApplicationEngine
+
+try:
+    import msgpack  # 可选依赖，没有安装时以JSON编码请求
+except ImportError:
+    msgpack = None
 
 server_address = "http://127.0.0.1:5000"
+ECHO_INTERVAL = 5  # 发送echo的间隔（秒）
+REQUEST_TIMEOUT = 10  # 请求的超时时间（秒），超时按照连接失败处理
+HISTORY_LIMIT = 1000  # 界面中保留的消息数量上限，为0时不限制
+MSGPACK = "application/msgpack"
+
+
+class MessageListModel(QAbstractListModel):
+    """消息列表模型。
+
+    每条消息只保存内容和发送方，不为每条消息创建QObject。添加消息时只通知插入的行，界面只需要生成新消息的委托。
+    消息数量超过上限时，最早的消息被移出列表。
+
+    :ivar limit: 保留的消息数量上限，为0时不限制。
+    """
+    MsgRole = Qt.UserRole + 1  # 消息内容
+    AuthorRole = Qt.UserRole + 2  # 消息发送方，0表示客服，1表示用户
+
+    def __init__(self, limit: int = 0, parent=None) -> None:
+        super().__init__(parent)
+        self.limit = limit
+        self._messages: list[tuple[str, int]] = []
+
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self._messages)
+
+    def data(self, index: QModelIndex, role: int = Qt.DisplayRole):
+        if not index.isValid() or not 0 <= index.row() < len(self._messages):
+            return None
+        msg, author = self._messages[index.row()]
+        if role == self.MsgRole or role == Qt.DisplayRole:
+            return msg
+        if role == self.AuthorRole:
+            return author
+        return None
+
+    def roleNames(self) -> dict[int, QByteArray]:
+        return {self.MsgRole: QByteArray(b"msg"), self.AuthorRole: QByteArray(b"author")}
+
+    def append(self, msg: str, author: int) -> None:
+        """在列表末尾添加一条消息。
+
+        :param msg: 消息内容。
+        :param author: 消息发送方，0表示客服，1表示用户。
+        """
+        row = len(self._messages)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self._messages.append((msg, author))
+        self.endInsertRows()
+        if self.limit > 0 and len(self._messages) > self.limit:
+            overflow = len(self._messages) - self.limit
+            self.beginRemoveRows(QModelIndex(), 0, overflow - 1)
+            del self._messages[:overflow]
+            self.endRemoveRows()
+
 
+class NetworkWorker(QObject):
+    """网络请求工作对象，运行在单独的线程中，界面线程不会等待网络请求。
 
-class Message(QObject):
-    """消息类。
+    所有请求共用一个 ``requests.Session`` ，连接在请求之间保持，不需要每次重新握手。
+    请求按照发出的顺序依次处理，令牌也由工作对象保存：建立会话、登录和注册成功后立即换用新的令牌，
+    因此在登录请求之后发出的消息一定使用新的令牌。
 
-    :ivar msg: 消息内容。
-    :ivar author: 消息发送方，0表示客服，1表示用户。
+    请求以POST发送，参数在请求体中，不会出现在URL和访问日志里。安装了 ``msgpack`` 时请求和响应都以MessagePack编码，否则以JSON编码。
+
+    :ivar session: HTTP会话。
+    :ivar token: 令牌，没有会话时为None。
     """
-    def __init__(self, msg: str, author: int, parent=None) -> None:
+    finished = pyqtSignal(str, int, object)  # 请求类型、状态码和响应的JSON对象，状态码为-1表示连接失败，为0表示没有会话
+
+    def __init__(self, parent=None) -> None:
         super().__init__(parent)
-        self._msg = msg
-        self._author = author
+        self.session = requests.Session()
+        self.token: Optional[str] = None
+
+    @pyqtSlot(str, str, object)
+    def request(self, kind: str, path: str, params: dict) -> None:
+        """发送一个请求，结果通过 ``finished`` 信号返回给界面线程。
 
-    @pyqtProperty('QString', constant=True)
-    def msg(self) -> str:
-        return self._msg
+        :param kind: 请求类型，原样返回。
+        :param path: 请求路径，除了 ``/`` 以外都需要令牌。
+        :param params: 请求参数，不包括令牌。
+        """
+        if path != "/":
+            if self.token is None:
+                self.finished.emit(kind, 0, None)
+                return
+            params = dict(params, token=self.token)
+        try:
+            if msgpack is not None:
+                r = self.session.post(server_address + path, data=msgpack.packb(params), timeout=REQUEST_TIMEOUT,
+                                      headers={"Content-Type": MSGPACK, "Accept": MSGPACK})
+            else:
+                r = self.session.post(server_address + path, json=params, timeout=REQUEST_TIMEOUT)
+        except requests.exceptions.RequestException:
+            self.finished.emit(kind, -1, None)
+            return
+        try:
+            data = None
+            if r.status_code == 200:
+                data = msgpack.unpackb(r.content) if r.headers.get("Content-Type", "").startswith(MSGPACK) else r.json()
+        except ValueError:  # JSON和MessagePack的格式错误都是ValueError的子类
+            self.finished.emit(kind, r.status_code, None)
+            return
+        if isinstance(data, dict):
+            if data.get("token") is not None:
+                self.token = data["token"]
+            if data.get("exit"):
+                self.token = None
+        self.finished.emit(kind, r.status_code, data)
 
-    @pyqtProperty(int, constant=True)
-    def author(self) -> int:
-        return self._author
+    @pyqtSlot()
+    def close(self) -> None:
+        """关闭HTTP会话。"""
+        self.session.close()
 
 
 # noinspection PyUnresolvedReferences
 class ClientModel(QObject):
     """客户端模型。与QML交互。
 
-    :ivar message_list: 消息列表。
-    :ivar lock: 互斥锁。
-    :ivar token: 令牌。
+    网络请求通过 ``_request`` 信号交给工作线程中的 :py:class:`NetworkWorker` ，响应在 ``_on_finished`` 中处理，
+    界面线程只处理信号，不会被网络请求阻塞。
+
+    :ivar message_list: 消息列表模型。
+    :ivar connected: 是否已经建立会话。
     :ivar have_login: 是否已经登录。
-    :ivar timer: 超时计时器，监测用户闲置时间。
+    :ivar timer: 计时器，每隔5秒向服务器发送echo，报告用户闲置时间。
     :ivar time_count: 用户闲置时间计数器。
     """
+    _request = pyqtSignal(str, str, object)
+
     def __init__(self, parent=None) -> None:
         super().__init__(parent)
-        self._message_list = []
-        self._lock = Lock()
-
-        self._token: Optional[str] = None
+        self._message_list = MessageListModel(HISTORY_LIMIT, self)
+        self._connected = False
         self._have_login = False
-        self._timer: Optional[Timer] = None
-        self._time_count: Optional[int] = None
+        self._time_count = 0
+        self._timer = QTimer(self)
+        self._timer.setInterval(ECHO_INTERVAL * 1000)
+        self._timer.timeout.connect(self.timeout_handler)
+
+        self._thread = QThread(self)
+        self._worker = NetworkWorker()
+        self._worker.moveToThread(self._thread)
+        self._request.connect(self._worker.request)
+        self._worker.finished.connect(self._on_finished)
+        self._thread.finished.connect(self._worker.close)
+        self._thread.start()
         self.connect()
 
-    def __del__(self) -> None:
-        if self._timer is not None:
-            self._timer.cancel()
+    def shutdown(self) -> None:
+        """停止计时器和工作线程，退出前调用。"""
+        self._timer.stop()
+        self._thread.quit()
+        self._thread.wait()
 
-    message_list_changed = pyqtSignal()
     have_login_changed = pyqtSignal()
 
-    @pyqtProperty(QQmlListProperty, notify=message_list_changed)
-    def message_list(self) -> QQmlListProperty:
-        return QQmlListProperty(Message, self, self._message_list)
+    @pyqtProperty(QObject, constant=True)
+    def message_list(self) -> MessageListModel:
+        return self._message_list
 
     @pyqtProperty(bool, notify=have_login_changed)
     def have_login(self) -> bool:
         return self._have_login
 
-    def append_message(self, msg: Message) -> None:
-        self._message_list.append(msg)
-        self.message_list_changed.emit()
+    def append_message(self, msg: str, author: int) -> None:
+        self._message_list.append(msg, author)
 
     @pyqtSlot('QString')
     def submit_message(self, msg: str) -> None:
-        if self._token is None:
-            self.connect()
-            if self._token is None:
-                return
-
-        if len(msg.strip()) == 0: # 消息为空
+        if len(msg.strip()) == 0:  # 消息为空
             return
-        self.append_message(Message(msg, 1))
-
-        with self._lock: # 重设计时器
-            self._time_count = 0
-        self._timer.cancel()
-        self._timer = Timer(5, self.timeout_handler)
+        if not self._connected:
+            self.connect()
+        self.append_message(msg, 1)
+        self._time_count = 0  # 重设计时器
         self._timer.start()
-
-        try:
-            r = requests.get(server_address + '/send', params={"token": self._token, "msg": msg})
-            if r.status_code == 401:
-                self.append_message(Message("需要登录，请点击右上角登录", 0))
-                return
-            elif r.status_code == 403:
-                self.append_message(Message("服务器拒绝请求，请重启客户端", 0))
-                self._timer.cancel()
-                return
-            elif r.status_code != 200:
-                raise requests.exceptions.ConnectionError()
-            for msg in r.json().get("msg"):
-                self.append_message(Message(msg, 0))
-            if r.json().get("exit"):
-                self.append_message(Message("会话结束，您可以发送一条消息开始新的会话", 0))
-                self._token = None
-                self._have_login = False
-                self._timer.cancel()
-        except requests.exceptions.ConnectionError:
-            self.append_message(Message("服务器异常，请稍后重试", 0))
-        except (KeyError, json.decoder.JSONDecodeError):
-            self.append_message(Message("服务器消息异常，请稍后重试", 0))
+        self._request.emit("send", "/send", {"msg": msg})
 
     @pyqtSlot('QString', 'QString')
     def user_login(self, username: str, passwd: str) -> None:
-        if self._token is None:
+        if not self._connected:
             self.connect()
-            if self._token is None:
-                self.append_message(Message("服务器异常，请稍后重试", 0))
-                return
-        try:
-            r = requests.get(server_address + '/login',
-                             params={"token": self._token, "username": username, "passwd": passwd})
-            if r.status_code == 403:
-                self.append_message(Message("服务器拒绝请求，请重启客户端", 0))
-                self._timer.cancel()
-                return
-            elif r.status_code != 200:
-                raise requests.exceptions.ConnectionError()
-            if r.json().get("token") is None:
-                self.append_message(Message("登录失败，用户名或密码无效", 0))
-                return
-            self._token = r.json().get("token")
-            self.append_message(Message("登录成功", 0))
-        except requests.exceptions.ConnectionError:
-            self.append_message(Message("服务器异常，请稍后重试", 0))
-        except (KeyError, json.decoder.JSONDecodeError):
-            self.append_message(Message("服务器消息异常，请稍后重试", 0))
+        self._request.emit("login", "/login", {"username": username, "passwd": passwd})
 
     @pyqtSlot('QString', 'QString')
     def user_register(self, username: str, passwd: str) -> None:
-        if self._token is None:
+        if not self._connected:
             self.connect()
-            if self._token is None:
-                self.append_message(Message("服务器异常，请稍后重试", 0))
-                return
-        try:
-            r = requests.get(server_address + '/register',
-                             params={"token": self._token, "username": username, "passwd": passwd})
-            if r.status_code == 403:
-                self.append_message(Message("服务器拒绝请求，请重启客户端", 0))
-                self._timer.cancel()
-                return
-            elif r.status_code != 200:
-                raise requests.exceptions.ConnectionError()
-            if r.json().get("token") is None:
-                self.append_message(Message("注册失败，用户名冲突", 0))
-                return
-            self._token = r.json().get("token")
-            self.append_message(Message("注册并登录成功", 0))
-        except requests.exceptions.ConnectionError:
-            self.append_message(Message("服务器异常，请稍后重试", 0))
-        except (KeyError, json.decoder.JSONDecodeError):
-            self.append_message(Message("服务器消息异常，请稍后重试", 0))
+        self._request.emit("register", "/register", {"username": username, "passwd": passwd})
 
     def connect(self) -> None:
-        try:
-            r = requests.get(server_address)
-            if r.status_code != 200:
-                raise requests.exceptions.ConnectionError()
-            self._token = r.json().get("token")
-            for msg in r.json().get("msg"):
-                self.append_message(Message(msg, 0))
-            self._time_count = 0
-            self._timer = Timer(5, self.timeout_handler)
-            self._timer.start()
-        except requests.exceptions.ConnectionError:
-            self.append_message(Message("服务器异常，请稍后重试", 0))
-        except KeyError:
-            self.append_message(Message("服务器消息异常，请稍后重试", 0))
+        self._connected = True  # 之后的请求排在建立会话的请求之后，会使用新的令牌
+        self._request.emit("connect", "/", {})
 
     def timeout_handler(self) -> None:
-        with self._lock:
-            self._time_count += 5
-        self._timer = Timer(5, self.timeout_handler)
-        self._timer.start()
+        self._time_count += ECHO_INTERVAL
+        self._request.emit("echo", "/echo", {"seconds": self._time_count})
+
+    def end_session(self) -> None:
+        """会话结束或者被服务器拒绝，停止发送echo。"""
+        self._connected = False
+        self._have_login = False
+        self._timer.stop()
+
+    @pyqtSlot(str, int, object)
+    def _on_finished(self, kind: str, status: int, data: Optional[dict]) -> None:
+        """处理工作线程返回的响应。
 
+        :param kind: 请求类型。
+        :param status: 状态码，-1表示连接失败，0表示没有会话。
+        :param data: 响应的JSON对象。
+        """
+        if status == 0:  # 建立会话失败，之后的请求没有令牌
+            if kind in ("login", "register"):
+                self.append_message("服务器异常，请稍后重试", 0)
+            return
+        if status == 429:  # 请求被服务器限流
+            if kind == "connect":
+                self._connected = False
+            if kind != "echo":  # echo被拒绝时不打扰用户，等待下一次echo
+                self.append_message("请求过于频繁，请稍后重试", 0)
+            return
+        if status == -1 or (status != 200 and status not in (401, 403)):
+            if kind == "connect":
+                self._connected = False
+            self.append_message("服务器异常，请稍后重试", 0)
+            return
+        if status == 401:
+            self.append_message("需要登录，请点击右上角登录", 0)
+            return
+        if status == 403:
+            self.append_message("服务器拒绝请求，请重启客户端", 0)
+            self.end_session()
+            return
         try:
-            r = requests.get(server_address + '/echo', params={"token": self._token, "seconds": self._time_count})
-            if r.status_code == 401:
-                self.append_message(Message("需要登录，请点击右上角登录", 0))
-                return
-            elif r.status_code == 403:
-                self.append_message(Message("服务器拒绝请求，请重启客户端", 0))
-                self._timer.cancel()
-                return
-            elif r.status_code != 200:
-                raise requests.exceptions.ConnectionError()
-            if r.json().get("reset"):
-                with self._lock:
+            if kind == "connect":
+                for msg in data["msg"]:
+                    self.append_message(msg, 0)
+                self._time_count = 0
+                self._timer.start()
+            elif kind in ("login", "register"):
+                if data["token"] is None:
+                    self.append_message("登录失败，用户名或密码无效" if kind == "login" else "注册失败，用户名冲突", 0)
+                else:
+                    self.append_message("登录成功" if kind == "login" else "注册并登录成功", 0)
+            else:  # send或者echo
+                if kind == "echo" and data.get("reset"):
                     self._time_count = 0
-            for msg in r.json().get("msg"):
-                self.append_message(Message(msg, 0))
-            if r.json().get("exit"):
-                self.append_message(Message("会话结束，您可以发送一条消息开始新的会话", 0))
-                self._token = None
-                self._have_login = False
-                self._timer.cancel()
-        except requests.exceptions.ConnectionError:
-            self.append_message(Message("服务器异常，请稍后重试", 0))
-        except (KeyError, json.decoder.JSONDecodeError):
-            self.append_message(Message("服务器消息异常，请稍后重试", 0))
+                for msg in data["msg"]:
+                    self.append_message(msg, 0)
+                if data.get("exit"):
+                    self.append_message("会话结束，您可以发送一条消息开始新的会话", 0)
+                    self.end_session()
+        except (KeyError, TypeError):
+            self.append_message("服务器消息异常，请稍后重试", 0)
 
 
 if __name__ == '__main__':
@@ -227,4 +287,4 @@ if __name__ == '__main__':
     # user_button.setProperty("visible", False)
 
     app.exec()
-    client_model.__del__()
+    client_model.shutdown()
@@ -61,13 +61,13 @@ ApplicationWindow {
 
                     Image {
                         id: avatar
-                        source: modelData.author ? "./static/client.png" : "./static/support.png"
+                        source: model.author ? "./static/client.png" : "./static/support.png"
                         width: 30
                         fillMode: Image.PreserveAspectFit
-                        anchors.right: modelData.author ? parent.right : undefined
-                        anchors.rightMargin: modelData.author ? 10 : undefined
-                        anchors.left: modelData.author ? undefined : parent.left
-                        anchors.leftMargin: modelData.author ? undefined : 10
+                        anchors.right: model.author ? parent.right : undefined
+                        anchors.rightMargin: model.author ? 10 : undefined
+                        anchors.left: model.author ? undefined : parent.left
+                        anchors.leftMargin: model.author ? undefined : 10
                     }
 
                     Rectangle {
@@ -78,10 +78,10 @@ ApplicationWindow {
                         radius: 10
                         border.color: "black"
                         border.width: 1
-                        anchors.right: modelData.author ? avatar.left : undefined
-                        anchors.rightMargin: modelData.author ? 10 : undefined
-                        anchors.left: modelData.author ? undefined : avatar.right
-                        anchors.leftMargin: modelData.author ? undefined : 10
+                        anchors.right: model.author ? avatar.left : undefined
+                        anchors.rightMargin: model.author ? 10 : undefined
+                        anchors.left: model.author ? undefined : avatar.right
+                        anchors.leftMargin: model.author ? undefined : 10
 
                         Text {
                             id: message
@@ -89,7 +89,7 @@ ApplicationWindow {
                             anchors.leftMargin: 10
                             anchors.verticalCenter: parent.verticalCenter
                             width: 230
-                            text: modelData.msg
+                            text: model.msg
                             wrapMode: Text.Wrap
                         }
                     }
@@ -0,0 +1,274 @@
+"""预分叉（prefork）启动器。
+
+主进程导入 :py:mod:`app` ，只解析一次脚本并且构建状态机，之后调用 ``gc.freeze`` 将这些对象移出垃圾回收的跟踪范围，
+再分叉出若干工作进程。工作进程以写时复制的方式共用状态机，垃圾回收不会修改这些对象的头部，因此对应的内存页不会被复制。
+各个工作进程在同一个监听套接字上接受连接，会话保存在 :py:class:`server.user_manage.SharedUserManage` 的会话文件中，
+同一个客户端的请求可以由任意一个工作进程处理。
+
+内存数据库后端（ ``memory`` ）的数据只存在于一个进程中，不能用于预分叉模式。工作进程意外退出时，主进程分叉出新的工作进程。
+
+运行方式::
+
+    python prefork.py -w 4 -p 5000
+    python prefork.py --report -w 4
+
+``--report`` 分别以预分叉和独立启动两种方式启动工作进程，发送一些请求之后，输出每个进程的启动耗时和内存占用。
+内存占用读取自 ``/proc/<pid>/smaps_rollup`` ，只支持Linux。
+
+Copyright (c) 2021 Ziheng Mao.
+"""
+
+import os
+import gc
+import sys
+import json
+import time
+import signal
+import socket
+import subprocess
+from http.client import HTTPConnection
+from types import ModuleType
+from urllib.parse import urlencode
+
+current_path = os.path.split(os.path.realpath(__file__))[0]
+
+
+def memory(pid: int) -> dict[str, int]:
+    """读取一个进程的内存占用。
+
+    :param pid: 进程号。
+    :return: 包括 ``rss`` 、 ``pss`` （按共享进程数均摊的占用）和 ``uss`` （独占的占用）的字典，单位为KiB。
+    """
+    fields = dict()
+    with open(f"/proc/{pid}/smaps_rollup", "r") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1])
+    return {"rss": fields["Rss"], "pss": fields["Pss"], "uss": fields["Private_Clean"] + fields["Private_Dirty"]}
+
+
+def prepare(store: str) -> ModuleType:
+    """在主进程中导入 :py:mod:`app` ，将会话移入会话文件，并且冻结此时的所有对象。
+
+    配置了 ``session_snapshot`` 时，主进程停止 ``create_app`` 启动的定期保存，改为从会话文件保存快照，
+    快照中包括各个工作进程的会话。
+
+    :param store: 会话文件路径。
+    :return: ``app`` 模块。
+    """
+    import app as application
+    from server.storage import MemorySQLiteStorage
+    from server.state_machine import get_storage
+    from server.user_manage import SharedUserManage
+
+    state = application.app.extensions["robot"]  # 按照config.json创建默认的应用
+    storage = get_storage()
+    if isinstance(storage, MemorySQLiteStorage):
+        raise SystemExit("The memory storage backend cannot be shared by worker processes")
+    local = state.user_manage
+    shared = SharedUserManage(local.key, store)
+    shared.create_table()
+    for user in local.users.values():  # 从会话快照中恢复的会话
+        shared.add(user)
+    local.stop_autosave()  # 会话已经移入会话文件，本进程的会话不再变化
+    state.user_manage = shared  # 退出时 AppState.shutdown 从会话文件保存快照
+    storage.close()  # 工作进程不能继承主进程的连接
+    shared.close()
+    gc.collect()
+    gc.freeze()
+    if state.snapshot_path is not None and state.config.get("session_snapshot_interval", 0) > 0:
+        shared.autosave(state.snapshot_path, state.state_machine.states, state.config["session_snapshot_interval"])
+    return application
+
+
+def serve(application: ModuleType, listener: socket.socket, ready: int) -> None:
+    """工作进程的入口，在监听套接字上处理请求，不会返回。
+
+    :param application: ``app`` 模块。
+    :param listener: 主进程创建的监听套接字。
+    :param ready: 管道的写端，开始处理请求之前写入一个字节，通知主进程启动完成。
+    """
+    from werkzeug.serving import make_server
+
+    def stop(signum: int, frame) -> None:
+        raise SystemExit
+
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, stop)
+    host, port = listener.getsockname()[:2]
+    server = make_server(host, port, application.app, threaded=True, fd=listener.fileno())
+    os.write(ready, b"\0")
+    os.close(ready)
+    try:
+        server.serve_forever()
+    finally:
+        transcript = application.app.extensions["robot"].transcript
+        if transcript is not None:  # 写入队列中剩余的对话记录
+            transcript.shutdown()
+        os._exit(0)  # 不执行主进程注册的退出处理函数
+
+
+def fork(application: ModuleType, listener: socket.socket) -> tuple[int, float]:
+    """分叉出一个工作进程，等待它启动完成。
+
+    :param application: ``app`` 模块。
+    :param listener: 监听套接字。
+    :return: 工作进程的进程号和启动耗时（秒）。
+    """
+    read, write = os.pipe()
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        serve(application, listener, write)
+    os.close(write)
+    os.read(read, 1)
+    os.close(read)
+    return pid, time.perf_counter() - start
+
+
+def listen(host: str, port: int) -> socket.socket:
+    """创建所有工作进程共用的监听套接字。"""
+    listener = socket.create_server((host, port), backlog=128)
+    listener.set_inheritable(True)
+    return listener
+
+
+def run(host: str, port: int, workers: int, store: str) -> None:
+    """以预分叉模式运行服务端，直到收到 ``SIGINT`` 或者 ``SIGTERM`` 。
+
+    :param host: 监听地址。
+    :param port: 监听端口。
+    :param workers: 工作进程数量。
+    :param store: 会话文件路径。
+    """
+    application = prepare(store)
+    listener = listen(host, port)
+
+    def stop(signum: int, frame) -> None:
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    pids = set()
+    try:
+        for _ in range(workers):
+            pid, seconds = fork(application, listener)
+            pids.add(pid)
+            print(f"Worker {pid} started in {seconds * 1000:.1f}ms")
+        print(f"Serving on http://{host}:{listener.getsockname()[1]} with {workers} worker(s)")
+        while True:
+            pid, status = os.wait()
+            if pid in pids:  # 工作进程意外退出，分叉出新的工作进程
+                pids.remove(pid)
+                print(f"Worker {pid} exited with status {status}, restarting")
+                pid, _ = fork(application, listener)
+                pids.add(pid)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+        listener.close()
+
+
+def single() -> None:
+    """独立启动一个工作进程，启动完成后向标准输出写入一行，作为 ``--report`` 的对照。"""
+    import logging
+    from werkzeug.serving import make_server
+    from app import app
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    print(server.port, flush=True)
+    server.serve_forever()
+
+
+def warm_up(port: int, requests: int) -> None:
+    """向一个端口发送若干组连接和消息请求，使工作进程访问状态机和存储后端。"""
+    for _ in range(requests):
+        connection = HTTPConnection("127.0.0.1", port, timeout=10)
+        connection.request("GET", "/")
+        token = json.loads(connection.getresponse().read())["token"]
+        connection.close()
+        connection = HTTPConnection("127.0.0.1", port, timeout=10)
+        connection.request("GET", "/send?" + urlencode({"msg": "你好", "token": token}))
+        connection.getresponse().read()
+        connection.close()
+
+
+def report(workers: int, store: str, requests: int) -> None:
+    """比较预分叉和独立启动的工作进程的启动耗时和内存占用，输出报告。
+
+    独立启动的工作进程依次启动，避免同时重建数据库。
+
+    :param workers: 工作进程数量。
+    :param store: 会话文件路径。
+    :param requests: 每个工作进程的预热请求数量。
+    """
+    import logging
+
+    rows = []
+    start = time.perf_counter()
+    application = prepare(store)
+    master_seconds = time.perf_counter() - start
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    listener = listen("127.0.0.1", 0)
+    forked = [fork(application, listener) for _ in range(workers)]
+    warm_up(listener.getsockname()[1], requests * workers)
+    rows.append(("prefork", "master", master_seconds, memory(os.getpid())))
+    rows += [("prefork", str(pid), seconds, memory(pid)) for pid, seconds in forked]
+    for pid, _ in forked:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+    listener.close()
+
+    processes = []
+    try:
+        for _ in range(workers):
+            start = time.perf_counter()
+            process = subprocess.Popen([sys.executable, os.path.realpath(__file__), "--single"], cwd=current_path,
+                                       stdout=subprocess.PIPE, encoding="utf-8")
+            port = int(process.stdout.readline())
+            processes.append((process, port, time.perf_counter() - start))
+        for process, port, _ in processes:
+            warm_up(port, requests)
+        rows += [("independent", str(process.pid), seconds, memory(process.pid)) for process, _, seconds in processes]
+    finally:
+        for process, _, _ in processes:
+            process.terminate()
+            process.wait()
+
+    print(f"{'mode':<14}{'process':>10}{'startup':>12}{'RSS':>12}{'PSS':>12}{'USS':>12}")
+    for mode, name, seconds, usage in rows:
+        print(f"{mode:<14}{name:>10}{seconds * 1000:>10.1f}ms" +
+              "".join(f"{usage[field] / 1024:>9.1f}MiB" for field in ("rss", "pss", "uss")))
+    for mode in ("prefork", "independent"):
+        selected = [row for row in rows if row[0] == mode]
+        print(f"{mode}: total PSS {sum(row[3]['pss'] for row in selected) / 1024:.1f}MiB, "
+              f"total startup {sum(row[2] for row in selected) * 1000:.1f}ms")
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="以预分叉模式运行服务端，或者比较预分叉和独立启动的工作进程。")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址，默认为127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=5000, help="监听端口，默认为5000")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1, help="工作进程数量，默认为CPU核数")
+    parser.add_argument("-s", "--store", default="sessions.db", help="会话文件路径，相对于本文件所在的目录")
+    parser.add_argument("--report", action="store_true", help="比较预分叉和独立启动的工作进程，输出报告")
+    parser.add_argument("-n", "--requests", type=int, default=20, help="报告中每个工作进程的预热请求数量")
+    parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        single()
+    elif args.report:
+        report(args.workers, os.path.join(current_path, args.store), args.requests)
+    else:
+        run(args.host, args.port, args.workers, os.path.join(current_path, args.store))
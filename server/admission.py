@@ -0,0 +1,114 @@
+"""准入控制模块。
+
+每个请求都需要解码JWT、执行状态转移并且访问数据库，一个异常的客户端频繁发送 ``/send`` 或者 ``/echo`` 就会拖慢所有用户。
+此模块提供两种限制，均在令牌解码之前进行，被拒绝的请求不会访问状态机和数据库：
+
+* :py:class:`RateLimiter` 为每个令牌维护一个令牌桶，令牌以固定的速率补充，桶中没有令牌时拒绝请求。
+* :py:class:`ConcurrencyLimiter` 限制同时处理的请求数量，超出时请求排队等待，队列已满或者等待超时则立即拒绝。
+
+被拒绝的请求返回429和 ``Retry-After`` 响应头，请求不会在服务端无限堆积，过载时其他用户的延迟不会随之增长。
+
+Copyright (c) 2021 Ziheng Mao.
+"""
+
+import math
+from threading import Lock, Semaphore
+from time import monotonic, perf_counter
+from server.metrics import registry
+
+rejected_total = registry.counter("robot_admission_rejected_total", "准入控制拒绝的请求数量", ("reason",))
+queue_wait_seconds = registry.histogram("robot_admission_wait_seconds", "请求排队等待的时间（秒）")
+
+
+class RateLimiter(object):
+    """按照键（通常是JWT令牌）限制请求速率的令牌桶。
+
+    :ivar rate: 每秒补充的令牌数量。
+    :ivar burst: 桶的容量，即允许的突发请求数量。
+    :ivar max_keys: 最多维护的桶数量，超出时淘汰最久没有请求的桶。
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 100000) -> None:
+        """
+        :raises ValueError: 速率或者容量不是正数时触发。
+        """
+        if rate <= 0 or burst < 1:
+            raise ValueError(f"令牌桶的速率 {rate} 必须为正数，容量 {burst} 至少为1")
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: dict[str, list[float]] = dict()  # 从键映射到剩余令牌数和上次补充的时刻，按照最近请求的顺序排列
+        self._lock = Lock()
+
+    def acquire(self, key: str) -> float:
+        """为一个请求取出一个令牌。
+
+        :param key: 限速的键。
+        :return: 如果取出成功，返回0；否则返回下一个令牌补充所需的秒数。
+        """
+        now = monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                bucket = [self.burst, now]
+                if len(self._buckets) >= self.max_keys:
+                    del self._buckets[next(iter(self._buckets))]
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            self._buckets[key] = bucket  # 移动到末尾
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0.0
+            return (1 - bucket[0]) / self.rate
+
+
+class ConcurrencyLimiter(object):
+    """限制同时处理的请求数量。
+
+    :ivar limit: 同时处理的最大请求数量。
+    :ivar queue: 最多排队等待的请求数量。
+    :ivar timeout: 排队等待的最长时间（秒）。
+    """
+
+    def __init__(self, limit: int, queue: int = 0, timeout: float = 1.0) -> None:
+        """
+        :raises ValueError: 并发数量不是正数时触发。
+        """
+        if limit < 1:
+            raise ValueError(f"并发数量 {limit} 必须为正数")
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self._semaphore = Semaphore(limit)
+        self._waiting = 0
+        self._lock = Lock()
+
+    def acquire(self) -> bool:
+        """开始处理一个请求，没有空闲的名额时排队等待。
+
+        :return: 如果可以处理请求，返回True，之后必须调用 :py:meth:`release` ；如果队列已满或者等待超时，返回False。
+        """
+        if self._semaphore.acquire(blocking=False):
+            return True
+        with self._lock:
+            if self._waiting >= self.queue:
+                return False
+            self._waiting += 1
+        start = perf_counter()
+        try:
+            admitted = self._semaphore.acquire(timeout=self.timeout)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        queue_wait_seconds.observe((), perf_counter() - start)
+        return admitted
+
+    def release(self) -> None:
+        """结束处理一个请求。"""
+        self._semaphore.release()
+
+
+def retry_after(seconds: float) -> int:
+    """将等待时间转换为 ``Retry-After`` 响应头的整数秒数，至少为1。"""
+    return max(1, math.ceil(seconds))
@@ -0,0 +1,284 @@
+"""脚本静态分析模块。
+
+此模块在构建好的状态机上进行静态分析，报告以下问题和开销：
+
+* 被之前的分支覆盖、永远不会被选中的 ``Case`` 分支，以及条件本身无法满足的分支。
+* 从 ``Welcome`` 状态出发无法到达的状态。
+* 每个状态处理一条消息时最多需要检查的条件数量。
+* 每个分支执行一次转移需要的数据库往返次数，包括新状态的默认 ``speak`` 动作。
+
+分析只使用每个条件的语义，因此结论是保守的：报告为被覆盖的分支一定不会被选中，但是没有报告的分支不一定能被选中。
+
+Copyright (c) 2021 Ziheng Mao.
+"""
+
+from typing import Optional
+from server.state_machine import StateMachine, Condition, LengthCondition, ContainCondition, TypeCondition, \
+    EqualCondition, InCondition, MatchCondition, SimilarCondition, Action, ExitAction, GotoAction, UpdateAction, \
+    SpeakAction
+
+INFINITY = float("inf")
+
+
+def _length_range(condition: Condition) -> Optional[tuple[float, float]]:
+    """计算满足条件的字符串长度的范围。
+
+    :param condition: 条件。
+    :return: 长度的闭区间 ``(lo, hi)`` ，满足条件的字符串长度一定在此区间内；无法确定时返回None。
+    """
+    if isinstance(condition, LengthCondition):
+        n = condition.length
+        if condition.op == "<":
+            return 0, n - 1
+        elif condition.op == ">":
+            return max(n + 1, 0), INFINITY
+        elif condition.op == "<=":
+            return 0, n
+        elif condition.op == ">=":
+            return max(n, 0), INFINITY
+        elif condition.op == "=":
+            return n, n
+    elif isinstance(condition, ContainCondition):
+        return len(condition.string), INFINITY
+    elif isinstance(condition, EqualCondition) or isinstance(condition, InCondition):
+        return min(len(string) for string in _strings(condition)), INFINITY  # 用户输入可以包含任意长度的首尾空白
+    elif isinstance(condition, TypeCondition):
+        return 1, INFINITY
+    return None
+
+
+def _covered(intervals: list[tuple[float, float]], target: tuple[float, float]) -> bool:
+    """判断若干区间的并集是否包含目标区间。"""
+    lo, hi = target
+    for start, end in sorted(intervals):
+        if start > lo:
+            break
+        if end >= hi:
+            return True
+        if end >= lo:
+            lo = end + 1
+    return lo > hi
+
+
+def _strings(condition: Condition) -> Optional[set[str]]:
+    """返回字符串相等条件或者关键词集合条件接受的去除首尾空白后的串集合，其他条件返回None。"""
+    if isinstance(condition, EqualCondition):
+        return {condition.string.strip()}
+    elif isinstance(condition, InCondition):
+        return {string.strip() for string in condition.strings}
+    return None
+
+
+def _subsumes(earlier: Condition, later: Condition) -> bool:
+    """判断满足 ``later`` 的字符串是否一定满足 ``earlier`` 。"""
+    later_strings = _strings(later)
+    if isinstance(earlier, ContainCondition):
+        if earlier.string == "":
+            return True
+        if isinstance(later, ContainCondition):
+            return earlier.string in later.string
+        if later_strings is not None:
+            return all(earlier.string in string for string in later_strings)
+    elif _strings(earlier) is not None and later_strings is not None:
+        return later_strings <= _strings(earlier)
+    elif isinstance(earlier, TypeCondition) and isinstance(later, TypeCondition):
+        return earlier.type == later.type
+    elif isinstance(earlier, MatchCondition) and isinstance(later, MatchCondition):
+        return earlier.pattern == later.pattern
+    elif isinstance(earlier, SimilarCondition) and isinstance(later, SimilarCondition):
+        return earlier.phrase.strip().casefold() == later.phrase.strip().casefold() and \
+            earlier.threshold <= later.threshold
+    return False
+
+
+class ClauseReport(object):
+    """分支的分析结果。
+
+    :ivar index: 分支序号，-1表示 ``Default`` 分支。
+    :ivar condition: 条件的字符串表示，``Default`` 分支为 ``Default`` 。
+    :ivar shadowed_by: 覆盖该分支的之前分支序号列表，为空表示没有被覆盖。
+    :ivar unsatisfiable: 条件本身是否无法满足。
+    :ivar checks: 选中该分支之前需要检查的条件数量。
+    :ivar db_round_trips: 执行该分支需要的数据库往返次数。
+    :ivar target: 转移到的状态，-1表示结束会话。
+    """
+
+    def __init__(self, index: int, condition: str, checks: int, db_round_trips: int, target: int) -> None:
+        self.index = index
+        self.condition = condition
+        self.shadowed_by: list[int] = []
+        self.unsatisfiable = False
+        self.checks = checks
+        self.db_round_trips = db_round_trips
+        self.target = target
+
+    @property
+    def dead(self) -> bool:
+        """该分支是否永远不会被选中。"""
+        return self.unsatisfiable or len(self.shadowed_by) != 0
+
+
+class StateReport(object):
+    """状态的分析结果。
+
+    :ivar name: 状态名。
+    :ivar reachable: 是否能从 ``Welcome`` 状态到达。
+    :ivar clauses: ``Case`` 分支的分析结果列表，最后一项为 ``Default`` 分支。
+    :ivar timeouts: 从超时秒数映射到 ``(数据库往返次数, 转移到的状态)`` 的字典。
+    :ivar hello_round_trips: 输出默认 ``speak`` 动作需要的数据库往返次数。
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.reachable = False
+        self.clauses: list[ClauseReport] = []
+        self.timeouts: dict[int, tuple[int, int]] = dict()
+        self.hello_round_trips = 0
+
+    @property
+    def max_checks(self) -> int:
+        """处理一条消息时最多需要检查的条件数量。"""
+        return len(self.clauses) - 1
+
+
+def _round_trips(actions: list[Action]) -> int:
+    """计算执行一个动作列表需要的数据库往返次数。"""
+    count = 0
+    for action in actions:
+        if isinstance(action, UpdateAction):
+            count += 1
+        elif isinstance(action, SpeakAction) and any(content[0] == '$' for content in action.contents):
+            count += 1  # 一次读出所有变量
+    return count
+
+
+def _target(actions: list[Action], state: int) -> int:
+    """计算执行一个动作列表之后转移到的状态。"""
+    for action in actions:
+        if isinstance(action, ExitAction):
+            return -1
+        if isinstance(action, GotoAction):
+            return action.next
+    return state
+
+
+def analyze(machine: StateMachine) -> list[StateReport]:
+    """分析一个状态机。
+
+    :param machine: 状态机。
+    :return: 各个状态的分析结果列表，与 ``machine.states`` 一一对应。
+    """
+    hello = [_round_trips(speak) for speak in machine.speak]
+    reports: list[StateReport] = []
+    for state, name in enumerate(machine.states):
+        report = StateReport(name)
+        report.hello_round_trips = hello[state]
+        lengths: list[tuple[int, tuple[float, float]]] = []  # 之前的Length分支
+        for index, case in enumerate(machine.case[state]):
+            target = _target(case.actions, state)
+            clause = ClauseReport(index, repr(case.condition), index + 1,
+                                  _round_trips(case.actions) + (hello[target] if target != -1 else 0), target)
+            length_range = _length_range(case.condition)
+            if length_range is not None and length_range[0] > length_range[1]:
+                clause.unsatisfiable = True
+            for earlier in report.clauses:
+                if not earlier.dead and _subsumes(machine.case[state][earlier.index].condition, case.condition):
+                    clause.shadowed_by.append(earlier.index)
+            if not clause.dead and length_range is not None and \
+                    _covered([interval for _, interval in lengths], length_range):
+                clause.shadowed_by += [i for i, interval in lengths if interval[0] <= length_range[1] and
+                                       interval[1] >= length_range[0]]
+            if isinstance(case.condition, LengthCondition) and not clause.dead:
+                lengths.append((index, length_range))
+            report.clauses.append(clause)
+        target = _target(machine.default[state], state)
+        default = ClauseReport(-1, "Default", len(machine.case[state]),
+                               _round_trips(machine.default[state]) + (hello[target] if target != -1 else 0), target)
+        for clause in report.clauses:  # 之前的分支可能已经接受了所有字符串
+            if not clause.dead and isinstance(machine.case[state][clause.index].condition, ContainCondition) and \
+                    machine.case[state][clause.index].condition.string == "":
+                default.shadowed_by = [clause.index]
+                break
+        else:
+            if _covered([interval for _, interval in lengths], (0, INFINITY)):
+                default.shadowed_by = [i for i, _ in lengths]
+        report.clauses.append(default)
+        for seconds, actions in machine.timeout[state].items():
+            target = _target(actions, state)
+            report.timeouts[seconds] = (_round_trips(actions) + (hello[target] if target not in (-1, state) else 0),
+                                        target)
+        reports.append(report)
+
+    # 从Welcome状态出发，沿着可能被选中的分支和超时分支搜索可达的状态
+    queue = [0]
+    reports[0].reachable = True
+    while queue:
+        state = queue.pop()
+        targets = [clause.target for clause in reports[state].clauses if not clause.dead]
+        targets += [target for _, target in reports[state].timeouts.values()]
+        for target in targets:
+            if target != -1 and not reports[target].reachable:
+                reports[target].reachable = True
+                queue.append(target)
+    return reports
+
+
+def format_report(machine: StateMachine, reports: list[StateReport]) -> str:
+    """将分析结果格式化为文本。
+
+    :param machine: 状态机。
+    :param reports: :py:func:`analyze` 的返回值。
+    :return: 分析报告。
+    """
+    def state_name(index: int) -> str:
+        return "Exit" if index == -1 else machine.states[index]
+
+    lines = []
+    for report in reports:
+        lines.append(f"State {report.name}" + ("" if report.reachable else "  [unreachable from Welcome]"))
+        lines.append(f"    hello: {report.hello_round_trips} db round-trip(s); "
+                     f"at most {report.max_checks} condition check(s) per message")
+        for clause in report.clauses:
+            line = f"    {clause.condition}: {clause.checks} check(s), {clause.db_round_trips} db round-trip(s), " \
+                   f"-> {state_name(clause.target)}"
+            if clause.unsatisfiable:
+                line += "  [never matches]"
+            elif clause.shadowed_by:
+                line += f"  [shadowed by Case #{', #'.join(str(i) for i in clause.shadowed_by)}]"
+            lines.append(line)
+        for seconds, (round_trips, target) in report.timeouts.items():
+            lines.append(f"    Timeout {seconds}: {round_trips} db round-trip(s), -> {state_name(target)}")
+    return "\n".join(lines)
+
+
+def warnings(reports: list[StateReport]) -> int:
+    """统计分析结果中的问题数量，包括永远不会被选中的分支和不可达的状态。"""
+    return sum(1 for report in reports if not report.reachable) + \
+        sum(1 for report in reports for clause in report.clauses if clause.dead and clause.index != -1)
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    import tempfile
+    from server.state_machine import GrammarError, init_database
+
+    parser = argparse.ArgumentParser(description="静态分析脚本，报告被覆盖的分支、不可达的状态和各个转移的开销。")
+    parser.add_argument("source", nargs="+", help="脚本文件")
+    parser.add_argument("--strict", action="store_true", help="发现问题时以状态码1退出")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        init_database(os.path.join(directory, "analyzer.db"))
+        try:
+            state_machine = StateMachine(args.source)
+        except GrammarError as err:
+            print(" ".join([str(item) for item in err.context]))
+            print("GrammarError: ", err.msg)
+            raise SystemExit(1)
+    result = analyze(state_machine)
+    print(format_report(state_machine, result))
+    count = warnings(result)
+    print(f"{count} warning(s)")
+    if args.strict and count != 0:
+        raise SystemExit(1)
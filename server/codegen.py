@@ -0,0 +1,170 @@
+"""状态机代码生成模块。
+
+此模块为状态机的每个状态生成一个专用的Python函数，函数接受用户消息的 :py:class:`server.state_machine.MessageContext` ，返回第一个满足条件的 ``Case`` 分支序号，-1表示 ``Default`` 分支。
+
+生成的函数中条件被内联展开，常量在生成时折叠：
+
+* ``Length`` 条件展开为对消息长度的一次比较，恒成立的条件直接返回，恒不成立的条件被删除。
+* ``Contain`` 条件展开为 ``in`` 运算，包含空串的条件直接返回。
+* ``Type`` 条件展开为对消息上下文中数字判断或者实数值的检查。
+* 连续的字符串相等条件和关键词集合条件合并为一次字典查找，常量在生成时去除首尾空白。
+
+无法内联的条件通过调用 :py:meth:`server.state_machine.Condition.check` 判断。生成的代码在加载脚本时通过 ``compile`` 编译一次。
+
+Copyright (c) 2021 Ziheng Mao.
+"""
+
+from typing import Callable, Any
+from server.state_machine import MessageContext, Condition, LengthCondition, ContainCondition, TypeCondition, \
+    EqualCondition, InCondition
+
+_LENGTH_OPERATORS = {"<": "<", ">": ">", "<=": "<=", ">=": ">=", "=": "=="}
+
+
+def _length_constant(op: str, length: int) -> Any:
+    """折叠长度条件，长度总是非负的。
+
+    :return: 条件恒成立时返回True，恒不成立时返回False，否则返回None。
+    """
+    if op == "<":
+        return False if length <= 0 else None
+    elif op == "<=":
+        return False if length < 0 else None
+    elif op == ">":
+        return True if length < 0 else None
+    elif op == ">=":
+        return True if length <= 0 else None
+    elif op == "=":
+        return False if length < 0 else None
+
+
+class _StateGenerator(object):
+    """生成一个状态的匹配函数。
+
+    :ivar name: 生成的函数名。
+    :ivar lines: 函数体的代码行。
+    :ivar namespace: 函数的全局命名空间，存放无法内联的条件对象和字典。
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.lines: list[str] = []
+        self.namespace: dict[str, Any] = dict()
+        self._length = False  # 是否已经读取了消息长度
+        self._strip = False  # 是否已经读取了去除首尾空白的消息
+        self._equal_run: list[tuple[str, int]] = []  # 尚未生成的连续字符串相等条件，关键词集合的每个串各占一项
+
+    def _emit(self, line: str) -> None:
+        self.lines.append("    " + line)
+
+    def _need_length(self) -> None:
+        if not self._length:
+            self._emit("n = msg.length")
+            self._length = True
+
+    def _need_strip(self) -> None:
+        if not self._strip:
+            self._emit("s = msg.stripped")
+            self._strip = True
+
+    def _flush_equal(self) -> None:
+        """生成之前累积的连续字符串相等条件和关键词集合条件。"""
+        if len(self._equal_run) == 0:
+            return
+        self._need_strip()
+        if len(self._equal_run) == 1:
+            string, index = self._equal_run[0]
+            self._emit(f"if s == {string!r}:")
+            self._emit(f"    return {index}")
+        else:
+            table: dict[str, int] = dict()
+            for string, index in self._equal_run:
+                table.setdefault(string, index)  # 相同的串只有第一个分支可能被选中
+            table_name = f"_table{len(self.namespace)}"
+            self.namespace[table_name] = table
+            self._emit(f"i = {table_name}.get(s)")
+            self._emit("if i is not None:")
+            self._emit("    return i")
+        self._equal_run = []
+
+    def add(self, index: int, condition: Condition) -> bool:
+        """生成一个条件。
+
+        :param index: 分支序号。
+        :param condition: 条件。
+        :return: 如果该条件恒成立，之后的分支不会被选中，返回False；否则返回True。
+        """
+        if isinstance(condition, EqualCondition):
+            self._equal_run.append((condition.string.strip(), index))
+            return True
+        if isinstance(condition, InCondition):
+            self._equal_run += [(string.strip(), index) for string in condition.strings]
+            return True
+        self._flush_equal()
+        if isinstance(condition, LengthCondition):
+            constant = _length_constant(condition.op, condition.length)
+            if constant is False:
+                return True
+            if constant is True:
+                self._emit(f"return {index}")
+                return False
+            self._need_length()
+            self._emit(f"if n {_LENGTH_OPERATORS[condition.op]} {condition.length!r}:")
+            self._emit(f"    return {index}")
+        elif isinstance(condition, ContainCondition):
+            if condition.string == "":
+                self._emit(f"return {index}")
+                return False
+            self._emit(f"if {condition.string!r} in msg:")
+            self._emit(f"    return {index}")
+        elif isinstance(condition, TypeCondition) and condition.type == "Int":
+            self._emit("if msg.is_digit:")
+            self._emit(f"    return {index}")
+        elif isinstance(condition, TypeCondition) and condition.type == "Real":
+            self._emit("if msg.real_value is not None:")
+            self._emit(f"    return {index}")
+        else:  # 无法内联的条件
+            condition_name = f"_condition{index}"
+            self.namespace[condition_name] = condition
+            self._emit(f"if {condition_name}.check(msg):")
+            self._emit(f"    return {index}")
+        return True
+
+    def source(self) -> str:
+        """返回生成的函数源代码。"""
+        self._flush_equal()
+        if len(self.lines) == 0 or not self.lines[-1].startswith("    return "):
+            self._emit("return -1")
+        return f"def {self.name}(msg):\n" + "\n".join(self.lines) + "\n"
+
+
+def generate(states: list[str], case: list[list[Any]]) -> list[tuple[str, dict[str, Any]]]:
+    """为每个状态生成匹配函数的源代码。
+
+    :param states: 状态名列表。
+    :param case: 各个状态的条件分支列表，参考 :py:class:`server.state_machine.StateMachine`。
+    :return: 各个状态的源代码和全局命名空间。
+    """
+    result = []
+    for state, clauses in enumerate(case):
+        generator = _StateGenerator(f"match_{states[state]}")
+        for index, clause in enumerate(clauses):
+            if not generator.add(index, clause.condition):
+                break
+        result.append((generator.source(), generator.namespace))
+    return result
+
+
+def compile_matchers(states: list[str], case: list[list[Any]]) -> list[Callable[[MessageContext], int]]:
+    """编译各个状态的匹配函数。
+
+    :param states: 状态名列表。
+    :param case: 各个状态的条件分支列表。
+    :return: 各个状态的匹配函数，函数接受用户消息，返回第一个满足条件的分支序号，-1表示 ``Default`` 分支。
+    """
+    matchers = []
+    for state, (source, namespace) in enumerate(generate(states, case)):
+        code = compile(source, f"<robot-dsl state {states[state]}>", "exec")
+        exec(code, namespace)
+        matchers.append(namespace[f"match_{states[state]}"])
+    return matchers
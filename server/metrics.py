@@ -0,0 +1,304 @@
+"""性能指标模块。
+
+此模块提供计数器、直方图和回调仪表三种指标，并且能够以Prometheus文本格式导出所有指标。
+
+为了降低热路径上的开销，指标的写操作不加锁：每个线程只写入属于自己的分片，导出时再将所有分片汇总。
+线程结束之后，它的分片被合并到已退出线程的合计中，因此为每个请求创建新线程的服务器不会让分片无限增长。
+
+Copyright (c) 2021 Ziheng Mao.
+"""
+
+import weakref
+from abc import ABCMeta, abstractmethod
+from bisect import bisect_left
+from itertools import count
+from threading import Lock, RLock, local
+from time import perf_counter
+from typing import Callable, Iterable
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LOCK_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    """生成指标的标签串。
+
+    :param names: 标签名。
+    :param values: 标签值。
+    :param extra: 附加的标签，例如直方图的 ``le`` 标签。
+    :return: 形如 ``{a="1",b="2"}`` 的标签串，没有标签时返回空串。
+    """
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    """格式化指标的值。"""
+    if isinstance(value, float) and value == float("inf"):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """指标基类。
+
+    :ivar name: 指标名。
+    :ivar help: 指标说明。
+    :ivar labelnames: 标签名。
+    """
+    type = "untyped"
+
+    def __init__(self, name: str, help_: str, labelnames: Iterable[str] = ()) -> None:
+        self.name = name
+        self.help = help_
+        self.labelnames = tuple(labelnames)
+
+    def samples(self) -> list[str]:
+        """返回指标的所有样本行。"""
+        return []
+
+    def expose(self) -> str:
+        """以Prometheus文本格式导出指标。"""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines += self.samples()
+        return "\n".join(lines) + "\n"
+
+
+class _Owner(object):
+    """保存在线程局部变量中，线程结束时被回收，触发分片的合并。"""
+    __slots__ = ("__weakref__",)
+
+
+class _ShardedMetric(Metric, metaclass=ABCMeta):
+    """按线程分片存储的指标。
+
+    每个线程只写入保存在线程局部变量中的分片，因此写操作不需要加锁。线程结束时分片不再被写入，
+    此时将其合并到 ``_retired`` 中并且移除，分片的数量不超过存活的线程数量。
+    """
+
+    def __init__(self, name: str, help_: str, labelnames: Iterable[str] = ()) -> None:
+        super().__init__(name, help_, labelnames)
+        self._local = local()
+        self._keys = count()
+        self._shards: dict[int, dict[tuple, object]] = dict()  # 存活线程的分片
+        self._retired: dict[tuple, object] = dict()  # 已经结束的线程的合计
+        self._lock = RLock()  # 保护分片的移除与合并，回收可能发生在持有锁的线程中，因此可重入
+
+    def _shard(self) -> dict[tuple, object]:
+        """返回当前线程的分片。"""
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            key, owner = next(self._keys), _Owner()
+            shard = self._shards[key] = dict()
+            weakref.finalize(owner, self._retire, key).atexit = False
+            self._local.owner = owner
+            self._local.shard = shard
+        return shard
+
+    def _retire(self, key: int) -> None:
+        """将已经结束的线程的分片合并到 ``_retired`` 中。"""
+        with self._lock:
+            shard = self._shards.pop(key, None)
+            for labels, value in (shard or {}).items():
+                self._retired[labels] = self._add(self._retired.get(labels), value)
+
+    @staticmethod
+    @abstractmethod
+    def _add(total: object, value: object) -> object:
+        """合并同一组标签下的两个值， ``total`` 为None时返回 ``value`` 的副本。"""
+        pass
+
+    def _total(self) -> dict[tuple, object]:
+        """汇总已经结束的线程和所有存活线程的分片。"""
+        with self._lock:
+            shards = [list(self._retired.items())] + [list(shard.items()) for shard in list(self._shards.values())]
+        total: dict[tuple, object] = dict()
+        for items in shards:
+            for labels, value in items:
+                total[labels] = self._add(total.get(labels), value)
+        return total
+
+
+class Counter(_ShardedMetric):
+    """单调递增的计数器。"""
+    type = "counter"
+
+    def inc(self, labels: tuple = (), amount: float = 1) -> None:
+        """增加计数。
+
+        :param labels: 标签值，与 ``labelnames`` 一一对应。
+        :param amount: 增加的数量。
+        """
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    @staticmethod
+    def _add(total: float, value: float) -> float:
+        return value if total is None else total + value
+
+    def value(self, labels: tuple = ()) -> float:
+        """返回某组标签下的计数。"""
+        return self._total().get(labels, 0)
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+                for labels, value in sorted(self._total().items())]
+
+
+class Histogram(_ShardedMetric):
+    """直方图，记录观测值的分布。
+
+    每组标签在分片中对应一个列表，前 ``len(buckets) + 1`` 项为各个区间的计数，最后两项为观测值之和与观测次数。
+
+    :ivar buckets: 各区间的上界，按升序排列。
+    """
+    type = "histogram"
+
+    def __init__(self, name: str, help_: str, labelnames: Iterable[str] = (),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, help_, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, labels: tuple, value: float) -> None:
+        """记录一个观测值。
+
+        :param labels: 标签值，与 ``labelnames`` 一一对应。
+        :param value: 观测值。
+        """
+        shard = self._shard()
+        data = shard.get(labels)
+        if data is None:
+            data = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        data[bisect_left(self.buckets, value)] += 1
+        data[-2] += value
+        data[-1] += 1
+
+    @staticmethod
+    def _add(total: list, value: list) -> list:
+        return list(value) if total is None else [a + b for a, b in zip(total, value)]
+
+    def count(self, labels: tuple = ()) -> int:
+        """返回某组标签下的观测次数。"""
+        data = self._total().get(labels)
+        return 0 if data is None else data[-1]
+
+    def samples(self) -> list[str]:
+        lines = []
+        for labels, data in sorted(self._total().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), data):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(data[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {data[-1]}")
+        return lines
+
+
+class GaugeFunction(Metric):
+    """回调仪表，导出时调用回调函数得到当前值。
+
+    :ivar function: 回调函数，返回从标签值映射到数值的字典。
+    """
+    type = "gauge"
+
+    def __init__(self, name: str, help_: str, labelnames: Iterable[str],
+                 function: Callable[[], dict[tuple, float]]) -> None:
+        super().__init__(name, help_, labelnames)
+        self.function = function
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+                for labels, value in sorted(self.function().items())]
+
+
+class Registry(object):
+    """指标注册表。
+
+    :ivar metrics: 从指标名映射到指标对象的字典。
+    :ivar lock: 互斥访问 ``metrics`` 字典的锁。
+    """
+
+    def __init__(self) -> None:
+        self.metrics: dict[str, Metric] = dict()
+        self.lock = Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        """注册一个指标，同名的指标会被替换。
+
+        :param metric: 指标对象。
+        :return: 注册的指标对象。
+        """
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_: str, labelnames: Iterable[str] = ()) -> Counter:
+        """创建并注册一个计数器。"""
+        return self.register(Counter(name, help_, labelnames))
+
+    def histogram(self, name: str, help_: str, labelnames: Iterable[str] = (),
+                  buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        """创建并注册一个直方图。"""
+        return self.register(Histogram(name, help_, labelnames, buckets))
+
+    def gauge_function(self, name: str, help_: str, labelnames: Iterable[str],
+                       function: Callable[[], dict[tuple, float]]) -> GaugeFunction:
+        """创建并注册一个回调仪表。"""
+        return self.register(GaugeFunction(name, help_, labelnames, function))
+
+    def expose(self) -> str:
+        """以Prometheus文本格式导出所有指标。"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return "".join(metric.expose() for metric in metrics)
+
+
+class InstrumentedLock(object):
+    """记录等待时间和持有时间的互斥锁，用法与 ``threading.Lock`` 相同。
+
+    :ivar wait: 记录等待时间的直方图。
+    :ivar hold: 记录持有时间的直方图。
+    :ivar labels: 记录时使用的标签值。
+    """
+
+    def __init__(self, wait: Histogram, hold: Histogram, labels: tuple = ()) -> None:
+        self._lock = Lock()
+        self._acquired_at = 0.0
+        self.wait = wait
+        self.hold = hold
+        self.labels = labels
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        """获取锁，参数与 ``threading.Lock.acquire`` 相同，只有获取成功时才记录等待时间。
+
+        :return: 是否获取了锁。
+        """
+        start = perf_counter()
+        if not self._lock.acquire(blocking, timeout):
+            return False
+        self._acquired_at = perf_counter()  # 只有持有锁的线程会写入此属性
+        self.wait.observe(self.labels, self._acquired_at - start)
+        return True
+
+    def release(self) -> None:
+        held = perf_counter() - self._acquired_at
+        self._lock.release()
+        self.hold.observe(self.labels, held)
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+    def __enter__(self) -> bool:
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.release()
+
+
+registry = Registry()
@@ -17,6 +17,7 @@ class RobotLanguage(object):
     _real_constant = pp.Regex("[-+]?[0-9]*\\.?[0-9]+([eE][-+]?[0-9]+)?").set_parse_action(
         lambda tokens: float(tokens[0]))
     _string_constant = pp.quoted_string('"')
+    _regex_constant = pp.Regex(r"/(?:[^/\\\n]|\\.)*/")
 
     _variable = pp.Combine('$' + pp.Regex("[0-9A-Za-z_]+"))
     _variable_clause = pp.Group(_variable + (
@@ -27,8 +28,12 @@ class RobotLanguage(object):
     _length_condition = pp.Keyword("Length") + pp.oneOf("< > <= >= =") + _integer_constant
     _contain_condition = pp.Keyword("Contain") + _string_constant
     _type_condition = pp.Keyword("Type") + (pp.Keyword("Int") ^ pp.Keyword("Real"))
+    _match_condition = pp.Keyword("Match") + _regex_constant
+    _similar_condition = pp.Keyword("Similar") + _string_constant + _real_constant
+    _in_condition = pp.Keyword("In") + pp.Group(_string_constant + pp.ZeroOrMore(pp.Suppress(",") + _string_constant))
     _equal_condition = _string_constant
-    _conditions = _length_condition ^ _contain_condition ^ _type_condition ^ _equal_condition
+    _conditions = _length_condition ^ _contain_condition ^ _type_condition ^ _match_condition ^ _in_condition ^ \
+        _similar_condition ^ _equal_condition
 
     _exit_action = pp.Group(pp.Keyword("Exit"))
     _goto_action = pp.Group(pp.Keyword("Goto") + pp.Word(pp.alphas))
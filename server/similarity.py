@@ -0,0 +1,140 @@
+"""模糊意图匹配模块。
+
+此模块为 ``Similar`` 条件建立字符n-gram的TF-IDF索引。加载脚本时，一个状态中所有 ``Similar`` 条件的短语被向量化为一个稀疏矩阵，
+每条消息只需要一次稀疏矩阵向量乘法就能得到它和所有短语的余弦相似度，第一个相似度达到阈值的分支被选中。
+
+矩阵按列存储，每个n-gram对应一列，列中保存包含该n-gram的短语的行号和权重。一条消息通常只包含几十个n-gram，
+计算相似度时只读取这些列，再通过 ``numpy.bincount`` 累加到各个短语上，因此开销与词表大小无关。
+
+索引完全在本地CPU上计算，不需要网络或者预训练模型。此模块依赖NumPy，只有脚本中使用了 ``Similar`` 条件时才会被导入。
+
+Copyright (c) 2021 Ziheng Mao.
+"""
+
+import math
+from typing import Optional
+import numpy as np
+from server.state_machine import MessageContext, Condition, SimilarCondition
+
+NGRAM_RANGE = (1, 3)  # n-gram的最小和最大长度
+THRESHOLD_TOLERANCE = 1e-6  # 权重以单精度存储，容许的误差使得和短语相同的消息能够满足阈值为1的条件
+
+
+def ngrams(text: str) -> dict[str, int]:
+    """统计一个串中各个字符n-gram的出现次数。
+
+    :param text: 已经去除首尾空白并且忽略大小写的串。
+    :return: 从n-gram映射到出现次数的字典。
+    """
+    counts: dict[str, int] = dict()
+    for n in range(NGRAM_RANGE[0], NGRAM_RANGE[1] + 1):
+        for i in range(len(text) - n + 1):
+            gram = text[i:i + n]
+            counts[gram] = counts.get(gram, 0) + 1
+    return counts
+
+
+class SimilarIndex(object):
+    """一个状态中所有 ``Similar`` 条件的TF-IDF索引。
+
+    :ivar size: 短语的数量。
+    :ivar thresholds: 各个条件的相似度阈值。
+    :ivar columns: 从n-gram映射到列号的字典。
+    :ivar idf: 各列的逆文档频率。
+    :ivar indptr: 第 ``i`` 列的元素在 ``rows`` 和 ``weights`` 中的范围为 ``indptr[i]`` 到 ``indptr[i + 1]`` 。
+    :ivar rows: 各个元素所在的行，即短语的序号。
+    :ivar weights: 各个元素的权重，每个短语的向量已经归一化。
+    """
+
+    def __init__(self, conditions: list[SimilarCondition]) -> None:
+        self.size = len(conditions)
+        self.thresholds = np.array([condition.threshold for condition in conditions], dtype=np.float64)
+        documents = [ngrams(condition.phrase.strip().casefold()) for condition in conditions]
+
+        self.columns: dict[str, int] = dict()
+        frequency: list[int] = []  # 各列的文档频率
+        for document in documents:
+            for gram in document:
+                column = self.columns.setdefault(gram, len(self.columns))
+                if column == len(frequency):
+                    frequency.append(0)
+                frequency[column] += 1
+        self.idf = np.log((1 + self.size) / (1 + np.array(frequency, dtype=np.float64))) + 1
+        self._unknown_idf = math.log(1 + self.size) + 1  # 不在词表中的n-gram视为只在一个虚拟文档中出现
+
+        columns: list[int] = []
+        rows: list[int] = []
+        weights: list[float] = []
+        for row, document in enumerate(documents):
+            indices = [self.columns[gram] for gram in document]
+            vector = np.array(list(document.values()), dtype=np.float64) * self.idf[indices]
+            columns += indices
+            rows += [row] * len(indices)
+            weights += (vector / np.linalg.norm(vector)).tolist()
+        order = np.argsort(np.array(columns, dtype=np.int64), kind="stable")
+        self.rows = np.array(rows, dtype=np.int32)[order]
+        self.weights = np.array(weights, dtype=np.float32)[order]
+        self.indptr = np.zeros(len(self.columns) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(np.array(columns, dtype=np.int64), minlength=len(self.columns)), out=self.indptr[1:])
+        self._key = f"similar_index_{id(self)}"
+
+    @property
+    def nbytes(self) -> int:
+        """索引中数组占用的字节数。"""
+        return self.thresholds.nbytes + self.idf.nbytes + self.indptr.nbytes + self.rows.nbytes + self.weights.nbytes
+
+    def scores(self, message: MessageContext) -> np.ndarray:
+        """计算消息和各个短语的余弦相似度。
+
+        :param message: 用户消息。
+        :return: 长度为 ``size`` 的数组。
+        """
+        indices: list[int] = []
+        counts: list[int] = []
+        unknown = 0.0  # 不在词表中的n-gram对消息向量长度的贡献
+        for gram, count in ngrams(message.casefolded).items():
+            column = self.columns.get(gram)
+            if column is None:
+                unknown += (count * self._unknown_idf) ** 2
+            else:
+                indices.append(column)
+                counts.append(count)
+        if len(indices) == 0:
+            return np.zeros(self.size)
+        query = np.array(counts, dtype=np.float64) * self.idf[indices]
+        query /= math.sqrt(float(query @ query) + unknown)
+
+        # 取出消息中各个n-gram对应的列，一次累加得到矩阵和消息向量的乘积
+        starts = self.indptr[indices]
+        lengths = self.indptr[np.array(indices) + 1] - starts
+        offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+        return np.bincount(self.rows[offsets], weights=self.weights[offsets] * np.repeat(query, lengths),
+                           minlength=self.size)
+
+    def _first(self, message: MessageContext) -> int:
+        hits = np.flatnonzero(self.scores(message) >= self.thresholds - THRESHOLD_TOLERANCE)
+        return int(hits[0]) if hits.size != 0 else -1
+
+    def first(self, message: MessageContext) -> int:
+        """返回第一个相似度达到阈值的条件在索引中的序号，每条消息只计算一次。
+
+        :param message: 用户消息。
+        :return: 条件的序号，都没有达到阈值时返回-1。
+        """
+        return message.memo(self._key, self._first)
+
+    @classmethod
+    def combine(cls, conditions: list[Condition]) -> Optional["SimilarIndex"]:
+        """为一个状态中的所有 ``Similar`` 条件建立索引，并且设置各个条件的 ``group`` 和 ``position`` 。
+
+        :param conditions: 一个状态的条件列表。
+        :return: 建立的索引，没有 ``Similar`` 条件时返回None。
+        """
+        phrases = [condition for condition in conditions if isinstance(condition, SimilarCondition)]
+        if len(phrases) == 0:
+            return None
+        index = cls(phrases)
+        for position, condition in enumerate(phrases):
+            condition.group = index
+            condition.position = position
+        return index
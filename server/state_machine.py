@@ -6,17 +6,38 @@
 
 此模块同时维护一个数据库，存储用户相关的变量。
 
+导入pyparsing和构建文法的耗时较长，因此语法分析模块只在需要解析脚本时才导入。
+指定了语法树缓存目录时，语法树以JSON格式保存在缓存目录中，以脚本文件和文法定义的哈希值为键，缓存有效时不导入语法分析模块。
+
 Copyright (c) 2021 Ziheng Mao.
 """
 
 import os
+import re
+import json
+import hashlib
+import operator
 from abc import ABCMeta, abstractmethod
+from functools import partial, lru_cache
 from threading import Lock
-from typing import Any, Union, Optional
+from time import perf_counter
+from typing import Any, Union, Optional, Callable
 from storm.locals import create_database, Store
 from storm.properties import Unicode, Int, Float
-from pyparsing import ParseException
-from server.parser import RobotLanguage
+from server import tracing
+from server.metrics import registry, InstrumentedLock, LOCK_BUCKETS
+from server.storage import UserVariableSet, Storage, StormStorage, SQLiteStorage, MemorySQLiteStorage, \
+    ShardedSQLiteStorage, shard_path
+
+transition_seconds = registry.histogram("robot_transition_seconds", "状态转移的耗时（秒）", ("state", "kind"))
+action_seconds = registry.histogram("robot_action_seconds", "动作执行的耗时（秒）", ("action",))
+db_lock_wait_seconds = registry.histogram("robot_db_lock_wait_seconds", "等待数据库锁的时间（秒）",
+                                          buckets=LOCK_BUCKETS)
+db_lock_hold_seconds = registry.histogram("robot_db_lock_hold_seconds", "持有数据库锁的时间（秒）",
+                                          buckets=LOCK_BUCKETS)
+
+MATCH_CACHE_KEY_LENGTH = 64
+PARSER_SOURCE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "parser.py")  # 文法改变时语法树缓存失效
 
 
 class LoginError(Exception):
@@ -36,32 +57,14 @@ class GrammarError(Exception):
         self.context = context
 
 
-class UserVariableSet(object):
-    """用户变量集，与数据库关联。
-
-    采用storm作为ORM，除了 ``column_type`` 之外各个类属性关联到数据库表中的一列，实例中的相关属性关联到元组的对应属性。
-
-    用户的基础属性包括用户名和密码，其他属性则通过 ``setattr`` 动态添加。
-
-    :var column_type: 表中各列的类型。
-    """
-    __storm_table__ = 'user_variable'
-    column_type = {"username": "Text", "passwd": "Text"}
-    username = Unicode(primary=True)
-    passwd = Unicode()
-
-    def __init__(self, username: str, passwd: str) -> None:
-        self.username = username
-        self.passwd = passwd
-
-
 class UserState(object):
     """用户状态对象。
 
     :ivar state: 用户在状态机中所处的状态。
     :ivar have_login: 用户是否已经登录。
     :ivar last_time: 距离用户上次发送消息过去的秒数。
-    :ivar lock: 互斥锁。
+    :ivar lock: 互斥锁，保护单个字段的写入。一次状态转移包括多次读写，同一个会话的状态转移由
+        :py:meth:`server.user_manage.UserManage.session` 依次执行。
     :ivar username: 用户名。
     """
 
@@ -81,20 +84,12 @@ class UserState(object):
         :param passwd: 密码。
         :return: 如果注册成功，返回True；否则返回False。
         """
-        global database, db_lock
-        with db_lock:
-            store = Store(database)
-            if store.get(UserVariableSet, username) is not None:  # 用户已经存在
-                store.close()
-                return False
-            with self.lock:
-                self.username = username
-                variable_set = UserVariableSet(username, passwd)
-                self.have_login = True
-            store.add(variable_set)  # 添加新的行
-            store.commit()
-            store.close()
-            return True
+        if not storage.register(username, passwd):  # 用户已经存在
+            return False
+        with self.lock:
+            self.username = username
+            self.have_login = True
+        return True
 
     def login(self, username: str, passwd: str) -> bool:
         """用户登录。
@@ -107,31 +102,105 @@ class UserState(object):
         """
         if username == "Guest":  # 不能登录访客用户
             return False
-        global database, db_lock
-        with db_lock:
-            store = Store(database)
-            variable_set = store.get(UserVariableSet, username)
-            if variable_set is None:  # 用户不存在
-                store.close()
-                return False
-            if variable_set.passwd == passwd:
-                with self.lock:
-                    self.username = username
-                    self.have_login = True
-                store.close()
-                return True
-            store.close()
+        if not storage.login(username, passwd):  # 用户不存在或者密码错误
             return False
+        with self.lock:
+            self.username = username
+            self.have_login = True
+        return True
+
+
+class _lazy(object):
+    """惰性属性，第一次访问时计算并且存入实例字典，之后的访问直接读取实例字典。"""
+
+    def __init__(self, function: Callable[[Any], Any]) -> None:
+        self.function = function
+        self.name = function.__name__
+        self.__doc__ = function.__doc__
+
+    def __get__(self, instance: Any, owner: type) -> Any:
+        if instance is None:
+            return self
+        value = instance.__dict__[self.name] = self.function(instance)
+        return value
+
+
+class MessageContext(str):
+    """一条用户消息的分析上下文。
+
+    每次条件转移为用户输入创建一个上下文，依次传给各个条件的 :py:meth:`Condition.check` 和各个动作的
+    :py:meth:`Action.exec` 。上下文本身就是用户输入的字符串，各个派生值在第一次使用时计算，之后直接复用，
+    因此每条消息的每个派生值最多计算一次。
+    """
+
+    @_lazy
+    def length(self) -> int:
+        """消息的长度。"""
+        return len(self)
+
+    @_lazy
+    def stripped(self) -> str:
+        """去除首尾空白的消息。"""
+        return self.strip()
+
+    @_lazy
+    def casefolded(self) -> str:
+        """去除首尾空白并且忽略大小写的消息。"""
+        return self.stripped.casefold()
+
+    @_lazy
+    def is_digit(self) -> bool:
+        """消息是否由数字组成。"""
+        return self.isdigit()
+
+    @_lazy
+    def int_value(self) -> int:
+        """消息的整数值，消息不是整数时抛出 ``ValueError`` 。"""
+        return int(self)
+
+    @_lazy
+    def real_value(self) -> Optional[float]:
+        """消息的实数值，消息不是实数时为None。"""
+        try:
+            return float(self)
+        except ValueError:
+            return None
+
+    @classmethod
+    def of(cls, message: str) -> "MessageContext":
+        """返回消息的上下文。直接传入的字符串没有上下文，临时创建一个，因此各个条件也接受普通的字符串。
+
+        :param message: 用户消息或者它的上下文。
+        :return: 消息的上下文。
+        """
+        return message if isinstance(message, MessageContext) else cls(message)
+
+    def memo(self, key: str, function: Callable[["MessageContext"], Any]) -> Any:
+        """读取以 ``key`` 为键的派生值，第一次读取时调用 ``function`` 计算。
+
+        :param key: 派生值的键，不能和上下文的属性名相同。
+        :param function: 计算派生值的函数，接受上下文本身。
+        :return: 派生值。
+        """
+        try:
+            return self.__dict__[key]
+        except KeyError:
+            value = self.__dict__[key] = function(self)
+            return value
 
 
 class Condition(metaclass=ABCMeta):
-    """条件判断抽象基类。"""
+    """条件判断抽象基类。
+
+    :var pure: 判断结果是否只取决于用户输入。只有一个状态的所有条件都满足此性质时，该状态的匹配结果才会被缓存。
+    """
+    pure = True
 
     @abstractmethod
-    def check(self, check_string: str) -> bool:
+    def check(self, message: MessageContext) -> bool:
         """判断是否满足条件。
 
-        :param check_string: 需要判断的字符串。
+        :param message: 需要判断的用户消息，可以是 :py:class:`MessageContext` 或者普通的字符串。
         :return: 如果满足条件，返回True；否则返回False。
         """
         pass
@@ -144,27 +213,21 @@ class LengthCondition(Condition):
     :ivar length: 长度。
     """
 
+    _operators = {"<": operator.lt, ">": operator.gt, "<=": operator.le, ">=": operator.ge, "=": operator.eq}
+
     def __init__(self, op: str, length: int) -> None:
         self.op = op
         self.length = length
+        self._compare = self._operators[op]  # 构造时选定比较函数，判断时不再检查运算符
 
     def __repr__(self) -> str:
         return f"Length {self.op} {self.length}"
 
-    def check(self, check_string: str) -> bool:
+    def check(self, message: MessageContext) -> bool:
         """
         参考：:py:meth:`Condition.check`
         """
-        if self.op == "<":
-            return len(check_string) < self.length
-        elif self.op == ">":
-            return len(check_string) > self.length
-        elif self.op == "<=":
-            return len(check_string) <= self.length
-        elif self.op == ">=":
-            return len(check_string) >= self.length
-        elif self.op == "=":
-            return len(check_string) == self.length
+        return self._compare(MessageContext.of(message).length, self.length)
 
 
 class ContainCondition(Condition):
@@ -179,11 +242,11 @@ class ContainCondition(Condition):
     def __repr__(self) -> str:
         return f"Contain {self.string}"
 
-    def check(self, check_string: str) -> bool:
+    def check(self, message: MessageContext) -> bool:
         """
         参考：:py:meth:`Condition.check`
         """
-        return self.string in check_string
+        return self.string in message
 
 
 class TypeCondition(Condition):
@@ -194,22 +257,26 @@ class TypeCondition(Condition):
 
     def __init__(self, type_: str) -> None:
         self.type = type_
+        self._check = self._is_int if type_ == "Int" else self._is_real  # 构造时选定判断函数
 
     def __repr__(self) -> str:
         return f"Type {self.type}"
 
-    def check(self, check_string: str) -> bool:
+    @staticmethod
+    def _is_int(message: MessageContext) -> bool:
+        """判断消息的字面值是否是整数。"""
+        return message.is_digit
+
+    @staticmethod
+    def _is_real(message: MessageContext) -> bool:
+        """判断消息的字面值是否是实数。"""
+        return message.real_value is not None
+
+    def check(self, message: MessageContext) -> bool:
         """
         参考：:py:meth:`Condition.check`
         """
-        if self.type == "Int":
-            return check_string.isdigit()
-        elif self.type == "Real":
-            try:
-                float(check_string)
-                return True
-            except ValueError:
-                return False
+        return self._check(MessageContext.of(message))
 
 
 class EqualCondition(Condition):
@@ -220,15 +287,176 @@ class EqualCondition(Condition):
 
     def __init__(self, string: str) -> None:
         self.string = string
+        self._stripped = string.strip()  # 构造时去除常量的首尾空白
 
     def __repr__(self) -> str:
         return f"Equal {self.string}"
 
-    def check(self, check_string: str) -> bool:
+    def check(self, message: MessageContext) -> bool:
+        """
+        参考：:py:meth:`Condition.check`
+        """
+        return MessageContext.of(message).stripped == self._stripped
+
+
+class InCondition(Condition):
+    """关键词集合判断条件，判断用户输入是否和一组串中的某一个相等。
+
+    和 :py:class:`EqualCondition` 一样，判断时忽略首尾空白。多个同义词共享一个分支和一个动作列表，
+    每条消息只需要一次哈希查找。
+
+    :ivar strings: 字符串列表。
+    """
+
+    def __init__(self, strings: list[str]) -> None:
+        self.strings = strings
+        self._set = frozenset(string.strip() for string in strings)  # 构造时去除常量的首尾空白
+
+    def __repr__(self) -> str:
+        return f"In {', '.join(self.strings)}"
+
+    def check(self, message: MessageContext) -> bool:
+        """
+        参考：:py:meth:`Condition.check`
+        """
+        return MessageContext.of(message).stripped in self._set
+
+
+class MatchCondition(Condition):
+    """正则表达式判断条件，判断用户输入中是否存在和正则表达式匹配的子串。
+
+    同一个状态中的多个正则表达式条件在加载脚本时被合并为一个 :py:class:`RegexGroup` ，
+    此时只需要一次扫描就能得到第一个匹配的条件，参考 :py:meth:`RegexGroup.combine` 。
+
+    :ivar pattern: 正则表达式。
+    :ivar regex: 编译后的正则表达式。
+    :ivar group: 该条件所属的合并模式，没有合并时为None。
+    :ivar position: 该条件在合并模式中的序号。
+    """
+
+    def __init__(self, pattern: str) -> None:
+        self.pattern = pattern
+        self.regex = re.compile(pattern)
+        self.group: Optional[RegexGroup] = None
+        self.position = 0
+
+    def __repr__(self) -> str:
+        return f"Match /{self.pattern}/"
+
+    def check(self, message: MessageContext) -> bool:
+        """
+        参考：:py:meth:`Condition.check`
+        """
+        if self.group is not None:
+            return self.group.first(MessageContext.of(message)) == self.position
+        return self.regex.search(message) is not None
+
+
+class RegexGroup(object):
+    """一个状态中所有正则表达式条件合并成的模式。
+
+    各个条件的正则表达式按照顺序组成不锚定的选择结构，从左到右扫描消息一次：
+
+    1. 用前 ``k`` 个条件组成的选择结构从上一个位置之后继续搜索，找到最左边的匹配位置，开始时 ``k`` 为条件的数量；
+    2. 在该位置上用命名分组的选择结构锚定匹配一次，选择结构按顺序尝试各个分支，匹配的分组就是在该位置匹配的序号最小的条件，
+       将 ``k`` 更新为它的序号；
+    3. 序号更小的条件只可能在更右边匹配，回到第1步，直到搜索失败或者 ``k`` 为0。
+
+    搜索用的选择结构不含捕获分组，因此 ``re`` 能够利用各个分支的前缀快速跳过不可能匹配的位置；命名分组会关闭这一优化，
+    只用于在已知位置上的一次锚定匹配。一条消息的扫描结果保存在 :py:class:`MessageContext` 中，该状态的其他正则表达式条件直接读取。
+
+    :ivar regex: 命名分组的选择结构，用于确定在某个位置匹配的条件。
+    :ivar searches: 第 ``k`` 项是前 ``k`` 个条件组成的不含捕获分组的选择结构，第0项为None。
+    """
+
+    _backreference = re.compile(r"\\[1-9]")  # 合并后分组的编号改变，数字反向引用无法合并
+
+    def __init__(self, conditions: list[MatchCondition]) -> None:
+        self.regex = re.compile("|".join(f"(?P<_c{position}>{condition.pattern})"
+                                         for position, condition in enumerate(conditions)))
+        self.searches: list[Optional[re.Pattern]] = [None] + [
+            re.compile("|".join(f"(?:{condition.pattern})" for condition in conditions[:count]))
+            for count in range(1, len(conditions) + 1)]
+        self._key = f"regex_group_{id(self)}"
+
+    def _scan(self, message: MessageContext) -> int:
+        first = -1
+        search = self.searches[-1]
+        start = 0
+        while True:
+            match = search.search(message, start)
+            if match is None:
+                return first
+            first = int(self.regex.match(message, match.start()).lastgroup[2:])
+            if first == 0:
+                return first
+            search = self.searches[first]
+            start = match.start() + 1
+
+    def first(self, message: MessageContext) -> int:
+        """返回第一个匹配消息的条件在合并模式中的序号，每条消息只扫描一次。
+
+        :param message: 用户消息。
+        :return: 条件的序号，都不匹配时返回-1。
+        """
+        return message.memo(self._key, self._scan)
+
+    @classmethod
+    def combine(cls, conditions: list[Condition]) -> Optional["RegexGroup"]:
+        """合并一个状态中的所有正则表达式条件，并且设置各个条件的 ``group`` 和 ``position`` 。
+
+        少于两个正则表达式条件、某个正则表达式包含数字反向引用或者合并后无法编译时不合并，各个条件单独扫描。
+
+        :param conditions: 一个状态的条件列表。
+        :return: 合并后的模式，没有合并时返回None。
+        """
+        patterns = [condition for condition in conditions if isinstance(condition, MatchCondition)]
+        if len(patterns) < 2 or any(cls._backreference.search(condition.pattern) for condition in patterns):
+            return None
+        try:
+            group = cls(patterns)
+        except re.error:  # 例如不在开头的全局标志、重复的分组名
+            return None
+        for position, condition in enumerate(patterns):
+            condition.group = group
+            condition.position = position
+        return group
+
+
+class SimilarCondition(Condition):
+    """模糊意图判断条件，判断用户输入和给定短语的字符n-gram TF-IDF余弦相似度是否达到阈值。
+
+    同一个状态中的所有 ``Similar`` 条件在加载脚本时共享一个 :py:class:`server.similarity.SimilarIndex` ，
+    每条消息和所有短语的相似度只计算一次。
+
+    :ivar phrase: 短语。
+    :ivar threshold: 相似度阈值，取值范围为0到1。
+    :ivar group: 该条件所属的索引，单独构造的条件在第一次判断时建立只包含自身的索引。
+    :ivar position: 该条件在索引中的序号。
+    """
+
+    def __init__(self, phrase: str, threshold: float) -> None:
+        """
+        :raises ValueError: 短语为空或者只包含空白，或者阈值不在0到1之间时触发。空短语的向量长度为0，相似度没有定义。
+        """
+        if phrase.strip() == "" or not 0 <= threshold <= 1:
+            raise ValueError(f"Similar条件的短语不能为空，阈值必须在0到1之间：{phrase!r} {threshold}")
+        self.phrase = phrase
+        self.threshold = threshold
+        self.group: Any = None
+        self.position = 0
+
+    def __repr__(self) -> str:
+        return f"Similar {self.phrase} {self.threshold}"
+
+    def check(self, message: MessageContext) -> bool:
         """
         参考：:py:meth:`Condition.check`
         """
-        return check_string.strip() == self.string.strip()
+        if self.group is None:
+            from server.similarity import SimilarIndex
+            SimilarIndex.combine([self])
+        return self.group.first(MessageContext.of(message)) == self.position
 
 
 class Action(metaclass=ABCMeta):
@@ -240,7 +468,7 @@ class Action(metaclass=ABCMeta):
 
         :param user_state: 用户状态。
         :param response: 产生回复字符串列表。
-        :param request: 用户请求字符串。
+        :param request: 用户请求，条件转移中为用户消息的 :py:class:`MessageContext` 。
         """
         pass
 
@@ -319,6 +547,39 @@ class UpdateAction(Action):
         self.variable = variable
         self.op = op
         self.value = value
+        self._statement = self._compile(variable, op)
+        self._parameter = self._binder(UserVariableSet.column_type[variable], value)
+
+    @staticmethod
+    def _compile(variable: str, op: str) -> str:
+        """构造时生成更新语句，加减运算在数据库中完成，不需要先读出变量的值。
+
+        :param variable: 变量名。
+        :param op: 更新操作类型。
+        :return: 以更新的值和用户名为参数的 ``UPDATE`` 语句。
+        """
+        expression = {"Add": f"{variable} + ?", "Sub": f"{variable} - ?", "Set": "?"}[op]
+        return f"UPDATE user_variable SET {variable} = {expression} WHERE username = ?"
+
+    @staticmethod
+    def _binder(column_type: str, value: Union[str, int, float]) -> Callable[[Any], Any]:
+        """构造时根据值和变量类型选定参数函数，执行时不再检查这些条件。
+
+        :param column_type: 变量类型。
+        :param value: 更新的值。
+        :return: 参数函数，接受用户输入，返回绑定到更新语句的值。
+        """
+        if value == "Copy":  # 根据用户输入处理值，类型检查时已经解析过的值直接复用
+            attribute = {"Int": "int_value", "Real": "real_value", "Text": None}[column_type]
+            if attribute is None:
+                return str
+
+            return lambda request: getattr(MessageContext.of(request), attribute)
+        if column_type == "Int":
+            value = int(value)
+        elif column_type == "Text":
+            value = value[1:-1]
+        return lambda request: value
 
     def __repr__(self) -> str:
         return f"Update {self.variable} {self.op} {self.value}"
@@ -326,44 +587,13 @@ class UpdateAction(Action):
     def exec(self, user_state: UserState, response: list[str], request: str) -> None:
         """
         参考：:py:meth:`Action.exec`
+
+        更新在一条 ``UPDATE`` 语句中完成，由数据库保证原子性，因此不需要持有 ``db_lock`` 。
         """
-        global database, db_lock
-        with db_lock:
-            store = Store(database)
-            variable_set: UserVariableSet = store.get(UserVariableSet, user_state.username)  # 得到用户的变量集
-            if self.op == "Add":
-                value = getattr(variable_set, self.variable)
-                if self.value == "Copy":  # 根据用户输入处理值
-                    if UserVariableSet.column_type[self.variable] == "Int":
-                        setattr(variable_set, self.variable, value + int(request))
-                    elif UserVariableSet.column_type[self.variable] == "Real":
-                        setattr(variable_set, self.variable, value + float(request))
-                else:
-                    setattr(variable_set, self.variable, value + self.value)
-            elif self.op == "Sub":
-                value = getattr(variable_set, self.variable)
-                if self.value == "Copy":  # 根据用户输入处理值
-                    if UserVariableSet.column_type[self.variable] == "Int":
-                        setattr(variable_set, self.variable, value - int(request))
-                    elif UserVariableSet.column_type[self.variable] == "Real":
-                        setattr(variable_set, self.variable, value - float(request))
-                else:
-                    setattr(variable_set, self.variable, value - self.value)
-            elif self.op == "Set":
-                if self.value == "Copy":  # 根据用户输入处理值
-                    if UserVariableSet.column_type[self.variable] == "Int":
-                        setattr(variable_set, self.variable, int(request))
-                    elif UserVariableSet.column_type[self.variable] == "Real":
-                        setattr(variable_set, self.variable, float(request))
-                    elif UserVariableSet.column_type[self.variable] == "Text":
-                        setattr(variable_set, self.variable, request)
-                else:
-                    if UserVariableSet.column_type[self.variable] == "Text":
-                        setattr(variable_set, self.variable, self.value[1:-1])
-                    else:
-                        setattr(variable_set, self.variable, self.value)
-            store.commit()
-            store.close()
+        start = perf_counter()
+        storage.update(self._statement, self._parameter(request), user_state.username)
+        if tracing.hooks:
+            tracing.db(perf_counter() - start)
 
 
 class SpeakAction(Action):
@@ -372,12 +602,22 @@ class SpeakAction(Action):
     :ivar contents: 回复内容列表。
     """
 
+    _VARIABLE, _STRING, _COPY = range(3)
+
     def __init__(self, contents: list[str]) -> None:
         self.contents = contents
+        self._parts: list[tuple[int, str]] = []  # 构造时区分各个部分的种类
         for content in self.contents:
             if content[0] == '$':
                 if UserVariableSet.column_type.get(content[1:]) is None:
                     raise GrammarError(f"{content[1:]} 变量名不存在", ["Speak"] + contents)
+                self._parts.append((self._VARIABLE, content[1:]))
+            elif content[0] == '"' and content[-1] == '"':
+                self._parts.append((self._STRING, content[1:-1]))
+            elif content == "Copy":
+                self._parts.append((self._COPY, content))
+        # 需要输出的变量，按照第一次出现的顺序去重
+        self._variables = tuple(dict.fromkeys(content for kind, content in self._parts if kind == self._VARIABLE))
 
     def __repr__(self) -> str:
         return "Speak " + " + ".join(self.contents)
@@ -387,18 +627,18 @@ class SpeakAction(Action):
         参考：:py:meth:`Action.exec`
         """
         res = ""
-        global database, db_lock
-        with db_lock:
-            for content in self.contents:
-                if content[0] == '$':  # 输出变量的值
-                    store = Store(database)
-                    variable_set = store.get(UserVariableSet, user_state.username)
-                    res += str(getattr(variable_set, content[1:]))
-                    store.close()
-                elif content[0] == '"' and content[-1] == '"':  # 输出字符串
-                    res += content[1:-1]
-                elif content == "Copy":  # 输出用户的输入
-                    res += request
+        if self._variables:  # 在一次数据库往返中读出需要输出的所有变量
+            start = perf_counter()
+            values = dict(zip(self._variables, storage.fetch(user_state.username, self._variables)))
+            if tracing.hooks:
+                tracing.db(perf_counter() - start)
+        for kind, content in self._parts:
+            if kind == self._STRING:  # 输出字符串
+                res += content
+            elif kind == self._VARIABLE:  # 输出变量的值
+                res += str(values[content])
+            else:  # 输出用户的输入
+                res += request
         response.append(res)
 
 
@@ -417,17 +657,51 @@ class CaseClause(object):
         return repr(self.condition) + ": " + "; ".join([repr(i) for i in self.actions])
 
 
-def init_database(path) -> None:
+storage: Optional[Storage] = None
+
+
+def init_database(path, backend: str = "storm", shards: int = 4, checkpoint_interval: float = 5.0,
+                  keep: bool = False) -> None:
     """初始化数据库。
 
+    除了 ``memory`` 后端会加载已有的数据库文件，其他后端默认删除已有的数据库文件。
+    ``keep`` 为True时保留并打开已有的数据库文件，例如 :py:func:`server.storage.reshard` 的输出。
+
     :param path: 数据库路径。
+    :param backend: 存储后端，可以是 ``storm``、``sqlite``、``memory``、``sharded`` 之一，参考 :py:mod:`server.storage`。
+    :param shards: ``sharded`` 后端的分片数量。
+    :param checkpoint_interval: ``memory`` 后端写回磁盘的间隔（秒）。
+    :param keep: 是否保留已有的数据库文件。
+    :raises ValueError: 存储后端不存在，或者保留的分片文件与分片数量不一致时触发。
     """
-    global database, db_lock
-    dir, file_name = os.path.split(path)
-    if file_name in os.listdir(dir):
-        os.remove(path)
-    database = create_database("sqlite:" + path)
-    db_lock = Lock()
+    global database, db_lock, storage
+    if storage is not None:
+        storage.shutdown()
+    paths = [] if backend == "memory" or keep else [path]
+    if backend == "sharded":
+        shard_paths = [shard_path(path, index) for index in range(shards)]
+        if keep:
+            present = [os.path.exists(database_path) for database_path in shard_paths]
+            if any(present) and (not all(present) or os.path.exists(shard_path(path, shards))):
+                raise ValueError(f"已有的分片文件与分片数量 {shards} 不一致，需要先重新分片")
+        else:
+            paths += shard_paths
+    for database_path in paths:
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(database_path + suffix):
+                os.remove(database_path + suffix)
+    database = create_database("sqlite:" + path + "?journal_mode=WAL")  # WAL模式下读操作不阻塞Update语句的提交
+    db_lock = InstrumentedLock(db_lock_wait_seconds, db_lock_hold_seconds)
+    if backend == "storm":
+        storage = StormStorage(database, db_lock)
+    elif backend == "sqlite":
+        storage = SQLiteStorage(path)
+    elif backend == "memory":
+        storage = MemorySQLiteStorage(path, db_lock, checkpoint_interval)
+    elif backend == "sharded":
+        storage = ShardedSQLiteStorage(path, shards)
+    else:
+        raise ValueError(f"未知的存储后端 {backend}")
 
 
 def get_database():
@@ -436,6 +710,52 @@ def get_database():
     return database
 
 
+def get_storage() -> Storage:
+    """返回存储后端。"""
+    global storage
+    return storage
+
+
+def parse_script(files: list[str], cache: Optional[str] = None) -> list:
+    """解析一个脚本，返回语法树。
+
+    指定了缓存目录时，先按照文法定义和各个脚本文件内容的SHA-256哈希值查找缓存，缓存有效时直接读取JSON格式的语法树，
+    不导入 :py:mod:`server.parser` ；否则解析脚本并且写入缓存。
+
+    :param files: 脚本文件列表。
+    :param cache: 语法树缓存目录，为None时不缓存。
+    :return: 语法树，与 :py:meth:`server.parser.RobotLanguage.parse_files` 的结果相同。
+    :raises GrammarError: 脚本存在语法错误时触发。
+    """
+    path = None
+    if cache is not None:
+        digest = hashlib.sha256()
+        for file in [PARSER_SOURCE] + [file for file in files if len(file) != 0]:
+            with open(file, "rb") as f:
+                digest.update(f.read())
+            digest.update(b"\0")
+        path = os.path.join(cache, digest.hexdigest() + ".json")
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):  # 缓存不存在或者已经损坏，重新解析
+            pass
+
+    from pyparsing import ParseException
+    from server.parser import RobotLanguage
+
+    try:
+        result = RobotLanguage.parse_files(files)
+    except ParseException as err:
+        raise GrammarError(err.__str__(), [err.line])
+    if path is not None:
+        os.makedirs(cache, exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)  # 其他进程不会读到写了一半的缓存
+    return result
+
+
 class StateMachine(object):
     """状态机。
 
@@ -444,6 +764,8 @@ class StateMachine(object):
     :ivar case: 状态的条件分支集合。
     :ivar default: 状态的默认分支。
     :ivar timeout: 状态的超时转移分支。
+    :ivar matchers: 各个状态的匹配函数，接受用户输入，返回第一个满足条件的分支序号，-1表示默认分支。
+    :ivar caches: 各个状态的匹配结果缓存，没有缓存的状态为None。
     """
 
     def _action_constructor(self, language_list: list, target_list: list[Action], index: int, verified: list[bool],
@@ -470,11 +792,15 @@ class StateMachine(object):
             elif language[0] == "Speak":
                 target_list.append(SpeakAction(language[1]))
 
-    def __init__(self, files: list[str]) -> None:
-        try:
-            result = RobotLanguage.parse_files(files)
-        except ParseException as err:
-            raise GrammarError(err.__str__(), [err.line])
+    def __init__(self, files: list[str], compiled: bool = False, cache_size: int = 0,
+                 parse_cache: Optional[str] = None) -> None:
+        """
+        :param files: 脚本文件列表。
+        :param compiled: 是否为每个状态生成专用的匹配函数，参考 :py:mod:`server.codegen`。
+        :param cache_size: 每个状态缓存的匹配结果数量，为0时不缓存。
+        :param parse_cache: 语法树缓存目录，为None时不缓存，参考 :py:func:`parse_script`。
+        """
+        result = parse_script(files, parse_cache)
         self.states: list[str] = []
         verified: list[bool] = []
         self.speak: list[list[Action]] = []
@@ -482,7 +808,6 @@ class StateMachine(object):
         self.default: list[list[Action]] = []
         self.timeout: list[dict[int, list[Action]]] = []
 
-        create_table_statement = ["CREATE TABLE user_variable (username TEXT PRIMARY KEY, passwd TEXT"]  # 建表语句
         # 处理变量定义和状态集
         for definition in result:
             if definition[0] == "Variable":  # 处理变量定义
@@ -492,15 +817,15 @@ class StateMachine(object):
                     if clause[1] == "Int":
                         setattr(UserVariableSet, clause[0][1:], Int(default=clause[2]))
                         UserVariableSet.column_type[clause[0][1:]] = "Int"
-                        create_table_statement.append(f"{clause[0][1:]} INT")
+                        UserVariableSet.column_default[clause[0][1:]] = clause[2]
                     elif clause[1] == "Real":
                         setattr(UserVariableSet, clause[0][1:], Float(default=clause[2]))
                         UserVariableSet.column_type[clause[0][1:]] = "Real"
-                        create_table_statement.append(f"{clause[0][1:]} REAL")
+                        UserVariableSet.column_default[clause[0][1:]] = clause[2]
                     elif clause[1] == "Text":
                         setattr(UserVariableSet, clause[0][1:], Unicode(default=clause[2][1:-1]))
                         UserVariableSet.column_type[clause[0][1:]] = "Text"
-                        create_table_statement.append(f"{clause[0][1:]} TEXT")
+                        UserVariableSet.column_default[clause[0][1:]] = clause[2][1:-1]
             elif definition[0] == "State":  # 处理状态定义
                 if definition[1] not in self.states:
                     self.states.append(definition[1])  # 将状态名加入状态集
@@ -510,6 +835,8 @@ class StateMachine(object):
                         verified.append(True)
                 else:
                     raise GrammarError("状态命名冲突", definition[:1])
+        if "__storm_class_info__" in UserVariableSet.__dict__:  # 新增的列使之前缓存的类信息失效
+            del UserVariableSet.__storm_class_info__
 
         if "Welcome" not in self.states:
             raise GrammarError("没有Welcome状态", [])
@@ -523,13 +850,7 @@ class StateMachine(object):
             self.states[0] = "Welcome"
 
         # 建立数据库
-        global database, db_lock
-        with db_lock:
-            store = Store(database)
-            store.execute(','.join(create_table_statement) + ')')
-            store.add(UserVariableSet("Guest", ''))  # 创建默认的访客用户
-            store.commit()
-            store.close()
+        storage.create_table()
 
         state_index = -1
         # 处理各个分支和动作
@@ -556,12 +877,31 @@ class StateMachine(object):
                         self.case[-1].append(CaseClause(TypeCondition(case_list[2])))
                         if case_list[2] == "Int" or case_list[2] == "Real":
                             value_check = case_list[2]
+                    elif case_list[1] == "In":
+                        self.case[-1].append(CaseClause(InCondition([string[1:-1] for string in case_list[2]])))
+                    elif case_list[1] == "Similar":
+                        if case_list[2][1:-1].strip() == "" or not 0 <= case_list[3] <= 1:
+                            raise GrammarError("Similar条件的短语不能为空，阈值必须在0到1之间", case_list[:4])
+                        self.case[-1].append(CaseClause(SimilarCondition(case_list[2][1:-1], case_list[3])))
+                    elif case_list[1] == "Match":
+                        try:
+                            self.case[-1].append(CaseClause(MatchCondition(case_list[2][1:-1])))
+                        except re.error as err:
+                            raise GrammarError(f"正则表达式错误：{err}", case_list[:3])
                     elif case_list[1][0] == '"' and case_list[1][-1] == '"':
                         self.case[-1].append(CaseClause(EqualCondition(case_list[1][1:-1])))
 
                     self._action_constructor(case_list[-1], self.case[-1][-1].actions, state_index, verified,
                                              value_check)
 
+            RegexGroup.combine([case.condition for case in self.case[-1]])
+            if any(isinstance(case.condition, SimilarCondition) for case in self.case[-1]):
+                try:
+                    from server.similarity import SimilarIndex  # NumPy是可选依赖，只有使用Similar条件时才导入
+                except ImportError:
+                    raise GrammarError("使用Similar条件需要安装NumPy", definition[:2])
+                SimilarIndex.combine([case.condition for case in self.case[-1]])
+
             # Default子句
             self.default.append([])
             self._action_constructor(definition[5][1], self.default[-1], state_index, verified, "Text")
@@ -574,16 +914,108 @@ class StateMachine(object):
                     self._action_constructor(timeout_list[-1], self.timeout[-1][timeout_list[1]],
                                              state_index, verified, None)
 
+        self.matchers: list[Callable[[MessageContext], int]]
+        if compiled:
+            from server.codegen import compile_matchers
+            self.matchers = compile_matchers(self.states, self.case)
+        else:
+            self.matchers = [partial(self._match, clauses) for clauses in self.case]
+
+        self.caches: list[Optional[Callable[[MessageContext], int]]] = [None] * len(self.states)
+        if cache_size > 0:
+            for state, clauses in enumerate(self.case):
+                if len(clauses) != 0 and all(case.condition.pure for case in clauses):
+                    self.caches[state] = lru_cache(maxsize=cache_size)(self.matchers[state])
+                    self.matchers[state] = partial(self._cached_match, self.caches[state], self.matchers[state])
+            registry.gauge_function("robot_match_cache_hits", "匹配结果缓存的命中次数", ("state",),
+                                    partial(self.cache_statistics, "hits"))
+            registry.gauge_function("robot_match_cache_misses", "匹配结果缓存的未命中次数", ("state",),
+                                    partial(self.cache_statistics, "misses"))
+            registry.gauge_function("robot_match_cache_size", "匹配结果缓存的条目数量", ("state",),
+                                    partial(self.cache_statistics, "currsize"))
+
+    @staticmethod
+    def _cached_match(cache: Callable[[MessageContext], int], matcher: Callable[[MessageContext], int],
+                      msg: MessageContext) -> int:
+        """查询匹配结果缓存。
+
+        缓存以原始的用户输入为键，因为 ``Length`` 和 ``Contain`` 条件的结果与首尾空白有关。过长的输入通常不会重复出现，不进入缓存。
+
+        :param cache: 缓存的匹配函数。
+        :param matcher: 原始的匹配函数。
+        :param msg: 用户输入。
+        :return: 参考 :py:meth:`_match`。
+        """
+        if len(msg) > MATCH_CACHE_KEY_LENGTH:
+            return matcher(msg)
+        return cache(msg)
+
+    def cache_statistics(self, field: str) -> dict[tuple, int]:
+        """统计各个状态的匹配结果缓存。
+
+        :param field: 统计的项目，可以是 ``hits``、``misses``、``currsize`` 之一。
+        :return: 从状态名映射到统计值的字典。
+        """
+        return {(self.states[state],): getattr(cache.cache_info(), field)
+                for state, cache in enumerate(self.caches) if cache is not None}
+
+    def clear_cache(self) -> None:
+        """清空所有状态的匹配结果缓存。"""
+        for cache in self.caches:
+            if cache is not None:
+                cache.cache_clear()
+
+    @staticmethod
+    def _match(clauses: list[CaseClause], msg: MessageContext) -> int:
+        """依次检查各个条件分支。
+
+        :param clauses: 一个状态的条件分支列表。
+        :param msg: 用户输入。
+        :return: 第一个满足条件的分支序号，如果都不满足则返回-1。
+        """
+        for index, case in enumerate(clauses):
+            if case.condition.check(msg):
+                return index
+        return -1
+
+    @staticmethod
+    def _exec_actions(actions: list[Action], user_state: UserState, response: list[str], request: Any) -> None:
+        """依次执行一个动作列表，记录每个动作的耗时，并且通知追踪钩子。
+
+        :param actions: 动作列表。
+        :param user_state: 用户状态。
+        :param response: 产生回复字符串列表。
+        :param request: 用户请求字符串。
+        """
+        for action in actions:
+            if tracing.hooks:
+                tracing.action_begin(action)
+            start = perf_counter()
+            action.exec(user_state, response, request)
+            seconds = perf_counter() - start
+            action_seconds.observe((action.__class__.__name__,), seconds)
+            if tracing.hooks:
+                tracing.action_end(action, seconds)
+
     def hello(self, user_state: UserState) -> list[str]:
         """输出某个状态的默认 ``speak`` 动作。
 
         :param user_state: 用户状态。
         :return: 输出的字符串列表。
         """
-        response: list[str] = []
-        for action in self.speak[user_state.state]:
-            action.exec(user_state, response, None)
-        return response
+        start = perf_counter()
+        state_name = self.states[user_state.state]
+        if tracing.hooks:
+            tracing.begin("hello", state_name)
+        try:
+            response: list[str] = []
+            self._exec_actions(self.speak[user_state.state], user_state, response, None)
+            return response
+        finally:
+            seconds = perf_counter() - start
+            transition_seconds.observe((state_name, "hello"), seconds)
+            if tracing.hooks:
+                tracing.end("hello", state_name, seconds)
 
     def condition_transform(self, user_state: UserState, msg: str) -> list[str]:
         """条件转移。
@@ -592,19 +1024,29 @@ class StateMachine(object):
         :param msg: 用户输入。
         :return: 输出的字符串列表。
         """
-        response: list[str] = []
-        for case in self.case[user_state.state]:
-            if case.condition.check(msg):
-                for action in case.actions:
-                    action.exec(user_state, response, msg)
-                if user_state.state != -1:  # 新状态的speak动作
-                    response += self.hello(user_state)
-                return response
-        for action in self.default[user_state.state]:
-            action.exec(user_state, response, msg)
-        if user_state.state != -1:  # 新状态的speak动作
-            response += self.hello(user_state)
-        return response
+        start = perf_counter()
+        state_name = self.states[user_state.state]
+        if tracing.hooks:
+            tracing.begin("condition", state_name)
+        try:
+            response: list[str] = []
+            msg = MessageContext(msg)
+            index = self.matchers[user_state.state](msg)
+            if tracing.hooks:
+                tracing.clause(index)
+            if index != -1:
+                actions = self.case[user_state.state][index].actions
+            else:
+                actions = self.default[user_state.state]
+            self._exec_actions(actions, user_state, response, msg)
+            if user_state.state != -1:  # 新状态的speak动作
+                response += self.hello(user_state)
+            return response
+        finally:
+            seconds = perf_counter() - start
+            transition_seconds.observe((state_name, "condition"), seconds)
+            if tracing.hooks:
+                tracing.end("condition", state_name, seconds)
 
     def timeout_transform(self, user_state: UserState, now_seconds: int) -> (list[str], bool, bool):
         """超时转移。
@@ -613,20 +1055,31 @@ class StateMachine(object):
         :param now_seconds: 用户未执行操作的秒数。
         :return: 输出的字符串列表、是否需要结束会话、是否转移到新的状态。
         """
+        start = perf_counter()
         response: list[str] = []
         with user_state.lock:
             last_seconds = user_state.last_time
             user_state.last_time = now_seconds
         old_state = user_state.state
-        for timeout_sec in self.timeout[user_state.state].keys():
-            if last_seconds < timeout_sec <= now_seconds:  # 检查字典的键是否在时间间隔内
-                for action in self.timeout[user_state.state][timeout_sec]:
-                    action.exec(user_state, response, "")
-                if old_state != user_state.state:  # 如果旧状态和新状态不同，执行新状态的speak动作
-                    if user_state.state != -1:
-                        response += self.hello(user_state)
-                    break
-        return response, user_state.state == -1, old_state != user_state.state
+        state_name = self.states[old_state]
+        if tracing.hooks:
+            tracing.begin("timeout", state_name)
+        try:
+            for index, timeout_sec in enumerate(self.timeout[user_state.state].keys()):
+                if last_seconds < timeout_sec <= now_seconds:  # 检查字典的键是否在时间间隔内
+                    if tracing.hooks:
+                        tracing.clause(index)
+                    self._exec_actions(self.timeout[user_state.state][timeout_sec], user_state, response, "")
+                    if old_state != user_state.state:  # 如果旧状态和新状态不同，执行新状态的speak动作
+                        if user_state.state != -1:
+                            response += self.hello(user_state)
+                        break
+            return response, user_state.state == -1, old_state != user_state.state
+        finally:
+            seconds = perf_counter() - start
+            transition_seconds.observe((state_name, "timeout"), seconds)
+            if tracing.hooks:
+                tracing.end("timeout", state_name, seconds)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,616 @@
+"""用户变量存储模块。
+
+此模块定义用户变量的存储接口 :py:class:`Storage` ，状态机中的用户注册、登录以及 ``Speak`` 和 ``Update`` 动作都通过此接口访问数据库。
+
+存储接口有以下几种实现：
+
+* :py:class:`StormStorage` 通过Storm库进行ORM访问，读操作和注册操作需要持有全局的互斥锁。
+* :py:class:`SQLiteStorage` 直接使用标准库的 ``sqlite3`` ，每个操作从连接池中取出一个连接，相同的语句复用连接中缓存的预编译语句，
+  每个操作都是一条SQL语句，不需要互斥锁。
+* :py:class:`MemorySQLiteStorage` 以内存数据库为主库，后台线程定期将其写回磁盘，用少量更新的持久性换取更低的延迟。
+* :py:class:`ShardedSQLiteStorage` 按照用户名的哈希值将用户分散到多个数据库文件中，每个文件是一个 :py:class:`SQLiteStorage` ，
+  不同文件的写操作可以同时进行。
+
+各个实现使用相同的表结构，表结构由 :py:class:`UserVariableSet` 描述。
+
+Copyright (c) 2021 Ziheng Mao.
+"""
+
+import logging
+import os
+import sqlite3
+import zlib
+from abc import ABCMeta, abstractmethod
+from threading import Event, Lock, Thread
+from time import perf_counter
+from typing import Any
+from storm.locals import Store
+from storm.properties import Unicode
+from server.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+checkpoint_seconds = registry.histogram("robot_checkpoint_seconds", "内存数据库写回磁盘的耗时（秒）")
+checkpoint_failures = registry.counter("robot_checkpoint_failures_total", "内存数据库写回磁盘失败的次数")
+
+SQL_TYPES = {"Int": "INT", "Real": "REAL", "Text": "TEXT"}
+
+
+class UserVariableSet(object):
+    """用户变量集，与数据库关联。
+
+    采用storm作为ORM，除了 ``column_type`` 和 ``column_default`` 之外各个类属性关联到数据库表中的一列，实例中的相关属性关联到元组的对应属性。
+
+    用户的基础属性包括用户名和密码，其他属性则通过 ``setattr`` 动态添加。
+
+    :var column_type: 表中各列的类型。
+    :var column_default: 表中各个用户变量的默认值。
+    """
+    __storm_table__ = 'user_variable'
+    column_type = {"username": "Text", "passwd": "Text"}
+    column_default: dict[str, Any] = dict()
+    username = Unicode(primary=True)
+    passwd = Unicode()
+
+    def __init__(self, username: str, passwd: str) -> None:
+        self.username = username
+        self.passwd = passwd
+
+
+class Storage(metaclass=ABCMeta):
+    """用户变量存储抽象基类。"""
+
+    @staticmethod
+    def variables() -> list[str]:
+        """返回所有用户变量的列名。
+
+        同一进程中之前的脚本定义的变量仍然是 :py:class:`UserVariableSet` 的属性，因此也需要建立对应的列。
+        """
+        return [column for column in UserVariableSet.column_type if column not in ("username", "passwd")]
+
+    @staticmethod
+    def _literal(value: Any) -> str:
+        """将默认值转换为SQL字面值。"""
+        if isinstance(value, str):
+            return "'" + value.replace("'", "''") + "'"
+        return repr(value)
+
+    @classmethod
+    def _column(cls, column: str) -> str:
+        """返回一个用户变量的列定义，带有默认值。"""
+        definition = f"{column} {SQL_TYPES[UserVariableSet.column_type[column]]}"
+        if column in UserVariableSet.column_default:
+            definition += f" DEFAULT {cls._literal(UserVariableSet.column_default[column])}"
+        return definition
+
+    def shutdown(self) -> None:
+        """停止存储后端的后台任务，服务端退出或者重新初始化数据库时调用。"""
+        pass
+
+    def close(self) -> None:
+        """关闭空闲的连接，之后的访问重新打开连接。预分叉的主进程在分叉之前调用，工作进程不会继承主进程的连接。"""
+        pass
+
+    @abstractmethod
+    def create_table(self) -> None:
+        """按照 :py:class:`UserVariableSet` 描述的表结构建表，并且添加默认的访客用户。
+
+        表已经存在时（例如重新分片的输出）保留其中的用户，缺少的用户变量通过 ``ALTER TABLE`` 添加，已有用户的这些变量取默认值。
+        """
+        pass
+
+    @abstractmethod
+    def register(self, username: str, passwd: str) -> bool:
+        """添加一个新用户，各个变量取默认值。
+
+        :param username: 用户名。
+        :param passwd: 密码。
+        :return: 如果添加成功，返回True；用户已经存在时返回False。
+        """
+        pass
+
+    @abstractmethod
+    def login(self, username: str, passwd: str) -> bool:
+        """验证用户名和密码。
+
+        :param username: 用户名。
+        :param passwd: 密码。
+        :return: 如果用户存在并且密码正确，返回True；否则返回False。
+        """
+        pass
+
+    @abstractmethod
+    def fetch(self, username: str, columns: tuple[str, ...]) -> tuple:
+        """在一次数据库往返中读出一个用户的若干变量。
+
+        :param username: 用户名。
+        :param columns: 列名。
+        :return: 各列的值，用户不存在时返回None。
+        """
+        pass
+
+    def exists(self, username: str) -> bool:
+        """判断用户是否存在。
+
+        :param username: 用户名。
+        :return: 如果用户存在，返回True；否则返回False。
+        """
+        return self.fetch(username, ("username",)) is not None
+
+    @abstractmethod
+    def update(self, statement: str, value: Any, username: str) -> None:
+        """执行一条更新语句。
+
+        :param statement: 以更新的值和用户名为参数的 ``UPDATE`` 语句，参考 :py:class:`server.state_machine.UpdateAction` 。
+        :param value: 更新的值。
+        :param username: 用户名。
+        """
+        pass
+
+
+class StormStorage(Storage):
+    """通过Storm库访问数据库。
+
+    Storm库不是线程安全的，除了更新语句以外，每次数据库访问都需要持有互斥锁。
+
+    :ivar database: Storm数据库对象。
+    :ivar lock: 互斥锁。
+    """
+
+    def __init__(self, database: Any, lock: Any) -> None:
+        self.database = database
+        self.lock = lock
+
+    def create_table(self) -> None:
+        """
+        参考：:py:meth:`Storage.create_table`
+        """
+        with self.lock:
+            store = Store(self.database)
+            existing = {row[1] for row in store.execute("PRAGMA table_info(user_variable)")}
+            if len(existing) == 0:
+                columns = [f"{column} {SQL_TYPES[UserVariableSet.column_type[column]]}" for column in self.variables()]
+                store.execute(",".join(["CREATE TABLE user_variable (username TEXT PRIMARY KEY, passwd TEXT"] +
+                                       columns) + ")")
+            else:
+                for column in self.variables():
+                    if column not in existing:
+                        store.execute(f"ALTER TABLE user_variable ADD COLUMN {self._column(column)}")
+            if store.get(UserVariableSet, "Guest") is None:
+                store.add(UserVariableSet("Guest", ''))  # 创建默认的访客用户
+            store.commit()
+            store.close()
+
+    def register(self, username: str, passwd: str) -> bool:
+        """
+        参考：:py:meth:`Storage.register`
+        """
+        with self.lock:
+            store = Store(self.database)
+            if store.get(UserVariableSet, username) is not None:  # 用户已经存在
+                store.close()
+                return False
+            store.rollback()  # 结束只读的事务，插入在新的事务中进行，避免和不持有锁的更新语句产生快照冲突
+            store.add(UserVariableSet(username, passwd))  # 添加新的行
+            store.commit()
+            store.close()
+            return True
+
+    def login(self, username: str, passwd: str) -> bool:
+        """
+        参考：:py:meth:`Storage.login`
+        """
+        with self.lock:
+            store = Store(self.database)
+            variable_set = store.get(UserVariableSet, username)
+            result = variable_set is not None and variable_set.passwd == passwd
+            store.close()
+            return result
+
+    def fetch(self, username: str, columns: tuple[str, ...]) -> tuple:
+        """
+        参考：:py:meth:`Storage.fetch`
+        """
+        with self.lock:
+            store = Store(self.database)
+            variable_set = store.get(UserVariableSet, username)
+            result = None if variable_set is None else tuple(getattr(variable_set, column) for column in columns)
+            store.close()
+            return result
+
+    def update(self, statement: str, value: Any, username: str) -> None:
+        """
+        参考：:py:meth:`Storage.update`
+
+        每次调用打开自己的 ``Store`` ，更新语句由数据库保证原子性，因此不需要持有互斥锁。
+        """
+        store = Store(self.database)
+        try:
+            store.execute(statement, (value, username), noresult=True)
+            store.commit()
+        finally:
+            store.close()  # 出错时回滚，不让连接继续持有写锁
+
+
+class SQLiteStorage(Storage):
+    """直接通过 ``sqlite3`` 访问数据库。
+
+    每个操作从连接池中取出一个空闲的连接，执行完毕之后放回，连接处于自动提交模式，每个操作都是一条SQL语句。
+    Werkzeug的多线程服务器为每个请求创建新的线程，连接不能按照线程保存，否则每个请求都要重新打开连接；
+    连接池中的连接在请求之间保持，``fetch`` 为每一组列名生成一次查询语句，之后相同的语句文本命中连接中缓存的预编译语句。
+
+    :ivar path: 数据库文件路径。
+    :ivar pool_size: 连接池中最多保留的空闲连接数量，超出的连接用完即关闭。
+    """
+
+    def __init__(self, path: str, pool_size: int = 16) -> None:
+        self.path = path
+        self.pool_size = pool_size
+        self._idle: list[sqlite3.Connection] = []  # 空闲的连接，后进先出，最近使用的连接的缓存更可能有效
+        self._idle_lock = Lock()
+        self._select: dict[tuple[str, ...], str] = dict()  # 从列名映射到查询语句
+
+    def acquire(self) -> sqlite3.Connection:
+        """从连接池中取出一个连接，没有空闲的连接时打开新的连接。用完之后必须调用 :py:meth:`release` 放回。"""
+        with self._idle_lock:
+            if self._idle:
+                return self._idle.pop()
+        connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, cached_statements=256,
+                                     check_same_thread=False)
+        connection.execute("PRAGMA journal_mode = WAL")
+        return connection
+
+    def release(self, connection: sqlite3.Connection) -> None:
+        """将连接放回连接池，连接池已满时关闭连接。"""
+        with self._idle_lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def close(self) -> None:
+        """关闭连接池中所有空闲的连接。"""
+        with self._idle_lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+    @classmethod
+    def schema(cls) -> str:
+        """返回建表语句，各个用户变量带有默认值。"""
+        columns = [cls._column(column) for column in cls.variables()]
+        return ",".join(["CREATE TABLE user_variable (username TEXT PRIMARY KEY, passwd TEXT"] + columns) + ")"
+
+    def _ensure_table(self, connection: sqlite3.Connection) -> None:
+        """表不存在时建表，否则添加缺少的用户变量。"""
+        existing = {row[1] for row in connection.execute("PRAGMA table_info(user_variable)")}
+        if len(existing) == 0:
+            connection.execute(self.schema())
+        else:
+            for column in self.variables():
+                if column not in existing:
+                    connection.execute(f"ALTER TABLE user_variable ADD COLUMN {self._column(column)}")
+
+    def create_table(self) -> None:
+        """
+        参考：:py:meth:`Storage.create_table`
+        """
+        connection = self.acquire()
+        try:
+            self._ensure_table(connection)
+        finally:
+            self.release(connection)
+        self.register("Guest", "")  # 创建默认的访客用户
+
+    def register(self, username: str, passwd: str) -> bool:
+        """
+        参考：:py:meth:`Storage.register`
+        """
+        connection = self.acquire()
+        try:
+            cursor = connection.execute("INSERT OR IGNORE INTO user_variable (username, passwd) VALUES (?, ?)",
+                                        (username, passwd))
+            return cursor.rowcount == 1
+        finally:
+            self.release(connection)
+
+    def login(self, username: str, passwd: str) -> bool:
+        """
+        参考：:py:meth:`Storage.login`
+        """
+        connection = self.acquire()
+        try:
+            row = connection.execute("SELECT passwd FROM user_variable WHERE username = ?", (username,)).fetchone()
+        finally:
+            self.release(connection)
+        return row is not None and row[0] == passwd
+
+    def fetch(self, username: str, columns: tuple[str, ...]) -> tuple:
+        """
+        参考：:py:meth:`Storage.fetch`
+        """
+        statement = self._select.get(columns)
+        if statement is None:
+            statement = self._select[columns] = f"SELECT {', '.join(columns)} FROM user_variable WHERE username = ?"
+        connection = self.acquire()
+        try:
+            return connection.execute(statement, (username,)).fetchone()
+        finally:
+            self.release(connection)
+
+    def update(self, statement: str, value: Any, username: str) -> None:
+        """
+        参考：:py:meth:`Storage.update`
+        """
+        connection = self.acquire()
+        try:
+            connection.execute(statement, (value, username))
+        finally:
+            self.release(connection)
+
+
+class MemorySQLiteStorage(SQLiteStorage):
+    """以内存数据库为主库，定期通过SQLite的在线备份接口写回磁盘。
+
+    启动时如果 ``path`` 已经存在，先将其加载到内存中，之后的读写都只访问内存，更新不再等待磁盘同步。
+    后台线程每隔 ``interval`` 秒将内存数据库写回 ``path`` ，停止时再写回一次，因此异常退出时最多丢失一个间隔内的更新。
+
+    内存数据库只有一个连接，各个线程通过互斥锁访问。写回时只在复制内存数据库的快照期间持有锁，写入磁盘在锁外进行。
+
+    :ivar lock: 互斥访问内存数据库的锁。
+    :ivar interval: 写回磁盘的间隔（秒）。
+    """
+
+    def __init__(self, path: str, lock: Any, interval: float) -> None:
+        super().__init__(path)
+        self.lock = lock
+        self.interval = interval
+        self._memory = sqlite3.connect(":memory:", check_same_thread=False, isolation_level=None,
+                                       cached_statements=256)
+        if os.path.exists(path):
+            disk = sqlite3.connect(path)
+            disk.backup(self._memory)
+            disk.close()
+        self._stopped = Event()
+        self._thread = Thread(target=self._run, name="checkpoint", daemon=True)
+        self._thread.start()
+
+    def acquire(self) -> sqlite3.Connection:
+        """返回内存数据库的连接，调用者需要持有 ``lock`` 。"""
+        return self._memory
+
+    def release(self, connection: sqlite3.Connection) -> None:
+        """内存数据库只有一个连接，不需要放回。"""
+        pass
+
+    def close(self) -> None:
+        """内存数据库的连接由所有线程共用，不需要关闭。"""
+        pass
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                self.checkpoint()
+            except Exception:  # 已经记录在失败次数中，下一个间隔重试，后台线程不能因为磁盘错误退出
+                logger.exception("Failed to checkpoint memory database to %s", self.path)
+
+    def checkpoint(self) -> None:
+        """将内存数据库写回磁盘，耗时记录在 ``robot_checkpoint_seconds`` 中。
+
+        :raises sqlite3.Error: 写回失败，失败次数记录在 ``robot_checkpoint_failures_total`` 中。
+        :raises OSError: 同上。
+        """
+        start = perf_counter()
+        snapshot = sqlite3.connect(":memory:")
+        try:
+            with self.lock:
+                self._memory.backup(snapshot)
+            disk = sqlite3.connect(self.path)
+            try:
+                snapshot.backup(disk)
+            finally:
+                disk.close()
+        except (sqlite3.Error, OSError):
+            checkpoint_failures.inc()
+            raise
+        finally:
+            snapshot.close()
+        checkpoint_seconds.observe((), perf_counter() - start)
+
+    def shutdown(self) -> None:
+        """
+        参考：:py:meth:`Storage.shutdown`
+
+        停止后台线程，并且最后一次写回磁盘。
+        """
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._thread.join()
+        self.checkpoint()
+
+    def create_table(self) -> None:
+        """
+        参考：:py:meth:`Storage.create_table`
+        """
+        with self.lock:
+            self._ensure_table(self._memory)
+            super().register("Guest", "")  # 创建默认的访客用户
+
+    def register(self, username: str, passwd: str) -> bool:
+        """
+        参考：:py:meth:`Storage.register`
+        """
+        with self.lock:
+            return super().register(username, passwd)
+
+    def login(self, username: str, passwd: str) -> bool:
+        """
+        参考：:py:meth:`Storage.login`
+        """
+        with self.lock:
+            return super().login(username, passwd)
+
+    def fetch(self, username: str, columns: tuple[str, ...]) -> tuple:
+        """
+        参考：:py:meth:`Storage.fetch`
+        """
+        with self.lock:
+            return super().fetch(username, columns)
+
+    def update(self, statement: str, value: Any, username: str) -> None:
+        """
+        参考：:py:meth:`Storage.update`
+        """
+        with self.lock:
+            super().update(statement, value, username)
+
+
+def shard_path(path: str, index: int) -> str:
+    """返回分片数据库文件的路径，例如 ``robot.db`` 的第1个分片为 ``robot.1.db`` 。
+
+    :param path: 数据库路径。
+    :param index: 分片序号。
+    :return: 分片的路径。
+    """
+    root, extension = os.path.splitext(path)
+    return f"{root}.{index}{extension}"
+
+
+def shard_of(username: str, shards: int) -> int:
+    """返回用户所在的分片。
+
+    采用CRC32而不是内置的 ``hash`` ，后者对字符串的结果在每次启动时不同。
+
+    :param username: 用户名。
+    :param shards: 分片数量。
+    :return: 分片序号。
+    """
+    return zlib.crc32(username.encode("utf-8")) % shards
+
+
+class ShardedSQLiteStorage(Storage):
+    """按照用户名的哈希值将用户分散到多个SQLite数据库文件中。
+
+    SQLite的每个文件同时只允许一个写者，分片之后不同分片中用户的更新可以同时提交。
+    每个用户的所有操作都在它所在的分片中进行，因此注册时只需要在该分片中检查用户名是否已经存在。
+
+    :ivar path: 数据库路径，各个分片的路径参考 :py:func:`shard_path` 。
+    :ivar shards: 各个分片。
+    """
+
+    def __init__(self, path: str, shards: int) -> None:
+        if shards < 1:
+            raise ValueError(f"分片数量 {shards} 必须为正数")
+        self.path = path
+        self.shards = [SQLiteStorage(shard_path(path, index)) for index in range(shards)]
+
+    def shard(self, username: str) -> SQLiteStorage:
+        """返回用户所在的分片。"""
+        return self.shards[shard_of(username, len(self.shards))]
+
+    def close(self) -> None:
+        """关闭各个分片连接池中的空闲连接。"""
+        for shard in self.shards:
+            shard.close()
+
+    def create_table(self) -> None:
+        """
+        参考：:py:meth:`Storage.create_table`
+        """
+        for shard in self.shards:
+            connection = shard.acquire()
+            try:
+                shard._ensure_table(connection)
+            finally:
+                shard.release(connection)
+        self.register("Guest", "")  # 访客用户只保存在它所在的分片中
+
+    def register(self, username: str, passwd: str) -> bool:
+        """
+        参考：:py:meth:`Storage.register`
+        """
+        return self.shard(username).register(username, passwd)
+
+    def login(self, username: str, passwd: str) -> bool:
+        """
+        参考：:py:meth:`Storage.login`
+        """
+        return self.shard(username).login(username, passwd)
+
+    def fetch(self, username: str, columns: tuple[str, ...]) -> tuple:
+        """
+        参考：:py:meth:`Storage.fetch`
+        """
+        return self.shard(username).fetch(username, columns)
+
+    def update(self, statement: str, value: Any, username: str) -> None:
+        """
+        参考：:py:meth:`Storage.update`
+        """
+        self.shard(username).update(statement, value, username)
+
+
+def reshard(source: str, source_shards: int, destination: str, destination_shards: int) -> list[int]:
+    """离线地将数据库中的用户重新分配到新的分片中。
+
+    建表语句从源数据库中读出，因此不需要加载脚本。目标文件必须不存在，源数据库不会被修改。
+    输出的数据库通过 ``init_database(..., keep=True)`` 打开，参考 :py:func:`server.state_machine.init_database` 。
+
+    :param source: 源数据库路径。
+    :param source_shards: 源数据库的分片数量，为1时表示未分片的单个文件。
+    :param destination: 目标数据库路径。
+    :param destination_shards: 目标数据库的分片数量，为1时输出未分片的单个文件。
+    :return: 各个目标分片中的用户数量。
+    """
+    sources = [source] if source_shards == 1 else [shard_path(source, index) for index in range(source_shards)]
+    destinations = [destination] if destination_shards == 1 else \
+        [shard_path(destination, index) for index in range(destination_shards)]
+    for path in sources:
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+    for path in destinations:
+        if os.path.exists(path):
+            raise FileExistsError(path)
+
+    connection = sqlite3.connect(sources[0])
+    schema = connection.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'user_variable'") \
+        .fetchone()[0]
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(user_variable)")]
+    connection.close()
+    insert = f"INSERT INTO user_variable ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))})"
+
+    outputs = [sqlite3.connect(path) for path in destinations]
+    counts = [0] * destination_shards
+    try:
+        for output in outputs:
+            output.execute("PRAGMA journal_mode = WAL")
+            output.execute(schema)
+        for path in sources:
+            connection = sqlite3.connect(path)
+            rows = connection.execute(f"SELECT {', '.join(columns)} FROM user_variable")
+            for row in rows:
+                index = shard_of(row[0], destination_shards)
+                outputs[index].execute(insert, row)
+                counts[index] += 1
+            connection.close()
+        for output in outputs:
+            output.commit()
+    finally:
+        for output in outputs:
+            output.close()
+    return counts
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="离线地将用户变量数据库重新分片。")
+    parser.add_argument("source", help="源数据库路径")
+    parser.add_argument("destination", help="目标数据库路径")
+    parser.add_argument("-s", "--source-shards", type=int, default=1, help="源数据库的分片数量，默认为1，即未分片")
+    parser.add_argument("-n", "--shards", type=int, required=True, help="目标数据库的分片数量")
+    args = parser.parse_args()
+
+    for index, count in enumerate(reshard(args.source, args.source_shards, args.destination, args.shards)):
+        print(f"shard {index}: {count} user(s)")
@@ -0,0 +1,282 @@
+"""状态转移追踪模块。
+
+此模块为状态机提供可插拔的追踪钩子。状态机在条件转移、超时转移、输出默认 ``speak`` 动作、执行每个动作以及每次访问数据库时通知所有已注册的钩子。
+
+:py:class:`CollapsedStackTracer` 是一个按比例采样的钩子，能够将记录的耗时导出为火焰图工具可用的折叠栈格式，帮助脚本作者找到脚本中开销较大的状态。
+
+Copyright (c) 2021 Ziheng Mao.
+"""
+
+import random
+from threading import Lock, local
+from time import perf_counter
+from typing import Any, Optional
+
+hooks: list["TransitionHook"] = []
+
+
+class TransitionHook(object):
+    """追踪钩子基类，子类按需覆盖各个方法。
+
+    同一个线程中的通知按照执行顺序到达，转移可以嵌套，例如条件转移之后会输出新状态的默认 ``speak`` 动作。
+    """
+
+    def on_begin(self, kind: str, state: str) -> None:
+        """开始一次转移。
+
+        :param kind: 转移的种类，可以是 ``condition``、``timeout``、``hello`` 之一。
+        :param state: 转移前的状态名。
+        """
+        pass
+
+    def on_clause(self, index: int) -> None:
+        """选中了一个分支。
+
+        :param index: 分支的序号。条件转移中-1表示 ``Default`` 分支，超时转移中为超时分支的序号。
+        """
+        pass
+
+    def on_action_begin(self, action: Any) -> None:
+        """开始执行一个动作。
+
+        :param action: 动作对象。
+        """
+        pass
+
+    def on_action_end(self, action: Any, seconds: float) -> None:
+        """一个动作执行完毕。
+
+        :param action: 动作对象。
+        :param seconds: 动作的耗时。
+        """
+        pass
+
+    def on_db(self, seconds: float) -> None:
+        """完成了一次数据库往返。
+
+        :param seconds: 数据库往返的耗时。
+        """
+        pass
+
+    def on_end(self, kind: str, state: str, seconds: float) -> None:
+        """一次转移结束，转移中抛出异常时同样会通知。
+
+        :param kind: 转移的种类。
+        :param state: 转移前的状态名。
+        :param seconds: 转移的耗时。
+        """
+        pass
+
+
+def add_hook(hook: TransitionHook) -> None:
+    """注册一个钩子。"""
+    hooks.append(hook)
+
+
+def remove_hook(hook: TransitionHook) -> None:
+    """移除一个钩子。"""
+    hooks.remove(hook)
+
+
+def begin(kind: str, state: str) -> None:
+    """参考：:py:meth:`TransitionHook.on_begin`"""
+    for hook in hooks:
+        hook.on_begin(kind, state)
+
+
+def clause(index: int) -> None:
+    """参考：:py:meth:`TransitionHook.on_clause`"""
+    for hook in hooks:
+        hook.on_clause(index)
+
+
+def action_begin(action: Any) -> None:
+    """参考：:py:meth:`TransitionHook.on_action_begin`"""
+    for hook in hooks:
+        hook.on_action_begin(action)
+
+
+def action_end(action: Any, seconds: float) -> None:
+    """参考：:py:meth:`TransitionHook.on_action_end`"""
+    for hook in hooks:
+        hook.on_action_end(action, seconds)
+
+
+def db(seconds: float) -> None:
+    """参考：:py:meth:`TransitionHook.on_db`"""
+    for hook in hooks:
+        hook.on_db(seconds)
+
+
+def end(kind: str, state: str, seconds: float) -> None:
+    """参考：:py:meth:`TransitionHook.on_end`"""
+    for hook in hooks:
+        hook.on_end(kind, state, seconds)
+
+
+class _Frame(object):
+    """调用栈中的一帧。
+
+    :ivar name: 帧名。
+    :ivar kind: 帧的种类，``transition``、``clause``、``action`` 之一。
+    :ivar start: 进入该帧的时刻。
+    :ivar child: 子帧的总耗时。
+    """
+    __slots__ = ("name", "kind", "start", "child")
+
+    def __init__(self, name: str, kind: str) -> None:
+        self.name = name
+        self.kind = kind
+        self.start = perf_counter()
+        self.child = 0.0
+
+
+class CollapsedStackTracer(TransitionHook):
+    """按比例采样状态转移，并且以折叠栈格式汇总各帧的自身耗时。
+
+    每条折叠栈形如 ``Recharge condition;Case #0;UpdateAction;db 1520`` ，各帧之间以分号分隔，最后是该栈的自身耗时（微秒）。
+
+    是否采样在最外层的转移开始时决定，嵌套的转移跟随外层的决定。
+
+    :ivar sample_rate: 采样比例，取值范围为0到1。
+    :ivar stacks: 从折叠栈映射到累计自身耗时（秒）的字典。
+    :ivar lock: 互斥访问 ``stacks`` 的锁。
+    """
+
+    def __init__(self, sample_rate: float = 1.0, seed: Optional[int] = None) -> None:
+        self.sample_rate = sample_rate
+        self.stacks: dict[str, float] = dict()
+        self.lock = Lock()
+        self._random = random.Random(seed)
+        self._local = local()
+
+    def _frames(self) -> Optional[list[_Frame]]:
+        """返回当前线程正在采样的调用栈，如果当前线程没有在采样则返回None。"""
+        return getattr(self._local, "frames", None)
+
+    def _pop(self, frames: list[_Frame]) -> None:
+        """弹出栈顶的帧，并且记录其自身耗时。"""
+        key = ";".join(frame.name for frame in frames)
+        frame = frames.pop()
+        total = perf_counter() - frame.start
+        self._add(key, total - frame.child)
+        if frames:
+            frames[-1].child += total
+
+    def _add(self, key: str, seconds: float) -> None:
+        with self.lock:
+            self.stacks[key] = self.stacks.get(key, 0.0) + seconds
+
+    def on_begin(self, kind: str, state: str) -> None:
+        frames = self._frames()
+        if frames is None:
+            depth = getattr(self._local, "depth", 0)
+            if depth > 0 or self._random.random() >= self.sample_rate:
+                self._local.depth = depth + 1  # 未采样，只记录嵌套深度
+                return
+            frames = self._local.frames = []
+        frames.append(_Frame(f"{state} {kind}", "transition"))
+
+    def on_clause(self, index: int) -> None:
+        frames = self._frames()
+        if not frames:
+            return
+        while frames[-1].kind != "transition":  # 超时转移可能依次选中多个分支
+            self._pop(frames)
+        kind = frames[-1].name.rsplit(" ", 1)[-1]
+        if kind == "timeout":
+            frames.append(_Frame(f"Timeout #{index}", "clause"))
+        elif index == -1:
+            frames.append(_Frame("Default", "clause"))
+        else:
+            frames.append(_Frame(f"Case #{index}", "clause"))
+
+    def on_action_begin(self, action: Any) -> None:
+        frames = self._frames()
+        if frames:
+            frames.append(_Frame(action.__class__.__name__, "action"))
+
+    def on_action_end(self, action: Any, seconds: float) -> None:
+        frames = self._frames()
+        if frames and frames[-1].kind == "action":
+            self._pop(frames)
+
+    def on_db(self, seconds: float) -> None:
+        frames = self._frames()
+        if frames:
+            self._add(";".join(frame.name for frame in frames) + ";db", seconds)
+            frames[-1].child += seconds
+
+    def on_end(self, kind: str, state: str, seconds: float) -> None:
+        frames = self._frames()
+        if frames is None:
+            depth = getattr(self._local, "depth", 0)
+            if depth > 0:
+                self._local.depth = depth - 1
+            return
+        while frames:  # 弹出到本次转移的帧为止，转移中抛出异常时栈中可能残留动作帧
+            is_transition = frames[-1].kind == "transition"
+            self._pop(frames)
+            if is_transition:
+                break
+        if not frames:
+            self._local.frames = None
+
+    def collapsed(self) -> list[str]:
+        """以折叠栈格式返回记录的结果。
+
+        :return: 折叠栈列表，耗时以微秒为单位。
+        """
+        with self.lock:
+            stacks = sorted(self.stacks.items())
+        return [f"{key} {max(int(seconds * 1000000), 0)}" for key, seconds in stacks]
+
+    def dump(self, path: str) -> None:
+        """将记录的结果写入文件，该文件可以直接作为 ``flamegraph.pl`` 等火焰图工具的输入。
+
+        :param path: 文件路径。
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            for line in self.collapsed():
+                f.write(line + "\n")
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    from server import tracing
+    from server.state_machine import StateMachine, UserState, GrammarError, init_database
+
+    parser = argparse.ArgumentParser(description="按顺序向脚本发送一组消息，并且将各个状态的耗时导出为折叠栈文件。")
+    parser.add_argument("source", nargs="+", help="脚本文件")
+    parser.add_argument("-m", "--messages", required=True,
+                        help="消息文件，每行一条消息，形如 \"#timeout 60\" 的行表示一次超时转移")
+    parser.add_argument("-o", "--output", default="trace.folded", help="输出的折叠栈文件")
+    parser.add_argument("-r", "--rate", type=float, default=1.0, help="采样比例")
+    parser.add_argument("-n", "--repeat", type=int, default=1, help="重复发送消息文件的次数")
+    args = parser.parse_args()
+
+    init_database(os.path.realpath("trace.db"))
+    try:
+        machine = StateMachine(args.source)
+    except GrammarError as err:
+        print(" ".join([str(item) for item in err.context]))
+        print("GrammarError: ", err.msg)
+        raise SystemExit(1)
+    tracer = CollapsedStackTracer(args.rate)
+    tracing.add_hook(tracer)
+    with open(args.messages, "r", encoding="utf-8") as f:
+        messages = [line.rstrip("\n") for line in f]
+    for i in range(args.repeat):
+        user_state = UserState()
+        user_state.register(f"trace{i}", "")
+        machine.hello(user_state)
+        for message in messages:
+            if user_state.state == -1:
+                break
+            if message.startswith("#timeout "):
+                machine.timeout_transform(user_state, int(message.split()[1]))
+            else:
+                machine.condition_transform(user_state, message)
+    tracer.dump(args.output)
+    os.remove(os.path.realpath("trace.db"))
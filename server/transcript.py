@@ -0,0 +1,192 @@
+"""对话记录模块。
+
+:py:class:`TranscriptLog` 记录每一条 ``/send`` 消息和服务端的响应，用于审计。请求线程只将一条记录追加到有界队列中，
+后台线程批量地将记录写入gzip压缩的JSONL文件，不会增加 ``condition_transform`` 所在请求的延迟。
+
+队列是 ``collections.deque`` ，后台线程取出记录是原子操作；请求线程检查容量和追加记录在互斥锁中进行，否则并发的请求可能超出容量。
+队列满时按照策略处理新的记录：
+
+* ``drop`` ：丢弃新的记录，请求不会等待。
+* ``block`` ：唤醒后台线程并且等待队列腾出空间，超过 ``block_timeout`` 秒仍然没有空间时丢弃。
+
+停止之后后台线程不会再写入，追加的记录直接拒绝并且计数，而不是留在队列中丢失。
+
+每一批记录写为gzip文件中的一个成员，写完即关闭文件，因此文件在任何时刻都是完整的，可以直接用 ``zcat`` 或者 ``gzip.open`` 读取。
+文件大小超过 ``max_bytes`` 之后轮转， ``transcript.jsonl.gz`` 依次改名为 ``transcript.1.jsonl.gz`` 、 ``transcript.2.jsonl.gz`` 等，
+最多保留 ``backups`` 个旧文件。预分叉的工作进程各自写入带有进程号的文件，例如 ``transcript-1234.jsonl.gz`` 。
+
+每条记录是一个JSON对象，包括时刻、会话名、转移前后的状态名（会话结束时为null）、用户消息、响应和状态转移的耗时（秒）。
+
+Copyright (c) 2021 Ziheng Mao.
+"""
+
+import os
+import gzip
+import json
+import weakref
+from collections import deque
+from threading import Event, Lock, Thread
+from time import perf_counter, monotonic
+from server.metrics import registry
+
+FIELDS = ("time", "session", "state", "next_state", "msg", "response", "seconds")
+POLICIES = ("drop", "block")
+BATCH_SIZE = 256  # 每批写入的最大记录数，队列中积累了这么多记录时立即唤醒后台线程
+
+records_total = registry.counter("robot_transcript_records_total", "对话记录的数量", ("result",))
+write_seconds = registry.histogram("robot_transcript_write_seconds", "写入一批对话记录的耗时（秒）")
+
+_logs: "weakref.WeakSet[TranscriptLog]" = weakref.WeakSet()  # 当前进程中所有的对话记录，分叉之后在子进程中重新启动
+
+
+def _after_fork() -> None:
+    for log in list(_logs):
+        log._after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def _insert(path: str, text: str) -> str:
+    """在文件名的第一个点之前插入一段文本，例如 ``transcript.jsonl.gz`` 插入 ``.1`` 得到 ``transcript.1.jsonl.gz`` 。"""
+    directory, name = os.path.split(path)
+    stem, dot, suffix = name.partition(".")
+    return os.path.join(directory, stem + text + dot + suffix)
+
+
+class TranscriptLog(object):
+    """异步批量写入的对话记录。
+
+    :ivar path: 记录文件路径。
+    :ivar capacity: 队列容量。
+    :ivar policy: 队列满时的处理策略， ``drop`` 或者 ``block`` 。
+    :ivar max_bytes: 记录文件轮转的大小（字节）。
+    :ivar backups: 保留的旧文件数量。
+    :ivar interval: 后台线程写入的最长间隔（秒）。
+    :ivar block_timeout: ``block`` 策略下等待队列腾出空间的最长时间（秒）。
+    """
+
+    def __init__(self, path: str, capacity: int = 10000, policy: str = "drop", max_bytes: int = 64 << 20,
+                 backups: int = 5, interval: float = 1.0, block_timeout: float = 1.0) -> None:
+        """
+        :raises ValueError: 策略不存在或者容量不是正数时触发。
+        """
+        if policy not in POLICIES:
+            raise ValueError(f"不支持的队列策略 {policy}")
+        if capacity < 1:
+            raise ValueError(f"队列容量 {capacity} 必须为正数")
+        self.path = path
+        self.capacity = capacity
+        self.policy = policy
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.interval = interval
+        self.block_timeout = block_timeout
+        self._file = path  # 当前进程写入的文件
+        self._start()
+        _logs.add(self)
+
+    def _start(self) -> None:
+        self._queue: deque[tuple] = deque()
+        self._lock = Lock()  # 保护容量检查和追加，以及停止标志
+        self._wake = Event()  # 唤醒后台线程
+        self._space = Event()  # 后台线程取出了一批记录，队列腾出了空间
+        self._stopped = Event()
+        self._thread = Thread(target=self._run, name="transcript", daemon=True)
+        self._thread.start()
+
+    def _after_fork(self) -> None:
+        """子进程中没有后台线程，继承的队列由父进程写入。子进程重新启动后台线程，写入自己的文件。"""
+        if self._stopped.is_set():
+            return
+        self._file = _insert(self.path, f"-{os.getpid()}")
+        self._start()
+
+    def push(self, record: tuple) -> bool:
+        """追加一条记录。
+
+        :param record: 按照 :py:data:`FIELDS` 顺序排列的元组。
+        :return: 如果记录被丢弃，或者已经停止，返回False。
+        """
+        deadline = monotonic() + self.block_timeout
+        while True:
+            with self._lock:
+                if self._stopped.is_set():
+                    records_total.inc(("rejected",))
+                    return False
+                queue = self._queue
+                if len(queue) < self.capacity:
+                    queue.append(record)
+                    if len(queue) >= BATCH_SIZE:
+                        self._wake.set()
+                    return True
+            if self.policy == "drop" or not self._wait(deadline):
+                records_total.inc(("dropped",))
+                return False
+
+    def _wait(self, deadline: float) -> bool:
+        """等待队列腾出空间，到达截止时刻或者已经停止时返回False。
+
+        :param deadline: 截止时刻，与 ``time.monotonic`` 的返回值比较。
+        """
+        while True:
+            self._space.clear()
+            if len(self._queue) < self.capacity:
+                return True
+            remaining = deadline - monotonic()
+            if remaining <= 0 or self._stopped.is_set():
+                return False
+            self._wake.set()
+            self._space.wait(remaining)
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self._drain()
+        self._drain()
+
+    def _drain(self) -> None:
+        """将队列中的所有记录分批写入文件。"""
+        queue = self._queue
+        while queue:
+            batch = []
+            while queue and len(batch) < BATCH_SIZE:
+                batch.append(queue.popleft())
+            self._space.set()
+            try:
+                self._write(batch)
+            except OSError:
+                records_total.inc(("failed",), len(batch))
+            else:
+                records_total.inc(("written",), len(batch))
+
+    def _write(self, batch: list[tuple]) -> None:
+        """将一批记录写为gzip文件的一个成员，文件过大时轮转，耗时记录在 ``robot_transcript_write_seconds`` 中。"""
+        start = perf_counter()
+        data = "".join(json.dumps(dict(zip(FIELDS, record)), ensure_ascii=False) + "\n" for record in batch)
+        with gzip.open(self._file, "ab") as f:
+            f.write(data.encode("utf-8"))
+        if os.path.getsize(self._file) >= self.max_bytes:
+            self.rotate()
+        write_seconds.observe((), perf_counter() - start)
+
+    def rotate(self) -> None:
+        """轮转记录文件，由后台线程调用。"""
+        if self.backups < 1:
+            os.remove(self._file)
+            return
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(_insert(self._file, f".{index}")):
+                os.replace(_insert(self._file, f".{index}"), _insert(self._file, f".{index + 1}"))
+        os.replace(self._file, _insert(self._file, ".1"))
+
+    def shutdown(self) -> None:
+        """停止后台线程，写入队列中剩余的记录，之后追加的记录被拒绝。可以重复调用。"""
+        with self._lock:
+            if self._stopped.is_set():
+                return
+            self._stopped.set()
+        self._wake.set()
+        self._space.set()
+        self._thread.join()
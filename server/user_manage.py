@@ -2,14 +2,104 @@
 
 管理用户的连接、登录、注册和超时释放，采用JWT令牌进行鉴权。
 
+会话可以保存为二进制快照，服务端重启之后加载快照，持有有效JWT令牌的客户端不需要重新连接和登录。快照的格式如下，整数均为小端序：
+
+* 文件头：魔数 ``RSS1`` 、状态名数量（u32）、会话数量（u32）。
+* 状态名：每个状态名为长度（u16）和UTF-8编码的字节串，顺序即保存快照时的状态序号。
+* 会话：每个会话为状态序号（i32）、是否已经登录（u8）、闲置秒数（i64）、会话名长度（u16）、用户名长度（u16），之后是会话名和用户名的UTF-8编码。
+
+多个工作进程共用会话时，使用 :py:class:`SharedUserManage` ，会话保存在一个SQLite文件中，参考 :py:mod:`prefork` 。
+
+同一个会话的请求通过 :py:meth:`UserManage.session` 依次处理：每个会话有一个先进先出的锁（ :py:class:`SessionLocks` ），
+请求在读出会话之前取得锁，在保存修改之后释放锁，不同会话的请求互不等待。
+
 Copyright (c) 2021 Ziheng Mao.
 """
 
+import os
+import mmap
+import logging
 import time
-from typing import Optional
-from threading import Lock, Timer
+import struct
+import sqlite3
+from collections import deque
+from contextlib import contextmanager
+from typing import Iterator, Optional
+from threading import Event, Lock, Timer, Thread, local
+from time import perf_counter
 import jwt
-from server.state_machine import UserState
+from server.state_machine import UserState, get_storage
+from server.metrics import registry
+
+SNAPSHOT_MAGIC = b"RSS1"
+_HEADER = struct.Struct("<4sII")
+_NAME = struct.Struct("<H")
+_SESSION = struct.Struct("<iBqHH")
+
+logger = logging.getLogger(__name__)
+session_wait_seconds = registry.histogram("robot_session_wait_seconds", "请求等待同一个会话的其他请求的时间（秒）")
+
+
+def _string(buffer: mmap.mmap, offset: int, length: int) -> str:
+    """从快照中读出一个UTF-8编码的串。
+
+    :raises struct.error: 串超出文件末尾时触发。
+    """
+    if offset + length > len(buffer):
+        raise struct.error("快照文件被截断")
+    return buffer[offset:offset + length].decode("utf-8")
+
+
+class SessionLocks(object):
+    """各个会话的先进先出锁。
+
+    每个被持有的会话对应一个等待队列，队列中是各个等待线程的 ``Lock`` 。释放时如果有线程在等待，
+    直接将锁交给队首的线程，因此先到达的请求一定先被处理，不会被后到达的请求插队；没有线程等待时删除队列，
+    表的大小不超过正在处理的请求数量。没有竞争时只需要一次字典操作，不需要创建条件变量。
+    """
+
+    def __init__(self) -> None:
+        self._queues: dict[str, deque[Lock]] = dict()
+        self._lock = Lock()
+
+    def acquire(self, name: str) -> None:
+        """持有一个会话，会话已经被持有时排队等待，等待时间记录在 ``robot_session_wait_seconds`` 中。
+
+        :param name: 会话名。
+        """
+        with self._lock:
+            queue = self._queues.get(name)
+            if queue is None:
+                self._queues[name] = deque()
+                return
+            waiter = Lock()
+            waiter.acquire()
+            queue.append(waiter)
+        start = perf_counter()
+        waiter.acquire()  # 前一个请求释放会话时解锁
+        session_wait_seconds.observe((), perf_counter() - start)
+
+    def release(self, name: str) -> None:
+        """释放一个会话，交给等待时间最长的线程。
+
+        :param name: 会话名。
+        """
+        with self._lock:
+            queue = self._queues[name]
+            if queue:
+                queue.popleft().release()
+            else:
+                del self._queues[name]
+
+    def waiting(self, name: str) -> int:
+        """返回等待一个会话的线程数量，会话没有被持有时返回-1。"""
+        with self._lock:
+            queue = self._queues.get(name)
+            return -1 if queue is None else len(queue)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._queues)
 
 
 class User(object):
@@ -32,12 +122,16 @@ class UserManage(object):
     :ivar users: 从用户名映射到 :py:class:`server.user_manage.User` 对象的字典。
     :ivar lock: 互斥访问 ``users`` 字典的锁。
     :ivar key: JWT加密密钥。
+    :ivar session_locks: 各个会话的先进先出锁。
     """
 
     def __init__(self, key: str) -> None:
         self.users: dict[str, User] = dict()
         self.lock = Lock()
         self.key = key
+        self.session_locks = SessionLocks()
+        self._snapshot_lock = Lock()  # 互斥写入快照文件
+        self._autosave_stopped = Event()
 
     def jwt_encode(self, username: str) -> str:
         """JWT令牌编码。
@@ -54,12 +148,41 @@ class UserManage(object):
         :return: 如果解码成功，并且用户存在，则返回对应的 ``User`` 对象。
         :raises jwt.InvalidTokenError: 当解码失败或者用户名不存在时触发。
         """
+        return self._load(self._decode(token))
+
+    @contextmanager
+    def session(self, token: str) -> Iterator[User]:
+        """解码JWT令牌，按照到达的顺序独占对应的会话。
+
+        同一个会话的请求依次执行，前一个请求的状态转移和 :py:meth:`commit` 完成之后，后一个请求才读出会话，
+        因此 ``/send`` 和 ``/echo`` 不会同时修改同一个用户状态。不同会话的请求互不等待。
+
+        :param token: JWT令牌。
+        :return: 上下文管理器，进入时得到对应的 ``User`` 对象。
+        :raises jwt.InvalidTokenError: 当解码失败或者用户名不存在时触发。用户名在等待期间被登录、注册或者超时释放时也会触发。
+        """
+        username = self._decode(token)
+        self.session_locks.acquire(username)
+        try:
+            yield self._load(username)
+        finally:
+            self.session_locks.release(username)
+
+    def _decode(self, token: str) -> str:
+        """解码JWT令牌，返回其中的用户名。"""
         username = jwt.decode(token, self.key, algorithms="HS256").get("username")
-        if username is None or username not in self.users.keys():
+        if username is None:
             raise jwt.InvalidTokenError
-        self.users[username].timer.cancel()
-        self.users[username].timer = Timer(300, self.timeout_handler, username)  # 重设超时计时器
-        return self.users[username]
+        return username
+
+    def _load(self, username: str) -> User:
+        """读出会话，重设超时计时器。"""
+        user = self.users.get(username)
+        if user is None:
+            raise jwt.InvalidTokenError
+        user.timer.cancel()
+        user.timer = Timer(300, self.timeout_handler, username)  # 重设超时计时器
+        return user
 
     def connect(self) -> (User, str):
         """处理新客户端连接到服务器的请求。
@@ -108,6 +231,25 @@ class UserManage(object):
             del self.users[old_username]
         return self.jwt_encode(username)
 
+    def commit(self, user: User) -> None:
+        """保存请求对用户状态的修改。
+
+        会话保存在本进程的内存中，``User`` 对象就是会话本身，因此不需要保存。
+
+        :param user: 客户端对应的 ``User`` 对象。
+        """
+        pass
+
+    def session_count(self) -> dict[tuple, int]:
+        """统计当前的会话数量。
+
+        :return: 从 ``("true",)`` 或 ``("false",)`` 映射到已登录或未登录的会话数量的字典。
+        """
+        with self.lock:
+            users = list(self.users.values())
+        login = sum(1 for user in users if user.state.have_login)
+        return {("true",): login, ("false",): len(users) - login}
+
     def timeout_handler(self, username: str) -> None:
         """超时处理函数。
 
@@ -116,3 +258,250 @@ class UserManage(object):
         with self.lock:
             self.users[username].timer.cancel()
             del self.users[username]  # 释放User对象。
+
+    def save_snapshot(self, path: str, states: list[str]) -> int:
+        """将当前的所有会话保存为二进制快照。
+
+        快照先写入临时文件，再替换 ``path`` ，因此写入过程中退出不会损坏已有的快照。
+
+        :param path: 快照文件路径。
+        :param states: 状态机的状态名列表，参考 :py:attr:`server.state_machine.StateMachine.states` 。
+        :return: 保存的会话数量。
+        """
+        sessions = self._sessions()
+        chunks = [_HEADER.pack(SNAPSHOT_MAGIC, len(states), len(sessions))]
+        for name in states:
+            encoded = name.encode("utf-8")
+            chunks += [_NAME.pack(len(encoded)), encoded]
+        for key, state, have_login, last_time, username in sessions:
+            encoded_key = key.encode("utf-8")
+            encoded_username = username.encode("utf-8")
+            chunks += [_SESSION.pack(state, have_login, last_time, len(encoded_key), len(encoded_username)),
+                       encoded_key, encoded_username]
+        with self._snapshot_lock:
+            with open(path + ".tmp", "wb") as f:
+                f.write(b"".join(chunks))
+            os.replace(path + ".tmp", path)
+        return len(sessions)
+
+    def _sessions(self) -> list[tuple[str, int, bool, int, str]]:
+        """返回所有会话的会话名、状态序号、是否已经登录、闲置秒数和用户名，用于保存快照。"""
+        with self.lock:
+            users = list(self.users.items())
+        return [(key, user.state.state, user.state.have_login, user.state.last_time, user.state.username)
+                for key, user in users]
+
+    def load_snapshot(self, path: str, states: list[str]) -> int:
+        """通过 ``mmap`` 加载二进制快照，恢复其中的会话。
+
+        状态序号按照状态名重新映射到当前的状态机中，已经不存在的状态映射到 ``Welcome`` 。
+        已经登录的用户如果在数据库中不存在，例如服务端启动时重建了数据库，对应的会话不会被恢复，客户端需要重新连接。
+        已经存在的会话不会被覆盖。
+
+        :param path: 快照文件路径。
+        :param states: 状态机的状态名列表。
+        :return: 恢复的会话数量。
+        :raises ValueError: 快照文件的格式错误时触发。
+        """
+        sessions = []
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                raise ValueError("快照文件为空")
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                try:
+                    magic, state_count, session_count = _HEADER.unpack_from(buffer, 0)
+                    if magic != SNAPSHOT_MAGIC:
+                        raise ValueError("快照文件的魔数错误")
+                    offset = _HEADER.size
+                    remap = []  # 从快照中的状态序号映射到当前的状态序号
+                    for _ in range(state_count):
+                        length, = _NAME.unpack_from(buffer, offset)
+                        name = _string(buffer, offset + _NAME.size, length)
+                        offset += _NAME.size + length
+                        remap.append(states.index(name) if name in states else 0)
+                    for _ in range(session_count):
+                        state, have_login, last_time, key_length, username_length = \
+                            _SESSION.unpack_from(buffer, offset)
+                        offset += _SESSION.size
+                        key = _string(buffer, offset, key_length)
+                        username = _string(buffer, offset + key_length, username_length)
+                        offset += key_length + username_length
+                        sessions.append((key, remap[state] if 0 <= state < len(remap) else 0, bool(have_login),
+                                         last_time, username))
+                except (struct.error, UnicodeDecodeError) as err:
+                    raise ValueError("快照文件被截断或者损坏") from err
+
+        storage = get_storage()
+        restored = 0
+        for key, state, have_login, last_time, username in sessions:
+            if have_login and not storage.exists(username):
+                continue
+            user = User(key)
+            user.state.state = state
+            user.state.have_login = have_login
+            user.state.last_time = last_time
+            user.state.username = username
+            user.timer = Timer(300, self.timeout_handler, key)
+            with self.lock:
+                if key in self.users:
+                    continue
+                self.users[key] = user
+            restored += 1
+        return restored
+
+    def autosave(self, path: str, states: list[str], interval: float) -> Thread:
+        """启动后台线程，每隔 ``interval`` 秒保存一次快照，直到调用 :py:meth:`stop_autosave` 。
+        保存失败时记录日志，下一个间隔重试。
+
+        :param path: 快照文件路径。
+        :param states: 状态机的状态名列表。
+        :param interval: 保存的间隔（秒）。
+        :return: 后台线程。
+        """
+        self._autosave_stopped.clear()
+
+        def run() -> None:
+            while not self._autosave_stopped.wait(interval):
+                try:
+                    self.save_snapshot(path, states)
+                except Exception:  # 一次保存失败不能结束线程，下一个间隔重试
+                    logger.exception("Failed to save session snapshot to %s", path)
+
+        thread = Thread(target=run, name="session-snapshot", daemon=True)
+        thread.start()
+        return thread
+
+    def stop_autosave(self) -> None:
+        """停止定期保存快照的后台线程，正在进行的保存会完成。"""
+        self._autosave_stopped.set()
+
+
+class SharedUserManage(UserManage):
+    """会话保存在SQLite文件中的用户管理类，多个工作进程通过同一个文件共用会话。
+
+    每次鉴权从文件中读出会话，构造新的 ``User`` 对象，请求修改了用户状态之后调用 :py:meth:`commit` 写回，
+    因此同一个客户端的请求可以由任意一个工作进程处理。 :py:meth:`UserManage.session` 的锁只在一个进程内有效，
+    同一个会话的请求在不同的工作进程中仍然可能同时执行，后写回的状态覆盖先写回的状态。与 :py:class:`SQLiteStorage` 相同，
+    每个线程在第一次访问时打开自己的连接；工作进程不能使用主进程打开的连接，分叉之前需要调用 :py:meth:`close` 。
+
+    :ivar path: 会话文件路径。
+    """
+
+    def __init__(self, key: str, path: str) -> None:
+        super().__init__(key)
+        self.path = path
+        self._local = local()
+
+    def connection(self) -> sqlite3.Connection:
+        """返回当前线程的连接，第一次调用时打开。"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode = WAL")
+            self._local.connection = connection
+        return connection
+
+    def close(self) -> None:
+        """关闭当前线程的连接。"""
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def create_table(self) -> None:
+        """清空会话文件并且建表，由主进程在分叉之前调用。"""
+        connection = self.connection()
+        connection.execute("DROP TABLE IF EXISTS session")
+        connection.execute("CREATE TABLE session (name TEXT PRIMARY KEY, username TEXT, state INTEGER, "
+                           "have_login INTEGER, last_time INTEGER)")
+
+    def add(self, user: User) -> bool:
+        """向会话文件中添加一个会话。
+
+        :param user: ``User`` 对象，会话名为 ``user.username`` 。
+        :return: 如果会话名已经存在，返回False。
+        """
+        try:
+            self.connection().execute("INSERT INTO session VALUES (?, ?, ?, ?, ?)",
+                                      (user.username, user.state.username, user.state.state,
+                                       user.state.have_login, user.state.last_time))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def _load(self, name: str) -> User:
+        """从会话文件中读出会话，构造新的 ``User`` 对象。"""
+        row = self.connection().execute(
+            "SELECT username, state, have_login, last_time FROM session WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            raise jwt.InvalidTokenError
+        user = User(name)
+        user.state.username, user.state.state, have_login, user.state.last_time = row
+        user.state.have_login = bool(have_login)
+        return user
+
+    def connect(self) -> (User, str):
+        """
+        参考：:py:meth:`UserManage.connect`
+
+        会话名包含进程号，不同的工作进程在同一时刻生成的会话名也不会重复。
+        """
+        user = User(f"Guest_{time.time_ns()}_{os.getpid()}")
+        self.add(user)
+        return user, self.jwt_encode(user.username)
+
+    def _rename(self, user: User, username: str) -> Optional[str]:
+        """登录或注册成功之后，将会话移动到新的会话名。如果该用户已经登录，返回None。"""
+        try:
+            cursor = self.connection().execute(
+                "UPDATE session SET name = ?, username = ?, have_login = ? WHERE name = ?",
+                (username, user.state.username, user.state.have_login, user.username))
+        except sqlite3.IntegrityError:  # 用户已经登录
+            return None
+        if cursor.rowcount == 0:  # 会话已经被其他请求释放
+            return None
+        user.username = username
+        return self.jwt_encode(username)
+
+    def login(self, user: User, username: str, passwd: str) -> Optional[str]:
+        """
+        参考：:py:meth:`UserManage.login`
+        """
+        if not user.state.login(username, passwd):
+            return None
+        return self._rename(user, username)
+
+    def register(self, user: User, username: str, passwd: str) -> Optional[str]:
+        """
+        参考：:py:meth:`UserManage.register`
+        """
+        if not user.state.register(username, passwd):
+            return None
+        return self._rename(user, username)
+
+    def commit(self, user: User) -> None:
+        """
+        参考：:py:meth:`UserManage.commit`
+
+        将用户状态写回会话文件。会话已经被释放时不做任何操作。
+        """
+        self.connection().execute("UPDATE session SET state = ?, last_time = ? WHERE name = ?",
+                                  (user.state.state, user.state.last_time, user.username))
+
+    def _sessions(self) -> list[tuple[str, int, bool, int, str]]:
+        """从会话文件中读出所有会话，因此主进程保存的快照包括各个工作进程的会话。"""
+        return [(name, state, bool(have_login), last_time, username) for name, username, state, have_login, last_time
+                in self.connection().execute("SELECT name, username, state, have_login, last_time FROM session")]
+
+    def session_count(self) -> dict[tuple, int]:
+        """
+        参考：:py:meth:`UserManage.session_count`
+        """
+        counts = dict(self.connection().execute("SELECT have_login, COUNT(*) FROM session GROUP BY have_login"))
+        return {("true",): counts.get(1, 0), ("false",): counts.get(0, 0)}
+
+    def timeout_handler(self, username: str) -> None:
+        """
+        参考：:py:meth:`UserManage.timeout_handler`
+        """
+        self.connection().execute("DELETE FROM session WHERE name = ?", (username,))
@@ -0,0 +1,57 @@
+import unittest
+import time
+from threading import Thread
+from server.admission import RateLimiter, ConcurrencyLimiter, retry_after
+from app import create_app, load_config
+
+
+class TestAdmission(unittest.TestCase):
+    def test_rate_limiter(self):
+        self.assertRaises(ValueError, RateLimiter, 0, 1)
+        limiter = RateLimiter(50, 2, max_keys=2)
+        self.assertEqual([limiter.acquire("a") for _ in range(2)], [0, 0])
+        self.assertGreater(limiter.acquire("a"), 0)
+        self.assertEqual(limiter.acquire("b"), 0)  # 不同的键互不影响
+        time.sleep(0.05)
+        self.assertEqual(limiter.acquire("a"), 0)
+        limiter.acquire("c")  # 淘汰最久没有请求的b
+        self.assertEqual(list(limiter._buckets), ["a", "c"])
+        self.assertEqual(retry_after(0.01), 1)
+        self.assertEqual(retry_after(2.5), 3)
+
+    def test_concurrency_limiter(self):
+        self.assertRaises(ValueError, ConcurrencyLimiter, 0)
+        limiter = ConcurrencyLimiter(1, queue=1, timeout=0.05)
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire())  # 等待超时
+
+        results = []
+        waiter = Thread(target=lambda: results.append(limiter.acquire()))
+        limiter.timeout = 5
+        waiter.start()
+        time.sleep(0.05)
+        self.assertFalse(limiter.acquire())  # 队列已满，立即拒绝
+        limiter.release()
+        waiter.join()
+        self.assertEqual(results, [True])
+        limiter.release()
+
+    def test_app(self):
+        app = create_app(dict(load_config(), rate_limit=1, rate_burst=2, max_concurrency=2))
+        self.addCleanup(create_app, load_config())  # 恢复默认的配置，不影响其他测试
+        client = app.test_client()
+        token = client.get("/").get_json()["token"]
+        statuses = [client.get("/send", query_string={"msg": "你好", "token": token}).status_code for _ in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+        response = client.get("/echo", query_string={"seconds": 1, "token": token})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers["Retry-After"], "1")
+        other = client.get("/").get_json()["token"]  # 其他客户端不受影响
+        self.assertEqual(client.get("/send", query_string={"msg": "你好", "token": other}).status_code, 200)
+        metrics = client.get("/metrics").get_data(as_text=True)
+        self.assertIn('robot_admission_rejected_total{reason="rate"} 2', metrics)
+        self.assertIn('robot_http_responses_total{route="/send",status="429"} 1', metrics)
+
+
+if __name__ == '__main__':
+    unittest.main()
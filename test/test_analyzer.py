@@ -0,0 +1,35 @@
+import unittest
+from server.state_machine import *
+from server.analyzer import analyze, warnings
+
+current_path = os.path.split(os.path.realpath(__file__))[0]
+
+
+class TestAnalyzer(unittest.TestCase):
+    def test_analyze(self):
+        init_database(os.path.join(current_path, "robot.db"))
+        m = StateMachine([os.path.join(current_path, "parser/case2.txt")])
+        reports = analyze(m)
+        os.remove(os.path.join(current_path, "robot.db"))
+
+        self.assertEqual([report.reachable for report in reports], [True, True, False])
+        hello = reports[1]
+        self.assertEqual([clause.shadowed_by for clause in hello.clauses], [[], [], [0], [0, 1], [0, 1], [0, 1]])
+        self.assertEqual(hello.max_checks, 5)
+        self.assertEqual(hello.hello_round_trips, 1)  # 一次读出Speak动作中的所有变量
+        self.assertEqual(hello.timeouts, {0: (0, 1), 500: (1, 1)})
+        goodbye = reports[2]
+        self.assertFalse(any(clause.dead for clause in goodbye.clauses))
+        self.assertEqual([clause.db_round_trips for clause in goodbye.clauses], [1, 3, 2, 1, 0])
+        self.assertEqual(warnings(reports), 4)
+
+    def test_keyword_set(self):
+        init_database(os.path.join(current_path, "robot.db"))
+        m = StateMachine([os.path.join(current_path, "codegen/case2.txt")])
+        reports = analyze(m)
+        os.remove(os.path.join(current_path, "robot.db"))
+        self.assertEqual([clause.shadowed_by for clause in reports[0].clauses], [[], [0], [], [], [], []])
+
+
+if __name__ == '__main__':
+    unittest.main()
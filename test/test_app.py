@@ -1,7 +1,15 @@
+import os
+import tempfile
 import unittest
 import json
+import app as application
 from app import app
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 
 class TestApp(unittest.TestCase):
     def setUp(self):
@@ -73,6 +81,101 @@ class TestApp(unittest.TestCase):
         json_data = json.loads(response.data)
         self.assertIn("token", json_data)
 
+    def test_body(self):
+        response = self.client.post("/", json={})
+        self.assertEqual(response.status_code, 200)
+        token = response.get_json()["token"]
+
+        response = self.client.post("/send", json={"msg": "投诉", "token": token})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/json")
+        self.assertIn("请输入您的建议".encode("utf-8"), response.data)  # 非ASCII字符不转义
+
+        response = self.client.post("/echo", json={"seconds": 60, "token": token})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["msg"][0], "您已经很久没有操作了，即将返回主菜单")
+
+        response = self.client.post("/send", json={"msg": "123"})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post("/send", json=["123", token])
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post("/send", json={"msg": ["123"], "token": token})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post("/send", data="{", content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post("/send", data="msg=123", content_type="text/plain")
+        self.assertEqual(response.status_code, 415)
+
+    @unittest.skipIf(msgpack is None, "msgpack is not installed")
+    def test_msgpack(self):
+        headers = {"Content-Type": "application/msgpack", "Accept": "application/msgpack"}
+        response = self.client.post("/", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/msgpack")
+        self.assertIn("Accept", response.vary)
+        token = msgpack.unpackb(response.data)["token"]
+
+        response = self.client.post("/send", data=msgpack.packb({"msg": "投诉", "token": token}), headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(msgpack.unpackb(response.data)["msg"][0], "请输入您的建议，不超过200个字符")
+
+        response = self.client.post("/send", data=msgpack.packb({"msg": "你好", "token": token}),
+                                    content_type="application/msgpack")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/json")  # 没有Accept时返回JSON
+        self.assertIn("Accept", response.vary)
+
+        response = self.client.post("/send", data=b"\xc1", headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_echo_range(self):
+        token = self.client.post("/").get_json()["token"]
+        for seconds in [10 ** 20, application.MAX_SECONDS + 1, -1]:
+            response = self.client.post("/echo", json={"seconds": seconds, "token": token})
+            self.assertEqual(response.status_code, 400)
+        response = self.client.post("/echo", json={"seconds": application.MAX_SECONDS, "token": token})
+        self.assertEqual(response.status_code, 200)
+        with tempfile.TemporaryDirectory() as directory:  # 超出范围的闲置时间不会进入会话，快照可以正常保存
+            path = os.path.join(directory, "sessions.bin")
+            robot = app.extensions["robot"]
+            self.assertGreater(robot.user_manage.save_snapshot(path, robot.state_machine.states), 0)
+
+    def test_two_apps(self):
+        token = self.client.post("/").get_json()["token"]
+        # 共用同一个数据库文件，默认的应用在之后的测试中仍然可用
+        other = application.create_app(dict(application.load_config(), key="other", keep_database=True))
+        robot = other.extensions["robot"]
+        self.assertIsNot(robot, app.extensions["robot"])
+        self.assertIsNot(robot.user_manage, app.extensions["robot"].user_manage)
+        client = other.test_client()
+        self.assertEqual(client.post("/send", json={"msg": "你好", "token": token}).status_code, 403)
+        other_token = client.post("/").get_json()["token"]
+        self.assertEqual(client.post("/send", json={"msg": "你好", "token": other_token}).status_code, 200)
+        self.assertEqual(self.client.post("/send", json={"msg": "你好", "token": token}).status_code, 200)
+        robot.shutdown()
+        robot.shutdown()  # 重复调用没有影响
+
+    def test_corrupted_snapshot(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "sessions.bin")
+            with open(path, "wb") as f:
+                f.write(b"XXXX")
+            with self.assertLogs("app", "WARNING") as logs:
+                other = application.create_app(dict(application.load_config(), session_snapshot=path,
+                                                    keep_database=True))
+            self.assertIn("corrupted", logs.output[0])
+            other.extensions["robot"].shutdown()  # 退出时重新保存快照
+            self.assertGreater(os.path.getsize(path), 4)
+
+    def test_metrics(self):
+        self.client.get("/")
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        text = response.data.decode()
+        self.assertIn('robot_http_request_seconds_count{route="/"}', text)
+        self.assertIn('robot_transition_seconds_count{state="Welcome",kind="hello"}', text)
+        self.assertIn("robot_sessions", text)
+
 
 if __name__ == '__main__':
     unittest.main()
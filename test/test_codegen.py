@@ -0,0 +1,51 @@
+import unittest
+from server.state_machine import *
+from server.codegen import generate, compile_matchers
+
+current_path = os.path.split(os.path.realpath(__file__))[0]
+
+messages = ["", " ", "是", "不", " 不要", "help me", " 是 ", "好的", "好的 ", "对", "对不对", "帮助", "我需要帮助", "123", "１２３", "²", "12.5",
+            "-3", " 7 ", "1e5", "inf", "abc", "nooooo", " nooooo", "goodbye!", "a" * 11, "a" * 25, "返回", "返回。",
+            "三个字", "\n", "NaN"]
+
+
+class TestCodegen(unittest.TestCase):
+    def test_differential(self):
+        for case in ["codegen/case1.txt", "codegen/case2.txt", "parser/case2.txt"]:
+            init_database(os.path.join(current_path, "robot.db"))
+            m = StateMachine([os.path.join(current_path, case)])
+            compiled = compile_matchers(m.states, m.case)
+            for state in range(len(m.states)):
+                for msg in messages:
+                    self.assertEqual(m.matchers[state](MessageContext(msg)), compiled[state](MessageContext(msg)),
+                                     f"{case} {m.states[state]} {msg!r}")
+
+        init_database(os.path.join(current_path, "robot.db"))
+        m = StateMachine([os.path.join(current_path, "codegen/case1.txt")], compiled=True)
+        user_state = UserState()
+        self.assertEqual(m.condition_transform(user_state, "我需要帮助"), ["帮助"])
+        self.assertEqual(m.condition_transform(user_state, "123"), [])
+        self.assertEqual(user_state.state, 1)
+        os.remove(os.path.join(current_path, "robot.db"))
+
+    def test_generate(self):
+        init_database(os.path.join(current_path, "robot.db"))
+        m = StateMachine([os.path.join(current_path, "codegen/case1.txt")])
+        os.remove(os.path.join(current_path, "robot.db"))
+        welcome, number, any_ = generate(m.states, m.case)
+        self.assertIn("_table", welcome[0])  # 连续的字符串相等条件合并为字典查找
+        self.assertEqual(list(welcome[1].values())[0], {"是": 0, "好的": 1})
+        self.assertNotIn("n < 0", welcome[0])  # 恒不成立的条件被删除
+        self.assertTrue(number[0].rstrip().endswith("return 1"))  # 恒成立的条件之后的分支被删除
+        self.assertNotIn("返回", number[0])
+        self.assertNotIn("isdigit", any_[0])
+
+        init_database(os.path.join(current_path, "robot.db"))
+        m = StateMachine([os.path.join(current_path, "codegen/case2.txt")])
+        os.remove(os.path.join(current_path, "robot.db"))
+        welcome, = generate(m.states, m.case)
+        self.assertEqual(list(welcome[1].values())[0], {"是": 0, "好的": 0, "对": 0})  # 关键词集合并入字典查找
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import gc
+import unittest
+from threading import Thread
+from server.metrics import *
+
+
+class TestCounter(unittest.TestCase):
+    def test_inc(self):
+        counter = Counter("test_total", "test", ("route",))
+        counter.inc(("/send",))
+        counter.inc(("/send",), 2)
+        pool = [Thread(target=counter.inc, args=[("/echo",)]) for _ in range(10)]
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+        self.assertEqual(counter.value(("/send",)), 3)
+        self.assertEqual(counter.value(("/echo",)), 10)
+        self.assertIn('test_total{route="/send"} 3', counter.expose())
+
+    def test_retire(self):
+        counter = Counter("test_total", "test")
+        histogram = Histogram("test_seconds", "test", (), (0.1,))
+
+        def work() -> None:
+            counter.inc()
+            histogram.observe((), 0.5)
+
+        for _ in range(20):  # 每个请求一个新线程
+            thread = Thread(target=work)
+            thread.start()
+            thread.join()
+        gc.collect()
+        self.assertEqual(len(counter._shards), 0)  # 结束的线程的分片已经合并
+        self.assertEqual(counter.value(), 20)
+        self.assertEqual(histogram.count(), 20)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 20', histogram.expose())
+        counter.inc()  # 主线程的分片与合计一起汇总
+        self.assertEqual(counter.value(), 21)
+
+
+class TestHistogram(unittest.TestCase):
+    def test_observe(self):
+        histogram = Histogram("test_seconds", "test", ("state",), (0.1, 1.0))
+        histogram.observe(("Welcome",), 0.05)
+        histogram.observe(("Welcome",), 0.5)
+        histogram.observe(("Welcome",), 5)
+        self.assertEqual(histogram.count(("Welcome",)), 3)
+        text = histogram.expose()
+        self.assertIn("# TYPE test_seconds histogram", text)
+        self.assertIn('test_seconds_bucket{state="Welcome",le="0.1"} 1', text)
+        self.assertIn('test_seconds_bucket{state="Welcome",le="1.0"} 2', text)
+        self.assertIn('test_seconds_bucket{state="Welcome",le="+Inf"} 3', text)
+        self.assertIn('test_seconds_count{state="Welcome"} 3', text)
+
+
+class TestInstrumentedLock(unittest.TestCase):
+    def test_lock(self):
+        wait = Histogram("wait_seconds", "test")
+        hold = Histogram("hold_seconds", "test")
+        lock = InstrumentedLock(wait, hold)
+        with lock:
+            self.assertTrue(lock.locked())
+        self.assertFalse(lock.locked())
+        self.assertEqual(wait.count(), 1)
+        self.assertEqual(hold.count(), 1)
+
+        self.assertTrue(lock.acquire(False))
+        self.assertFalse(lock.acquire(False))  # 获取失败时不记录等待时间
+        self.assertFalse(lock.acquire(timeout=0.01))
+        lock.release()
+        self.assertEqual(wait.count(), 2)
+
+
+class TestRegistry(unittest.TestCase):
+    def test_expose(self):
+        registry = Registry()
+        registry.counter("test_total", "test").inc()
+        registry.gauge_function("test_sessions", "test", ("login",), lambda: {("true",): 2})
+        text = registry.expose()
+        self.assertIn("test_total 1", text)
+        self.assertIn('test_sessions{login="true"} 2', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -14,6 +14,9 @@ class TestRobotLanguage(unittest.TestCase):
         with open(os.path.join(current_path, "parser/result2.txt"), "r") as f:
             result = f.readline().strip()
             self.assertEqual(repr(RobotLanguage.parse_files([os.path.join(current_path, "parser/case2.txt")])), result)
+        result = RobotLanguage.parse_files([os.path.join(current_path, "state_machine/case4.txt")])
+        self.assertEqual(result[0][4][0][1:3], ["Match", "/退(出|款)/"])
+        self.assertEqual(result[0][4][3][1:3], ["Match", "/order\\/[0-9]+/"])
         with self.assertRaises(ParseException):
             RobotLanguage.parse_files([os.path.join(current_path, "parser/case3.txt")]),
         with self.assertRaises(ParseException):
@@ -0,0 +1,56 @@
+import unittest
+from server.state_machine import *
+from server.similarity import SimilarIndex, ngrams
+
+current_path = os.path.split(os.path.realpath(__file__))[0]
+
+
+class TestSimilarIndex(unittest.TestCase):
+    def test_ngrams(self):
+        self.assertEqual(ngrams("abab"), {"a": 2, "b": 2, "ab": 2, "ba": 1, "aba": 1, "bab": 1})
+        self.assertEqual(ngrams(""), {})
+
+    def test_scores(self):
+        conditions = [SimilarCondition("查询余额", 0.6), SimilarCondition("我要投诉", 0.6), SimilarCondition("Hello", 1)]
+        index = SimilarIndex.combine(conditions)
+        scores = index.scores(MessageContext(" 查询余额 "))
+        self.assertAlmostEqual(scores[0], 1.0)
+        self.assertEqual(scores[1], 0.0)
+        self.assertEqual(index.scores(MessageContext("xyz")).tolist(), [0.0, 0.0, 0.0])
+        self.assertLess(index.scores(MessageContext("帮我查询一下余额"))[0], 1.0)
+        self.assertEqual(index.first(MessageContext("hello")), 2)  # 忽略大小写
+        self.assertEqual(index.first(MessageContext("我想投诉")), -1)
+        self.assertEqual(index.first(MessageContext("我要投诉你们")), 1)
+        self.assertEqual([condition.check(MessageContext("查询余额吧")) for condition in conditions],
+                         [True, False, False])
+
+    def test_standalone(self):
+        condition = SimilarCondition("查询余额", 0.5)
+        self.assertTrue(condition.check(MessageContext("余额查询")))
+        self.assertFalse(condition.check(MessageContext("投诉")))
+        self.assertTrue(condition.check("余额查询"))
+        self.assertRaises(ValueError, SimilarCondition, "", 0.5)
+        self.assertRaises(ValueError, SimilarCondition, " \t", 0.5)
+        self.assertRaises(ValueError, SimilarCondition, "查询", 1.5)
+
+
+class TestSimilarCondition(unittest.TestCase):
+    def test_state_machine(self):
+        init_database(os.path.join(current_path, "robot.db"))
+        with self.assertRaises(GrammarError):
+            StateMachine([os.path.join(current_path, "similarity/case2.txt")])
+        with self.assertRaises(GrammarError):  # 空白短语
+            StateMachine([os.path.join(current_path, "similarity/case3.txt")])
+        init_database(os.path.join(current_path, "robot.db"))
+        m = StateMachine([os.path.join(current_path, "similarity/case1.txt")])
+        self.assertIs(m.case[0][0].condition.group, m.case[0][2].condition.group)
+        user_state = UserState()
+        self.assertEqual(m.condition_transform(user_state, "查询余额"), ["余额"])
+        self.assertEqual(m.condition_transform(user_state, "帮我查询余额"), ["余额"])
+        self.assertEqual(m.condition_transform(user_state, "我要投诉客服"), ["投诉"])
+        self.assertEqual(m.condition_transform(user_state, "你好"), ["默认"])
+        os.remove(os.path.join(current_path, "robot.db"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -48,6 +48,66 @@ class TestStateMachine(unittest.TestCase):
 
         os.remove(os.path.join(current_path, "robot.db"))
 
+    def test_match_cache(self):
+        init_database(os.path.join(current_path, "robot.db"))
+        m = StateMachine([os.path.join(current_path, "codegen/case1.txt")], cache_size=2)
+        user_state = UserState()
+        for msg in ["我需要帮助", "我需要帮助", "abcd", "我需要帮助", "x" * 100, "x" * 100]:
+            self.assertEqual(m.condition_transform(user_state, msg), {"abcd": ["默认"], "x" * 100: ["太长了"]}.get(
+                msg, ["帮助"]))
+        self.assertEqual(m.cache_statistics("hits"), {("Welcome",): 2, ("Number",): 0, ("Any",): 0})
+        self.assertEqual(m.cache_statistics("misses"), {("Welcome",): 2, ("Number",): 0, ("Any",): 0})
+        m.clear_cache()
+        self.assertEqual(m.cache_statistics("currsize")[("Welcome",)], 0)
+        os.remove(os.path.join(current_path, "robot.db"))
+
+    def test_parse_cache(self):
+        import shutil
+        cache = os.path.join(current_path, "parse_cache")
+        script = os.path.join(current_path, "parse_cache.txt")
+        shutil.copy(os.path.join(current_path, "parser/case2.txt"), script)
+        result = parse_script([script], cache)
+        self.assertEqual(parse_script([script]), result)
+        self.assertEqual(len(os.listdir(cache)), 1)
+        path = os.path.join(cache, os.listdir(cache)[0])
+
+        with open(path, "w", encoding="utf-8") as f:  # 缓存有效时不重新解析脚本
+            f.write('[["State", "Welcome", [], [], [], ["Default", []], []]]')
+        self.assertEqual(parse_script([script], cache), [["State", "Welcome", [], [], [], ["Default", []], []]])
+        with open(path, "w", encoding="utf-8") as f:  # 缓存损坏时重新解析脚本
+            f.write('[["State"')
+        self.assertEqual(parse_script([script], cache), result)
+
+        with open(script, "a", encoding="utf-8") as f:  # 脚本修改之后缓存失效
+            f.write("\nState Other\n    Default\n")
+        self.assertEqual(parse_script([script], cache)[-1], ["State", "Other", [], [], [], ["Default", []], []])
+        self.assertEqual(len(os.listdir(cache)), 2)
+        with open(script, "a", encoding="utf-8") as f:
+            f.write("State\n")
+        self.assertRaises(GrammarError, parse_script, [script], cache)
+        shutil.rmtree(cache)
+        os.remove(script)
+
+    def test_match_condition(self):
+        init_database(os.path.join(current_path, "robot.db"))
+        with self.assertRaises(GrammarError):
+            StateMachine([os.path.join(current_path, "state_machine/case5.txt")])
+        init_database(os.path.join(current_path, "robot.db"))
+        m = StateMachine([os.path.join(current_path, "state_machine/case4.txt")])
+        welcome = [case.condition for case in m.case[0] if isinstance(case.condition, MatchCondition)]
+        self.assertIsNotNone(welcome[0].group)
+        self.assertEqual([condition.position for condition in welcome], [0, 1, 2, 3, 4])
+        self.assertIsNone(m.case[1][0].condition.group)  # 包含反向引用，不合并
+        user_state = UserState()
+        for msg, result in [("我要退款", ["退"]), ("13800000000", ["手机号13800000000"]), ("x13800000000", ["默认"]),
+                            ("see order/42", ["订单"]), ("HeLLo", ["你好"]), ("help", ["帮助"]), ("", ["默认"])]:
+            self.assertEqual(m.condition_transform(user_state, msg), result)
+        self.assertEqual(m.condition_transform(user_state, "退出"), ["退"])  # 第一个匹配的分支被选中
+        user_state.state = 1
+        self.assertEqual(m.condition_transform(user_state, "aab"), ["重复"])
+        self.assertEqual(m.condition_transform(user_state, "ab"), ["b"])
+        os.remove(os.path.join(current_path, "robot.db"))
+
 
 if __name__ == '__main__':
     unittest.main()
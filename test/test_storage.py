@@ -0,0 +1,185 @@
+import sqlite3
+import time
+import unittest
+from threading import Thread
+from server.state_machine import *
+from server.storage import shard_of, reshard, checkpoint_seconds
+
+current_path = os.path.split(os.path.realpath(__file__))[0]
+
+
+class TestStorage(unittest.TestCase):
+    def test_backends(self):
+        for backend in ["memory", "storm", "sqlite", "sharded"]:
+            with self.subTest(backend=backend):
+                init_database(os.path.join(current_path, "robot.db"), backend)
+                m = StateMachine([os.path.join(current_path, "parser/case2.txt")])
+                storage = get_storage()
+                self.assertTrue(storage.register("test", "passwd"))
+                self.assertFalse(storage.register("test", "other"))
+                self.assertTrue(storage.login("test", "passwd"))
+                self.assertFalse(storage.login("test", "other"))
+                self.assertFalse(storage.login("nobody", ""))
+                self.assertEqual(storage.fetch("test", ("name", "billing", "transactions")), ("用户", 0.0, 0))
+
+                user_state = UserState()
+                self.assertTrue(user_state.login("test", "passwd"))
+                user_state.state = 2
+                self.assertEqual(m.condition_transform(user_state, "nooooo"), ["用户timeoutnooooo"])
+                self.assertEqual(m.condition_transform(user_state, "12"), [])
+                self.assertEqual(storage.fetch("test", ("billing", "name", "transactions")), (13.0, "nooooo", 12))
+                user_state.state = 1
+                self.assertEqual(m.hello(user_state), ["test1nooooo13.012"])
+
+                action = UpdateAction("transactions", "Add", 1, None)
+
+                def add() -> None:
+                    for _ in range(50):
+                        action.exec(user_state, [], None)
+
+                pool = [Thread(target=add) for _ in range(4)]
+                for thread in pool:
+                    thread.start()
+                for thread in pool:
+                    thread.join()
+                self.assertEqual(storage.fetch("test", ("transactions",)), (212,))
+                storage.close()
+        for index in range(4):
+            os.remove(shard_path(os.path.join(current_path, "robot.db"), index))
+
+    def test_pool(self):
+        init_database(os.path.join(current_path, "robot.db"), "sqlite")
+        StateMachine([os.path.join(current_path, "parser/case2.txt")])
+        storage = get_storage()
+        connection = storage.acquire()
+        storage.release(connection)
+        seen = []
+
+        def request() -> None:  # 每个请求一个新线程，连接在线程之间复用
+            seen.append(storage.acquire())
+            storage.release(seen[-1])
+
+        for _ in range(3):
+            thread = Thread(target=request)
+            thread.start()
+            thread.join()
+        self.assertEqual(seen, [connection] * 3)
+        storage.close()
+        self.assertEqual(storage._idle, [])
+        self.assertTrue(storage.login("Guest", ""))  # 关闭之后重新打开连接
+        storage.close()
+
+    def test_memory(self):
+        path = os.path.join(current_path, "robot.db")
+        init_database(path, "memory", checkpoint_interval=0.05)
+        StateMachine([os.path.join(current_path, "parser/case2.txt")])
+        storage = get_storage()
+        self.assertTrue(storage.register("test", "passwd"))
+        storage.update("UPDATE user_variable SET billing = billing + ? WHERE username = ?", 2.5, "test")
+        count = checkpoint_seconds.count()
+        while checkpoint_seconds.count() == count:  # 等待后台线程写回磁盘
+            time.sleep(0.01)
+        connection = sqlite3.connect(path)
+        self.assertEqual(connection.execute("SELECT billing FROM user_variable WHERE username = 'test'").fetchone(),
+                         (2.5,))
+        connection.close()
+
+        storage.update("UPDATE user_variable SET transactions = transactions + ? WHERE username = ?", 3, "test")
+        # 重新初始化时上一个存储后端最后一次写回磁盘，新的存储后端加载磁盘上的数据库，并且添加新的用户变量
+        init_database(path, "memory", checkpoint_interval=60)
+        user_state = UserState()
+        m = StateMachine([os.path.join(current_path, "storage/case1.txt")])
+        storage = get_storage()
+        self.assertFalse(storage.register("test", ""))
+        self.assertTrue(user_state.login("test", "passwd"))
+        self.assertEqual(storage.fetch("test", ("billing", "transactions", "points")), (2.5, 3, 10))
+        self.assertEqual(m.hello(user_state), ["积分10"])
+        storage.shutdown()
+        storage.shutdown()  # 重复调用没有影响
+        os.remove(path)
+
+    def test_checkpoint_errors(self):
+        path = os.path.join(current_path, "robot.db")
+        init_database(path, "memory", checkpoint_interval=0.01)
+        StateMachine([os.path.join(current_path, "parser/case2.txt")])
+        storage = get_storage()
+        checkpoint = storage.checkpoint
+        calls = []
+
+        def failing() -> None:  # 前两次写回失败，后台线程记录日志之后继续重试
+            calls.append(None)
+            if len(calls) <= 2:
+                raise OSError("disk full") if len(calls) == 1 else ValueError("unexpected")
+            checkpoint()
+
+        storage.checkpoint = failing
+        with self.assertLogs("server.storage") as logs:
+            while len(calls) < 3:  # 第三次调用时前两次的错误已经记录
+                time.sleep(0.01)
+        self.assertIn("disk full", logs.output[0])
+        self.assertIn("unexpected", logs.output[1])
+        storage.shutdown()
+        os.remove(path)
+
+    def test_sharded(self):
+        path = os.path.join(current_path, "robot.db")
+        init_database(path, "sharded", 3)
+        StateMachine([os.path.join(current_path, "parser/case2.txt")])
+        storage = get_storage()
+        names = [f"user{i}" for i in range(60)]
+        for name in names:
+            self.assertTrue(storage.register(name, name))
+        for name in names:
+            self.assertFalse(storage.register(name, ""))  # 在所在的分片中检查用户名是否已经存在
+            self.assertTrue(storage.login(name, name))
+        storage.update("UPDATE user_variable SET transactions = transactions + ? WHERE username = ?", 5, "user7")
+        self.assertEqual(storage.fetch("user7", ("transactions",)), (5,))
+        counts = []
+        for index in range(3):
+            connection = sqlite3.connect(shard_path(path, index))
+            rows = [row[0] for row in connection.execute("SELECT username FROM user_variable")]
+            connection.close()
+            self.assertTrue(all(shard_of(name, 3) == index for name in rows))
+            counts.append(len(rows))
+        self.assertEqual(sum(counts), 61)
+        self.assertTrue(all(count > 0 for count in counts))
+        storage.close()
+
+        # 3个分片 -> 单个文件 -> 2个分片
+        single = os.path.join(current_path, "single.db")
+        self.assertEqual(reshard(path, 3, single, 1), [61])
+        self.assertRaises(FileExistsError, reshard, path, 3, single, 1)
+        resharded_path = os.path.join(current_path, "resharded.db")
+        self.assertEqual(sum(reshard(single, 1, resharded_path, 2)), 61)
+        resharded = ShardedSQLiteStorage(resharded_path, 2)
+        for name in names:
+            self.assertTrue(resharded.login(name, name))
+        self.assertTrue(resharded.login("Guest", ""))
+        self.assertEqual(resharded.fetch("user7", ("name", "transactions")), ("用户", 5))
+        self.assertTrue(resharded.register("new", ""))
+        self.assertEqual(resharded.fetch("new", ("billing",)), (0.0,))  # 保留了建表语句中的默认值
+        resharded.close()
+
+        # 服务端打开重新分片的输出，已有的用户和变量保留，新脚本中的变量以默认值添加
+        self.assertRaises(ValueError, init_database, resharded_path, "sharded", 3, keep=True)
+        for backend, target, shards in [("sharded", resharded_path, 2), ("sqlite", single, 4), ("storm", single, 4)]:
+            with self.subTest(backend=backend):
+                init_database(target, backend, shards, keep=True)
+                m = StateMachine([os.path.join(current_path, "storage/case1.txt")])
+                storage = get_storage()
+                user_state = UserState()
+                self.assertTrue(user_state.login("user7", "user7"))
+                self.assertFalse(storage.register("user8", ""))
+                self.assertEqual(storage.fetch("user7", ("transactions", "points")), (5, 10))
+                self.assertEqual(m.hello(user_state), ["积分10"])
+                if backend != "storm":
+                    storage.close()
+        os.remove(single)
+        for index in range(3):
+            os.remove(shard_path(path, index))
+        for index in range(2):
+            os.remove(shard_path(resharded_path, index))
+
+
+if __name__ == '__main__':
+    unittest.main()
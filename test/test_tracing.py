@@ -0,0 +1,47 @@
+import unittest
+from server.state_machine import *
+from server.tracing import CollapsedStackTracer, add_hook, remove_hook
+
+current_path = os.path.split(os.path.realpath(__file__))[0]
+
+
+class TestCollapsedStackTracer(unittest.TestCase):
+    def test_sample_rate(self):
+        tracer = CollapsedStackTracer(0.0)
+        tracer.on_begin("condition", "Welcome")
+        tracer.on_clause(0)
+        tracer.on_begin("hello", "Billing")
+        tracer.on_end("hello", "Billing", 0.0)
+        tracer.on_end("condition", "Welcome", 0.0)
+        self.assertEqual(tracer.collapsed(), [])
+
+    def test_state_machine(self):
+        init_database(os.path.join(current_path, "robot.db"))
+        m = StateMachine([os.path.join(current_path, "parser/case2.txt")])
+        tracer = CollapsedStackTracer()
+        add_hook(tracer)
+        try:
+            user_state = UserState()
+            user_state.register("test", "test")
+            user_state.state = 2
+            m.condition_transform(user_state, "nooooo")
+            user_state.state = 2
+            m.timeout_transform(user_state, 20)
+            user_state.state = 0
+            user_state.have_login = False
+            with self.assertRaises(LoginError):
+                m.condition_transform(user_state, "")
+        finally:
+            remove_hook(tracer)
+            os.remove(os.path.join(current_path, "robot.db"))
+        stacks = [line.rsplit(" ", 1)[0] for line in tracer.collapsed()]
+        self.assertIn("Goodbye condition;Case #1;SpeakAction;db", stacks)
+        self.assertIn("Goodbye condition;Case #1;UpdateAction;db", stacks)
+        self.assertIn("Goodbye condition;Case #1;Goodbye hello", stacks)
+        self.assertIn("Goodbye timeout;Timeout #1;GotoAction", stacks)
+        self.assertIn("Goodbye timeout;Timeout #1;Hello hello;SpeakAction;db", stacks)
+        self.assertIn("Welcome condition;Default;GotoAction", stacks)
+
+
+if __name__ == '__main__':
+    unittest.main()
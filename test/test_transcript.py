@@ -0,0 +1,87 @@
+import unittest
+import os
+import gzip
+import json
+import gc
+from threading import Thread
+from server import transcript
+from server.transcript import TranscriptLog
+
+current_path = os.path.split(os.path.realpath(__file__))[0]
+
+
+def read(path):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+class TestTranscript(unittest.TestCase):
+    def test_write(self):
+        path = os.path.join(current_path, "transcript.jsonl.gz")
+        log = TranscriptLog(path, interval=0.05)
+        self.assertTrue(log.push((1.5, "Guest_1", "Welcome", "Hello", "你好", ["欢迎"], 0.001)))
+        self.assertTrue(log.push((2.5, "Guest_1", "Hello", None, "再见", [], 0.002)))
+        log.shutdown()
+        log.shutdown()
+        records = read(path)
+        self.assertEqual(records[0], {"time": 1.5, "session": "Guest_1", "state": "Welcome", "next_state": "Hello",
+                                      "msg": "你好", "response": ["欢迎"], "seconds": 0.001})
+        self.assertIsNone(records[1]["next_state"])
+        os.remove(path)
+
+    def test_policy(self):
+        path = os.path.join(current_path, "transcript.jsonl.gz")
+        self.assertRaises(ValueError, TranscriptLog, path, policy="wait")
+        log = TranscriptLog(path, capacity=2, interval=60)  # 后台线程不会在测试期间自行写入
+        self.assertEqual([log.push((i, "s", "Welcome", "Welcome", "m", [], 0)) for i in range(3)], [True, True, False])
+        log.shutdown()
+        self.assertEqual([record["time"] for record in read(path)], [0, 1])
+
+        log = TranscriptLog(path, capacity=2, policy="block", interval=60)
+        self.assertEqual([log.push((i, "s", "Welcome", "Welcome", "m", [], 0)) for i in range(3)], [True, True, True])
+        log.shutdown()
+        self.assertEqual([record["time"] for record in read(path)], [0, 1, 0, 1, 2])
+        os.remove(path)
+
+    def test_concurrent(self):
+        path = os.path.join(current_path, "transcript.jsonl.gz")
+        log = TranscriptLog(path, capacity=100, interval=60)
+        results = []
+
+        def push() -> None:
+            results.extend(log.push((0, "s", "Welcome", "Welcome", "m", [], 0)) for _ in range(50))
+
+        pool = [Thread(target=push) for _ in range(4)]
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+        self.assertEqual(results.count(True), 100)  # 并发追加不会超出容量
+        rejected = transcript.records_total.value(("rejected",))
+        log.shutdown()
+        self.assertFalse(log.push((1, "s", "Welcome", "Welcome", "m", [], 0)))  # 停止之后拒绝
+        self.assertEqual(transcript.records_total.value(("rejected",)), rejected + 1)
+        self.assertEqual(len(read(path)), 100)
+        os.remove(path)
+
+        self.assertIn(log, transcript._logs)
+        del log
+        gc.collect()
+        self.assertEqual(len(transcript._logs), 0)  # 分叉时的回调只注册一次，不会让停止的实例一直存活
+
+    def test_rotate(self):
+        path = os.path.join(current_path, "transcript.jsonl.gz")
+        log = TranscriptLog(path, max_bytes=1, backups=2, interval=60)
+        log.shutdown()
+        for batch in range(3):  # 每批写入之后轮转，只保留两个旧文件
+            log._write([(batch * 10 + i, "s", "Welcome", "Welcome", "m", [], 0) for i in range(10)])
+        self.assertFalse(os.path.exists(path))
+        older = read(os.path.join(current_path, "transcript.2.jsonl.gz"))
+        newer = read(os.path.join(current_path, "transcript.1.jsonl.gz"))
+        self.assertEqual([record["time"] for record in older + newer], list(range(10, 30)))
+        os.remove(os.path.join(current_path, "transcript.1.jsonl.gz"))
+        os.remove(os.path.join(current_path, "transcript.2.jsonl.gz"))
+
+
+if __name__ == '__main__':
+    unittest.main()
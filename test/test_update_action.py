@@ -1,4 +1,5 @@
 import unittest
+from threading import Thread
 from server.state_machine import *
 
 current_path = os.path.split(os.path.realpath(__file__))[0]
@@ -57,6 +58,28 @@ class TestUpdateAction(unittest.TestCase):
         self.assertEqual(store.get(UserVariableSet, "test").test2, 2.2)
         store.close()
 
+        action = UpdateAction("test1", "Sub", "Copy", "Int")
+        action.exec(user_state, None, MessageContext("5"))
+        store = Store(get_database())
+        self.assertEqual(store.get(UserVariableSet, "test").test1, -3)
+        store.close()
+
+        # 并发的Add语句不经过db_lock，每次更新都不能丢失
+        action = UpdateAction("test1", "Add", 1, None)
+
+        def add() -> None:
+            for _ in range(50):
+                action.exec(user_state, None, None)
+
+        pool = [Thread(target=add) for _ in range(8)]
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+        store = Store(get_database())
+        self.assertEqual(store.get(UserVariableSet, "test").test1, 397)
+        store.close()
+
         with self.assertRaises(GrammarError):
             UpdateAction("test4", "Set", "", None)
         with self.assertRaises(GrammarError):
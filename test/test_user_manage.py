@@ -0,0 +1,161 @@
+import time
+import unittest
+import jwt
+from threading import Thread
+from server.state_machine import *
+from server.user_manage import UserManage, SharedUserManage
+
+current_path = os.path.split(os.path.realpath(__file__))[0]
+
+
+class TestUserManage(unittest.TestCase):
+    def test_snapshot(self):
+        init_database(os.path.join(current_path, "robot.db"), "sqlite")
+        m = StateMachine([os.path.join(current_path, "parser/case2.txt")])
+        path = os.path.join(current_path, "sessions.bin")
+
+        manage = UserManage("secret")
+        guest, guest_token = manage.connect()
+        guest.state.state = 2
+        guest.state.last_time = 30
+        user, token = manage.connect()
+        token = manage.register(user, "测试", "passwd")
+        user.state.state = 1
+        gone, _ = manage.connect()
+        manage.register(gone, "gone", "")
+        self.assertEqual(manage.save_snapshot(path, m.states), 3)
+
+        connection = get_storage().acquire()
+        connection.execute("DELETE FROM user_variable WHERE username = 'gone'")
+        get_storage().release(connection)
+        restored = UserManage("secret")
+        # 状态的顺序改变，并且删除了Hello状态
+        states = ["Welcome", "Goodbye", "Other"]
+        self.assertEqual(restored.load_snapshot(path, states), 2)
+        self.assertEqual(restored.jwt_decode(guest_token).state.state, 1)
+        self.assertEqual(restored.jwt_decode(guest_token).state.last_time, 30)
+        self.assertFalse(restored.jwt_decode(guest_token).state.have_login)
+        self.assertEqual(restored.jwt_decode(token).state.state, 0)
+        self.assertTrue(restored.jwt_decode(token).state.have_login)
+        self.assertEqual(restored.jwt_decode(token).state.username, "测试")
+        self.assertNotIn("gone", restored.users)
+        self.assertEqual(restored.load_snapshot(path, states), 0)  # 已经存在的会话不会被覆盖
+
+        with open(path, "rb") as f:
+            data = f.read()
+        for corrupted in [b"", b"XXXX" + data[4:], data[:-3], data[:10]]:
+            with open(path, "wb") as f:
+                f.write(corrupted)
+            self.assertRaises(ValueError, UserManage("secret").load_snapshot, path, states)
+        get_storage().close()
+        os.remove(path)
+        os.remove(os.path.join(current_path, "robot.db"))
+
+    def test_autosave(self):
+        path = os.path.join(current_path, "autosave.bin")
+        manage = UserManage("secret")
+        user, _ = manage.connect()
+        user.state.last_time = 10 ** 20  # 无法保存为64位整数
+        with self.assertLogs("server.user_manage", "ERROR"):
+            thread = manage.autosave(path, ["Welcome"], 0.01)
+            time.sleep(0.05)
+        self.assertTrue(thread.is_alive())  # 保存失败之后线程继续运行
+        user.state.last_time = 30
+        deadline = time.monotonic() + 5
+        while not os.path.exists(path) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(os.path.exists(path))
+        manage.stop_autosave()
+        thread.join()
+        os.remove(path)
+
+    def test_session(self):
+        manage = UserManage("secret")
+        user, token = manage.connect()
+        other, other_token = manage.connect()
+        order = []
+
+        def request(index: int, token: str) -> None:
+            try:
+                with manage.session(token) as entered:
+                    order.append((index, entered.username))
+            except jwt.InvalidTokenError:
+                order.append((index, None))
+
+        def wait_for(waiters: int) -> None:
+            while manage.session_locks.waiting(user.username) < waiters:
+                time.sleep(0.001)
+
+        with manage.session(token) as entered:
+            self.assertIs(entered, user)
+            threads = []
+            for index in range(3):  # 依次到达的请求按照到达的顺序执行
+                threads.append(Thread(target=request, args=(index, token)))
+                threads[-1].start()
+                wait_for(index + 1)
+            request(3, other_token)  # 其他会话的请求不需要等待
+            self.assertEqual(order, [(3, other.username)])
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order[1:], [(0, user.username), (1, user.username), (2, user.username)])
+        self.assertEqual(len(manage.session_locks), 0)
+
+        order.clear()
+        with manage.session(token):
+            thread = Thread(target=request, args=(0, token))
+            thread.start()
+            wait_for(1)
+            manage.timeout_handler(user.username)  # 等待期间会话被释放
+        thread.join()
+        self.assertEqual(order, [(0, None)])
+        self.assertRaises(jwt.InvalidTokenError, manage.session(token).__enter__)
+        self.assertEqual(len(manage.session_locks), 0)
+
+    def test_shared(self):
+        init_database(os.path.join(current_path, "robot.db"), "sqlite")
+        m = StateMachine([os.path.join(current_path, "parser/case2.txt")])
+        path = os.path.join(current_path, "sessions.db")
+
+        manage = SharedUserManage("secret", path)
+        manage.create_table()
+        guest, guest_token = manage.connect()
+        guest.state.state = 2
+        guest.state.last_time = 30
+        manage.commit(guest)
+        other = SharedUserManage("secret", path)  # 另一个工作进程
+        self.assertEqual(other.jwt_decode(guest_token).state.state, 2)
+        self.assertEqual(other.jwt_decode(guest_token).state.last_time, 30)
+
+        user, token = other.connect()
+        token = manage.register(manage.jwt_decode(token), "测试", "passwd")
+        self.assertIsNotNone(token)
+        self.assertTrue(other.jwt_decode(token).state.have_login)
+        self.assertEqual(other.jwt_decode(token).state.username, "测试")
+        self.assertRaises(jwt.InvalidTokenError, other.jwt_decode, manage.jwt_encode(user.username))
+        self.assertIsNone(other.login(other.jwt_decode(guest_token), "测试", "passwd"))  # 用户已经登录
+        self.assertEqual(other.session_count(), {("true",): 1, ("false",): 1})
+
+        manage.timeout_handler("测试")
+        self.assertRaises(jwt.InvalidTokenError, other.jwt_decode, token)
+        self.assertEqual(other.login(other.jwt_decode(guest_token), "测试", "passwd"), manage.jwt_encode("测试"))
+        self.assertEqual(manage.session_count(), {("true",): 1, ("false",): 0})
+
+        snapshot = os.path.join(current_path, "shared.bin")  # 主进程从会话文件保存快照
+        self.assertEqual(manage.save_snapshot(snapshot, m.states), 1)
+        restored = UserManage("secret")
+        self.assertEqual(restored.load_snapshot(snapshot, m.states), 1)
+        self.assertEqual(restored.jwt_decode(token).state.state, 2)
+        self.assertEqual(restored.jwt_decode(token).state.last_time, 30)
+        self.assertTrue(restored.jwt_decode(token).state.have_login)
+        os.remove(snapshot)
+        manage.close()
+        other.close()
+        get_storage().close()
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        os.remove(os.path.join(current_path, "robot.db"))
+
+
+if __name__ == '__main__':
+    unittest.main()
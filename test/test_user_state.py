@@ -35,6 +35,22 @@ class TestUserState(TestWithDatabase):
         self.assertTrue(user_state.have_login)
 
 
+class TestMessageContext(unittest.TestCase):
+    def test_lazy(self):
+        message = MessageContext(" 12 ")
+        self.assertEqual(message, " 12 ")
+        self.assertNotIn("stripped", message.__dict__)
+        self.assertEqual(message.stripped, "12")
+        self.assertIn("stripped", message.__dict__)
+        self.assertEqual(message.length, 4)
+        self.assertFalse(message.is_digit)
+        self.assertEqual(message.real_value, 12.0)
+        self.assertEqual(message.int_value, 12)
+        self.assertIsNone(MessageContext("abc").real_value)
+        with self.assertRaises(ValueError):
+            MessageContext("abc").int_value
+
+
 class TestLengthCondition(unittest.TestCase):
     def test_check(self):
         condition = LengthCondition("<", 3)
@@ -74,6 +90,39 @@ class TestEqualCondition(unittest.TestCase):
         self.assertFalse(condition.check(""))
 
 
+class TestInCondition(unittest.TestCase):
+    def test_check(self):
+        condition = InCondition(["是", " 好的 ", "对"])
+        self.assertTrue(condition.check("好的"))
+        self.assertTrue(condition.check(" 是"))
+        self.assertFalse(condition.check("是的"))
+
+
+class TestMatchCondition(unittest.TestCase):
+    def test_check(self):
+        condition = MatchCondition("[0-9]+元")
+        self.assertTrue(condition.check("充值100元"))
+        self.assertFalse(condition.check("充值"))
+
+    def test_combine(self):
+        conditions = [MatchCondition("a"), ContainCondition("x"), MatchCondition("b"), MatchCondition("ab")]
+        group = RegexGroup.combine(conditions)
+        self.assertIsNotNone(group)
+        self.assertEqual(group.first(MessageContext("bab")), 0)
+        self.assertEqual(group.first(MessageContext("b")), 1)
+        self.assertEqual(group.first(MessageContext("c")), -1)
+        # 序号小的条件在序号大的条件的匹配范围之内，或者只能在更右边匹配
+        group = RegexGroup.combine([MatchCondition("bc"), MatchCondition("abcd"), MatchCondition("^a")])
+        self.assertEqual(group.first(MessageContext("abcd")), 0)
+        self.assertEqual(group.first(MessageContext("abd")), 2)
+        self.assertEqual(group.first(MessageContext("xabcd")), 0)
+        message = MessageContext("b")
+        self.assertEqual([condition.check(message) for condition in conditions], [False, False, True, False])
+        self.assertTrue(conditions[2].check("b"))  # 普通的字符串临时创建上下文
+        self.assertIsNone(RegexGroup.combine([MatchCondition("(a)\\1"), MatchCondition("b")]))
+        self.assertIsNone(RegexGroup.combine([MatchCondition("a"), MatchCondition("(?i)b")]))
+
+
 class TestExitAction(TestWithDatabase):
     def test_exec(self):
         action = ExitAction()